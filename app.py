@@ -1,14 +1,19 @@
 from server.app     import app
 from server.website import Website
 from server.backend import Backend_Api
+from server.pool    import warm_db_pool
 
 from json import load
+import os
 
-if __name__ == '__main__':
-    config = load(open('config.json', 'r'))
-    site_config = config['site_config']
-    
-    site = Website(app)
+
+def load_config() -> dict:
+    with open(os.getenv('CONFIG_PATH') or 'config.json', 'r') as f:
+        return load(f)
+
+
+def register_routes(config: dict, start_background: bool = True) -> Backend_Api:
+    site = Website(app, config)
     for route in site.routes:
         app.add_url_rule(
             route,
@@ -16,7 +21,7 @@ if __name__ == '__main__':
             methods   = site.routes[route]['methods'],
         )
 
-    backend_api  = Backend_Api(app, config)
+    backend_api  = Backend_Api(app, config, start_background)
     for route in backend_api.routes:
         app.add_url_rule(
             route,
@@ -24,6 +29,31 @@ if __name__ == '__main__':
             methods   = backend_api.routes[route]['methods'],
         )
 
-    print(f"Running on port {site_config['port']}")
-    app.run(**site_config)
+    return backend_api
+
+
+if __name__ == '__main__':
+    config = load_config()
+    site_config = config['site_config']
+    # "flask" runs the synchronous routes on the Flask server (compatibility
+    # mode); "asgi" serves the conversation stream asynchronously under uvicorn
+    mode = os.getenv('SERVING_MODE') or config.get('serving', {}).get('mode', 'flask')
+
+    backend_api = register_routes(config)
+
+    warm_db_pool()
+
+    print(f"Running on port {site_config['port']} ({mode})")
+    if mode == 'asgi':
+        import uvicorn
+        from server.asgi import create_asgi_app
+
+        uvicorn.run(
+            create_asgi_app(app, backend_api, config),
+            host = site_config['host'],
+            port = site_config['port'],
+            log_level = 'debug' if site_config.get('debug') else 'info',
+        )
+    else:
+        app.run(**site_config)
     print(f"Closing port {site_config['port']}")
@@ -0,0 +1,213 @@
+#Local stand-ins for the Gemini streaming API and the ddg search endpoint
+
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+from uuid import uuid4
+
+# Defaults for FakeServices; every option can be changed from the loadtest CLI.
+FAKE_DEFAULTS = {
+    # text fragments per answer and how fast they are streamed
+    'tokens': 200,
+    'token_rate': 50.0,
+    # delay before the response headers, and before the first fragment
+    'latency': 0.2,
+    'first_token_latency': 0.3,
+    # share of generations failing with 503 / answered with a 404 model error
+    'error_rate': 0.0,
+    'missing_rate': 0.0,
+    # models that always answer 404
+    'missing_models': ('gemini-missing',),
+    # search endpoint delay and results per query
+    'search_latency': 0.15,
+    'search_results': 3,
+    # answer the cachedContents (context caching) endpoints; when False
+    # they 404 like an API version without caching
+    'cache_supported': True,
+}
+
+WORDS = ('the', 'team', 'docker', 'python', 'skills', 'stream', 'latency', 'answer', 'model', 'token')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # set on the per-server subclass
+    services = None
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _send_json(self, status: int, data) -> None:
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, data: bytes) -> None:
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self) -> None:
+        services = self.services
+        path = urlparse(self.path).path
+        if path.endswith('/search'):
+            services.count('search')
+            time.sleep(services.options['search_latency'])
+            return self._send_json(200, [
+                {'snippet': f'result {i} for {self.path}', 'link': f'https://example.com/{i}'}
+                for i in range(services.options['search_results'])
+            ])
+        if path.endswith('/models'):
+            return self._send_json(200, {'models': [{'name': 'models/gemini-2.5-flash'}, {'name': 'models/gemini-2.5-pro'}]})
+        self._send_json(404, {'error': {'code': 404, 'message': 'not found'}})
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def _cache_name(self) -> str:
+        path = urlparse(self.path).path
+        return path[path.index('cachedContents/'):] if 'cachedContents/' in path else None
+
+    def do_PATCH(self) -> None:
+        body = self._read_json()
+        name = self._cache_name()
+        cache = self.services.cached_contents.get(name)
+        if cache is None or cache['expires_at'] < time.time():
+            return self._send_json(404, {'error': {'code': 404, 'message': f'{name} not found'}})
+        cache['expires_at'] = time.time() + float(body.get('ttl', '3600s').rstrip('s'))
+        self.services.count('cache_refreshed')
+        self._send_json(200, {'name': name})
+
+    def do_DELETE(self) -> None:
+        name = self._cache_name()
+        found = self.services.cached_contents.pop(name, None)
+        self.services.count('cache_deleted')
+        self._send_json(200 if found else 404, {})
+
+    def _create_cache(self, body: dict) -> None:
+        services = self.services
+        if not services.options['cache_supported']:
+            return self._send_json(404, {'error': {'code': 404, 'message': 'not found'}})
+        name = f'cachedContents/{uuid4().hex[:12]}'
+        ttl = float(body.get('ttl', '3600s').rstrip('s'))
+        services.cached_contents[name] = {'expires_at': time.time() + ttl, 'model': body.get('model')}
+        services.count('cache_created')
+        self._send_json(200, {'name': name, 'model': body.get('model')})
+
+    def do_POST(self) -> None:
+        services = self.services
+        options = services.options
+        body = self._read_json()
+        if urlparse(self.path).path.endswith('/cachedContents'):
+            return self._create_cache(body)
+
+        model = urlparse(self.path).path.rsplit('/', 1)[-1].split(':', 1)[0]
+        time.sleep(options['latency'])
+
+        if 'cachedContent' in body:
+            cache = services.cached_contents.get(body['cachedContent'])
+            if 'systemInstruction' in body:
+                return self._send_json(400, {'error': {'code': 400, 'message': 'systemInstruction not allowed with cachedContent'}})
+            if cache is None or cache['expires_at'] < time.time() or cache['model'] != f'models/{model}':
+                return self._send_json(403, {'error': {'code': 403, 'message': 'CachedContent not found (or permission denied)'}})
+            services.count('cached_generations')
+
+        if model in options['missing_models'] or random.random() < options['missing_rate']:
+            services.count('not_found')
+            return self._send_json(404, {'error': {'code': 404, 'message': f'models/{model} is not found'}})
+        if random.random() < options['error_rate']:
+            services.count('errors')
+            return self._send_json(503, {'error': {'code': 503, 'message': 'The model is overloaded'}})
+
+        services.count('generations')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        try:
+            time.sleep(options['first_token_latency'])
+            interval = 1 / options['token_rate'] if options['token_rate'] > 0 else 0
+            next_at = time.monotonic()
+            for i in range(options['tokens']):
+                text = WORDS[i % len(WORDS)] + ' '
+                event = {'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}}]}
+                self._chunk(b'data: ' + json.dumps(event).encode() + b'\r\n\r\n')
+                next_at += interval
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self._chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            # the app closed the stream early (client disconnect)
+            services.count('cancelled')
+
+
+def add_fake_arguments(parser) -> None:
+    """Command line options for every FAKE_DEFAULTS entry (except tuples)."""
+    import argparse
+
+    for key, value in FAKE_DEFAULTS.items():
+        flag = f"--{key.replace('_', '-')}"
+        if isinstance(value, bool):
+            parser.add_argument(flag, action=argparse.BooleanOptionalAction, default=value,
+                                help=f'fake upstream: {key} (default {value})')
+        elif not isinstance(value, tuple):
+            parser.add_argument(flag, type=type(value), default=value, help=f'fake upstream: {key} (default {value})')
+
+
+class FakeServices:
+    """
+    One threaded HTTP server answering both as Gemini
+    (POST .../models/<model>:streamGenerateContent?alt=sse, GET .../models,
+    .../cachedContents) and as the ddg search API (GET /search).
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, **options) -> None:
+        self.options = {**FAKE_DEFAULTS, **options}
+        self.counters = {}
+        self.cached_contents = {}   # name -> {'expires_at', 'model'}
+        self._lock = threading.Lock()
+        handler = type('Handler', (_Handler,), {'services': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def start(self) -> 'FakeServices':
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-services', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the fake Gemini and search services on their own.')
+    parser.add_argument('--port', type=int, default=8765)
+    add_fake_arguments(parser)
+    args = vars(parser.parse_args())
+    services = FakeServices(port=args.pop('port'), **args).start()
+    print(f'Fake Gemini: GEMINI_API_BASE={services.url}/v1beta  search: {services.url}/search')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        services.stop()
@@ -0,0 +1,279 @@
+#Load test: drives concurrent conversation streams against app.py backed by local fakes
+
+import argparse
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.fake_services import FAKE_DEFAULTS, FakeServices, add_fake_arguments  # noqa: E402
+from server.history import estimate_tokens  # noqa: E402
+from server.relay import SSEParser, extract_texts  # noqa: E402
+
+TEAM_SKILLS_FILE = os.path.join(ROOT, 'bench', 'team_skills.json')
+# benchmark mode -> (serving.mode, command started in the repository root)
+BENCH_MODES = {
+    'flask': ('flask', [sys.executable, 'app.py']),
+    'asgi': ('asgi', [sys.executable, 'app.py']),
+    'gunicorn': ('flask', [sys.executable, '-m', 'gunicorn']),
+    'gunicorn-asgi': ('asgi', [sys.executable, '-m', 'gunicorn']),
+}
+PROMPTS = (
+    'Who on the team knows docker and kubernetes?',
+    'Explain how python generators work.',
+    'Which teammate could mentor someone on React?',
+    'Write a short summary of the latest release notes.',
+)
+
+
+def percentile(values: list, p: float) -> float:
+    """Nearest-rank percentile; 0.0 for an empty list."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+def bench_config(base: dict, mode: str, port: int, services: FakeServices, args) -> dict:
+    config = json.loads(json.dumps(base))
+    config['site_config'] = {'host': '127.0.0.1', 'port': port, 'debug': False}
+    config['serving'] = {**config.get('serving', {}), 'mode': BENCH_MODES[mode][0]}
+    if args.workers:
+        config['serving']['workers'] = args.workers
+    config['search'] = {**config.get('search', {}), 'url': f'{services.url}/search'}
+    config['metrics'] = {**config.get('metrics', {}), 'enable': True}
+    if not args.response_cache:
+        config['response_cache'] = {**config.get('response_cache', {}), 'enable': False}
+    if args.context_cache:
+        config['context_cache'] = {**config.get('context_cache', {}), 'enable': True}
+    if not args.rate_limit:
+        # one load generator looks like a single very busy user
+        config['admission'] = {**config.get('admission', {}), 'rate': 0}
+    return config
+
+
+class AppProcess:
+    """app.py (or gunicorn) in a subprocess with its config and environment pointed at the fakes."""
+
+    def __init__(self, mode: str, config: dict, services: FakeServices, args, workdir: str) -> None:
+        self.command = BENCH_MODES[mode][1]
+        self.port = config['site_config']['port']
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.config_path = os.path.join(workdir, f'config-{mode}.json')
+        self.log_path = os.path.join(workdir, f'app-{mode}.log')
+        with open(self.config_path, 'w') as f:
+            json.dump(config, f, indent=4)
+
+        self.env = {
+            **os.environ,
+            'CONFIG_PATH': self.config_path,
+            'GEMINI_API_KEY': 'bench',
+            'GEMINI_API_BASE': f'{services.url}/v1beta',
+            'PYTHONUNBUFFERED': '1',
+        }
+        if not args.team_skills_db:
+            self.env['TEAM_SKILLS_FILE'] = TEAM_SKILLS_FILE
+            self.env['DB_POOL_MIN'] = '0'
+        self.process = None
+
+    def start(self, timeout: float = 30) -> None:
+        try:
+            requests.get(f'{self.url}/chat/', timeout=1)
+            raise RuntimeError(f'something is already listening on port {self.port}')
+        except requests.RequestException:
+            pass
+        log = open(self.log_path, 'w')
+        # own process group, so gunicorn workers are stopped with their master
+        self.process = subprocess.Popen(
+            self.command, cwd=ROOT, env=self.env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True,
+        )
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f'{self.command[-1]} exited with {self.process.returncode}, see {self.log_path}')
+            try:
+                requests.get(f'{self.url}/chat/', timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f'{self.command[-1]} did not come up within {timeout}s, see {self.log_path}')
+
+    def stop(self) -> None:
+        if self.process is None or self.process.poll() is not None:
+            return
+        os.killpg(self.process.pid, signal.SIGINT)
+        try:
+            self.process.wait(15)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+
+
+def conversation_payload(i: int, args) -> dict:
+    return {
+        'conversation_id': f'bench-{uuid4()}',
+        'action': '_ask',
+        'model': args.model,
+        'jailbreak': args.jailbreak,
+        'meta': {
+            'id': str(uuid4()),
+            'user': {'user_id': f'bench-user-{i % args.users}'},
+            'content': {
+                'conversation': [],
+                'internet_access': args.internet,
+                'content_type': 'text',
+                'parts': [{'content': f'{PROMPTS[i % len(PROMPTS)]} (#{i})', 'role': 'user'}],
+            },
+        },
+    }
+
+
+def run_one(url: str, payload: dict, session: requests.Session) -> dict:
+    result = {'status': None, 'ttft': None, 'latency': None, 'tokens': 0, 'error': None}
+    started = time.perf_counter()
+    try:
+        with session.post(f'{url}/backend-api/v2/conversation', json=payload, stream=True, timeout=120) as resp:
+            result['status'] = resp.status_code
+            parser = SSEParser()
+            text = []
+            for chunk in resp.iter_content(chunk_size=None):
+                if not chunk:
+                    continue
+                if result['ttft'] is None:
+                    result['ttft'] = time.perf_counter() - started
+                if resp.status_code == 200:
+                    for data in parser.feed(chunk.replace(b'\r\n', b'\n')):
+                        text += extract_texts(data)
+            result['tokens'] = estimate_tokens(''.join(text)) if text else 0
+    except requests.RequestException as e:
+        result['error'] = type(e).__name__
+    result['latency'] = time.perf_counter() - started
+    return result
+
+
+def scrape_phases(url: str) -> dict:
+    """Mean seconds per phase from the app's chat_phase_seconds histogram."""
+    try:
+        text = requests.get(f'{url}/metrics', timeout=5).text
+    except requests.RequestException:
+        return {}
+    sums, counts = {}, {}
+    for name, phase, value in re.findall(r'^chat_phase_seconds_(sum|count)\{phase="([^"]+)"\} (\S+)$', text, re.M):
+        (sums if name == 'sum' else counts)[phase] = float(value)
+    return {phase: sums[phase] / counts[phase] for phase in sums if counts.get(phase)}
+
+
+def run_load(url: str, args) -> dict:
+    local = threading.local()
+
+    def task(i: int) -> dict:
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            local.session.trust_env = False
+        return run_one(url, conversation_payload(i, args), local.session)
+
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(task, range(args.warmup)))
+        started = time.perf_counter()
+        results = list(pool.map(task, range(args.warmup, args.warmup + args.requests)))
+        elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r['status'] == 200 and r['error'] is None]
+    statuses = {}
+    for r in results:
+        key = str(r['status']) if r['error'] is None else r['error']
+        statuses[key] = statuses.get(key, 0) + 1
+    ttft = [r['ttft'] for r in ok if r['ttft'] is not None]
+    latency = [r['latency'] for r in ok]
+    tokens = sum(r['tokens'] for r in ok)
+    return {
+        'requests': len(results),
+        'ok': len(ok),
+        'statuses': statuses,
+        'elapsed': elapsed,
+        'throughput': len(ok) / elapsed if elapsed else 0.0,
+        'tokens_per_second': tokens / elapsed if elapsed else 0.0,
+        'ttft': {f'p{p}': percentile(ttft, p) for p in (50, 95, 99)},
+        'latency': {f'p{p}': percentile(latency, p) for p in (50, 95, 99)},
+    }
+
+
+def report(mode: str, result: dict) -> None:
+    ms = lambda seconds: f'{seconds * 1000:8.1f} ms'
+    print(f'\n== {mode} ==')
+    print(f"requests     {result['requests']} ({result['ok']} ok)  statuses {result['statuses']}")
+    print(f"elapsed      {result['elapsed']:.2f} s")
+    print(f"throughput   {result['throughput']:.2f} req/s, {result['tokens_per_second']:.0f} tokens/s")
+    for name in ('ttft', 'latency'):
+        values = result[name]
+        print(f"{name:<12} p50 {ms(values['p50'])}   p95 {ms(values['p95'])}   p99 {ms(values['p99'])}")
+    if result.get('phases'):
+        print('server phases (mean): ' + ', '.join(f'{p} {s * 1000:.1f} ms' for p, s in sorted(result['phases'].items())))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark /backend-api/v2/conversation against local fakes.')
+    parser.add_argument('--mode', default='flask', help=f"serving mode(s) to compare, e.g. flask,asgi ({', '.join(BENCH_MODES)})")
+    parser.add_argument('--workers', type=int, default=0, help='gunicorn workers (default: serving.workers)')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=8)
+    parser.add_argument('--users', type=int, default=16, help='distinct user ids the requests are spread over')
+    parser.add_argument('--model', default='gemini-2.5-flash')
+    parser.add_argument('--internet', action='store_true', help='enable web search (served by the fake)')
+    parser.add_argument('--port', type=int, default=18338)
+    parser.add_argument('--config', default=os.path.join(ROOT, 'config.json'), help='base config the bench config is derived from')
+    parser.add_argument('--response-cache', action='store_true', help='keep the response cache setting from the base config')
+    parser.add_argument('--context-cache', action='store_true', help='enable Gemini context caching of the system prompt')
+    parser.add_argument('--jailbreak', default='default', help='jailbreak prelude sent with every request')
+    parser.add_argument('--rate-limit', action='store_true', help='keep the per-user admission rate limit')
+    parser.add_argument('--team-skills-db', action='store_true', help='read team_skills from Postgres instead of bench/team_skills.json')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    add_fake_arguments(parser)
+    args = parser.parse_args(argv)
+
+    services = FakeServices(**{key: getattr(args, key) for key in FAKE_DEFAULTS if hasattr(args, key)}).start()
+    with open(args.config) as f:
+        base = json.load(f)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='chat-bench-') as workdir:
+        modes = [m.strip() for m in args.mode.split(',') if m.strip()]
+        unknown = [m for m in modes if m not in BENCH_MODES]
+        if unknown:
+            parser.error(f"unknown mode(s) {', '.join(unknown)}")
+        for mode in modes:
+            app = AppProcess(mode, bench_config(base, mode, args.port, services, args), services, args, workdir)
+            app.start()
+            try:
+                result = run_load(app.url, args)
+                result['phases'] = scrape_phases(app.url)
+            finally:
+                app.stop()
+            results[mode] = result
+            report(mode, result)
+
+    print(f'\nfake upstream: {services.counters}')
+    services.stop()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,60 @@
 // Minimal API module: streaming POST to backend conversation endpoint.
 // Exports streamConversation(payload, onChunk, signal) -> returns final accumulated text.
 
+// A dropped connection is retried this many times (with the last event id,
+// so the server continues the same answer instead of generating a new one).
+const RESUME_ATTEMPTS = 3;
+const RESUME_DELAY_MS = 1000;
+
+function sleep(ms, signal) {
+  return new Promise((resolve, reject) => {
+    const timer = setTimeout(resolve, ms);
+    if (signal) {
+      signal.addEventListener('abort', () => {
+        clearTimeout(timer);
+        reject(new DOMException('Aborted', 'AbortError'));
+      }, { once: true });
+    }
+  });
+}
+
+function candidateText(payload) {
+  let text = '';
+  for (const cand of payload.candidates) {
+    for (const part of (cand.content && cand.content.parts) || []) {
+      if (typeof part.text === 'string') text += part.text;
+    }
+  }
+  return text;
+}
+
 export async function streamConversation(payload, onChunk, signal) {
+  const state = { finalText: '', lastEventId: null };
+  for (let attempt = 0; ; attempt++) {
+    try {
+      await readStream(payload, onChunk, signal, state);
+      return state.finalText;
+    } catch (err) {
+      // only a network failure after the server handed out event ids can be resumed
+      const resumable = err.name !== 'AbortError' && !err.status && state.lastEventId;
+      if (!resumable || attempt >= RESUME_ATTEMPTS) throw err;
+      console.warn(`Stream interrupted, resuming after ${state.lastEventId}`, err);
+      await sleep(RESUME_DELAY_MS * (attempt + 1), signal);
+    }
+  }
+}
+
+async function readStream(payload, onChunk, signal, state) {
   const url = '/backend-api/v2/conversation';
+  const headers = {
+    'Content-Type': 'application/json',
+    'Accept': 'text/event-stream'
+  };
+  if (state.lastEventId) headers['Last-Event-ID'] = state.lastEventId;
 
   const res = await fetch(url, {
     method: 'POST',
-    headers: {
-      'Content-Type': 'application/json',
-      'Accept': 'text/event-stream'
-    },
+    headers,
     body: JSON.stringify(payload),
     signal
   });
@@ -17,7 +62,9 @@ export async function streamConversation(payload, onChunk, signal) {
   if (!res.ok) {
     // attempt to read response body for better error messages
     const body = await res.text().catch(() => '');
-    throw new Error(`Request failed: ${res.status} ${res.statusText}${body ? ' - ' + body : ''}`);
+    const error = new Error(`Request failed: ${res.status} ${res.statusText}${body ? ' - ' + body : ''}`);
+    error.status = res.status;
+    throw error;
   }
 
   if (!res.body) {
@@ -26,7 +73,6 @@ export async function streamConversation(payload, onChunk, signal) {
 
   const reader = res.body.getReader();
   const decoder = new TextDecoder();
-  let finalText = '';
 
   // We'll parse Server-Sent Events (SSE) framed as one or more 'data: ...' lines
   // separated by a blank line (\n\n). The server emits JSON payloads in
@@ -43,12 +89,13 @@ export async function streamConversation(payload, onChunk, signal) {
       // Basic protection: detect common HTML/CF challenge responses and convert to readable text
       if (chunk.includes('<form id="challenge-form"') || chunk.includes('<title>Attention Required</title>')) {
         const msg = 'Error: Cloudflare/edge returned an HTML challenge. Refresh the page or check the server.';
-        finalText += msg;
+        state.finalText += msg;
         try { if (typeof onChunk === 'function') onChunk(msg); } catch (e) { /* ignore */ }
         continue;
       }
 
-      buffer += chunk;
+      // upstream frames relayed in passthrough mode use CRLF line endings
+      buffer += chunk.replace(/\r\n/g, '\n');
 
       // Process complete SSE events (separated by \n\n)
       while (true) {
@@ -57,27 +104,34 @@ export async function streamConversation(payload, onChunk, signal) {
         const rawEvent = buffer.slice(0, idx);
         buffer = buffer.slice(idx + 2);
 
-        // Extract data: lines (may be multiple) and concatenate their payloads
+        // Extract data: lines (may be multiple) and concatenate their payloads;
+        // the id: line marks where a reconnect continues
         const lines = rawEvent.split(/\r?\n/);
         let dataPayload = '';
+        let eventId = null;
         for (const line of lines) {
           if (line.startsWith('data:')) {
             dataPayload += line.slice(5).trim();
+          } else if (line.startsWith('id:')) {
+            eventId = line.slice(3).trim();
           }
         }
 
         if (!dataPayload) continue;
 
         // Try parsing JSON payloads emitted by the server: {"text":"..."}
+        // or, in passthrough mode, raw Gemini chunks with candidates/parts
         let text = dataPayload;
         try {
           const parsed = JSON.parse(dataPayload);
           if (parsed && typeof parsed.text === 'string') text = parsed.text;
+          else if (parsed && Array.isArray(parsed.candidates)) text = candidateText(parsed);
         } catch (e) {
           // not JSON — keep raw payload
         }
 
-        finalText += text;
+        state.finalText += text;
+        if (eventId) state.lastEventId = eventId;
         try { if (typeof onChunk === 'function') onChunk(text); } catch (e) { /* ignore */ }
       }
     }
@@ -95,9 +149,7 @@ export async function streamConversation(payload, onChunk, signal) {
       const parsed = JSON.parse(buffer);
       if (parsed && typeof parsed.text === 'string') text = parsed.text;
     } catch (e) { /* ignore */ }
-    finalText += text;
+    state.finalText += text;
     try { if (typeof onChunk === 'function') onChunk(text); } catch (e) { /* ignore */ }
   }
-
-  return finalText;
 }
\ No newline at end of file
@@ -32,8 +32,8 @@ async function handleSend() {
   resizeTextarea(inputEl);
 
   const convId = window.conversation_id || uuid();
-  store.addConversation(convId, convId);
-  store.addMessage(convId, "user", text);
+  await store.addConversation(convId, convId);
+  await store.addMessage(convId, "user", text);
 
   const token = message_id();
   renderUserMessage(token, text);
@@ -62,7 +62,10 @@ async function handleSend() {
         ...(teamId ? { team_id: teamId } : {}),
       },
       content: {
-        conversation: (await store.getConversation(convId)).messages,
+        // when the server stores history it loads it itself; leave it out
+        ...(window.server_history
+          ? {}
+          : { conversation: (await store.getConversation(convId)).messages }),
         internet_access: document.getElementById("switch")?.checked || false,
         content_type: "text",
         parts: [{ content: text, role: "user" }],
@@ -73,6 +76,9 @@ async function handleSend() {
     alert("Join Team clicked!");
   });
 
+  // the answer is stored as it streams (in batches), so a reload keeps it
+  const answer = await store.startMessage(convId, "assistant");
+
   // If MOCK_MODE is active, simulate a streaming assistant response locally
   let acc = "";
   if (MOCK_MODE) {
@@ -89,8 +95,8 @@ async function handleSend() {
         await new Promise((r) => setTimeout(r, 120));
         acc += c;
         renderAssistantChunk(token, acc);
+        answer.update(acc);
       }
-      store.addMessage(convId, "assistant", acc);
     } catch (err) {
       if (err.name === "AbortError") {
         renderAssistantChunk(token, acc + " [aborted]");
@@ -101,6 +107,7 @@ async function handleSend() {
       }
     } finally {
       currentAbort = null;
+      await (acc ? answer.finish(acc) : answer.discard());
       // force scroll at end so user sees final content
       scrollToBottom(true);
     }
@@ -113,11 +120,10 @@ async function handleSend() {
       (chunk) => {
         acc += chunk;
         renderAssistantChunk(token, acc);
+        answer.update(acc);
       },
       currentAbort.signal
     );
-
-    store.addMessage(convId, "assistant", acc);
   } catch (err) {
     if (err.name === "AbortError") {
       renderAssistantChunk(token, acc + " [aborted]");
@@ -128,6 +134,7 @@ async function handleSend() {
     }
   } finally {
     currentAbort = null;
+    await (acc ? answer.finish(acc) : answer.discard());
     scrollToBottom();
   }
 }
@@ -208,7 +215,7 @@ export async function init() {
     newBtn.addEventListener("click", async () => {
       const id = uuid();
       window.conversation_id = id;
-      store.addConversation(id, id);
+      await store.addConversation(id, id);
       clearMessages();
       const list = await store.listConversations();
       if (listEl) renderConversationList(listEl, list, handlers);
@@ -224,7 +231,7 @@ export async function init() {
   const clearBtn = document.getElementById("clear-conversations-button");
   if (clearBtn) {
     clearBtn.addEventListener("click", async () => {
-      store.clearConversations();
+      await store.clearConversations();
       clearMessages();
       if (listEl) renderConversationList(listEl, [], handlers);
     });
@@ -1,141 +1,360 @@
-// Client-side conversation storage (localStorage fallback to in-memory).
+// Client-side conversation storage (IndexedDB, falling back to in-memory).
 // Exports: getConversation, saveConversation, addConversation, addMessage,
-//          listConversations, deleteConversation, clearConversations
-
-const PREFIX = 'conv:';
-const inMemory = new Map();
-
-function storageAvailable() {
-  try {
-    const testKey = '__storage_test__';
-    window.localStorage.setItem(testKey, testKey);
-    window.localStorage.removeItem(testKey);
-    return true;
-  } catch (e) {
-    return false;
-  }
-}
+//          startMessage, listConversations, deleteConversation, clearConversations
+//
+// Conversations and messages are separate records: appending a message
+// writes that message and its conversation's summary, never the history.
+// The sidebar list reads conversation summaries through the `updated_at`
+// index without touching messages.
 
-function key(id) {
-  return `${PREFIX}${id}`;
+const DB_NAME = 'chat';
+const DB_VERSION = 1;
+const LEGACY_PREFIX = 'conv:';
+// how often a streaming message is written while it grows
+const FLUSH_MS = 500;
+
+function request(req) {
+  return new Promise((resolve, reject) => {
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
 }
 
+function committed(tx) {
+  return new Promise((resolve, reject) => {
+    tx.oncomplete = () => resolve();
+    tx.onerror = tx.onabort = () => reject(tx.error);
+  });
+}
 
 function safeParse(raw) {
   try { return JSON.parse(raw); } catch (e) { return null; }
 }
 
-function readRaw(k) {
-  if (storageAvailable()) {
-    return localStorage.getItem(k);
+function summary(id, title, now = Date.now()) {
+  return { id, title: title || id, created_at: now, updated_at: now, next_seq: 0 };
+}
+
+// what callers see of a message record
+function publicMessage(m) {
+  return { role: m.role, content: m.content, ts: m.ts };
+}
+
+/**
+ * Copy conversations saved by the localStorage store (`conv:<id>` keys)
+ * into the new object stores, inside the upgrade transaction. Returns the
+ * keys to remove once that transaction has committed.
+ */
+function migrateLegacy(tx) {
+  const keys = [];
+  let storage;
+  try { storage = window.localStorage; } catch (e) { return keys; }
+  if (!storage) return keys;
+  const convs = tx.objectStore('conversations');
+  const messages = tx.objectStore('messages');
+  for (let i = 0; i < storage.length; i++) {
+    const k = storage.key(i);
+    if (!k || !k.startsWith(LEGACY_PREFIX)) continue;
+    keys.push(k);
+    const old = safeParse(storage.getItem(k));
+    if (!old || !old.id) continue;
+    const list = Array.isArray(old.messages) ? old.messages : [];
+    const conv = summary(old.id, old.title, old.created_at || Date.now());
+    conv.updated_at = old.updated_at || conv.created_at;
+    list.forEach((m, seq) => {
+      messages.put({
+        conversation_id: old.id,
+        seq,
+        role: m.role || 'user',
+        content: m.content == null ? '' : m.content,
+        ts: m.ts || conv.updated_at,
+      });
+    });
+    conv.next_seq = list.length;
+    convs.put(conv);
   }
-  return inMemory.get(k) ?? null;
+  return keys;
 }
 
-function writeRaw(k, v) {
-  if (storageAvailable()) {
-    localStorage.setItem(k, v);
-    return;
+let backendPromise = null;
+
+/** The IndexedDB backend, or the in-memory one where IndexedDB can't be opened. */
+function backend() {
+  if (!backendPromise) {
+    backendPromise = openDb().then(db => (db ? idbBackend(db) : memoryBackend()));
   }
-  inMemory.set(k, v);
+  return backendPromise;
+}
+
+function openDb() {
+  return new Promise((resolve) => {
+    let req;
+    try {
+      req = window.indexedDB.open(DB_NAME, DB_VERSION);
+    } catch (e) {
+      resolve(null);
+      return;
+    }
+    let legacyKeys = [];
+    req.onupgradeneeded = (e) => {
+      const db = req.result;
+      if (e.oldVersion < 1) {
+        const convs = db.createObjectStore('conversations', { keyPath: 'id' });
+        convs.createIndex('updated_at', 'updated_at');
+        db.createObjectStore('messages', { keyPath: ['conversation_id', 'seq'] });
+        legacyKeys = migrateLegacy(req.transaction);
+      }
+    };
+    req.onsuccess = () => {
+      const db = req.result;
+      // let a newer version in another tab upgrade instead of blocking it
+      db.onversionchange = () => db.close();
+      // the upgrade has committed; the old copies are no longer needed
+      legacyKeys.forEach(k => localStorage.removeItem(k));
+      resolve(db);
+    };
+    req.onerror = () => {
+      console.warn('IndexedDB unavailable, keeping conversations in memory', req.error);
+      resolve(null);
+    };
+  });
+}
+
+function idbBackend(db) {
+  const range = id => IDBKeyRange.bound([id, 0], [id, Infinity]);
+
+  return {
+    async get(id) {
+      const tx = db.transaction(['conversations', 'messages']);
+      const [conv, messages] = await Promise.all([
+        request(tx.objectStore('conversations').get(id)),
+        request(tx.objectStore('messages').getAll(range(id))),
+      ]);
+      return conv ? { ...conv, messages } : null;
+    },
+
+    async list() {
+      const tx = db.transaction('conversations');
+      const convs = await request(tx.objectStore('conversations').index('updated_at').getAll());
+      return convs.reverse();
+    },
+
+    async create(id, title) {
+      const tx = db.transaction('conversations', 'readwrite');
+      const store = tx.objectStore('conversations');
+      let conv = await request(store.get(id));
+      if (!conv) {
+        conv = summary(id, title);
+        store.put(conv);
+      }
+      await committed(tx);
+      return conv;
+    },
+
+    async append(id, message) {
+      const tx = db.transaction(['conversations', 'messages'], 'readwrite');
+      const convs = tx.objectStore('conversations');
+      const conv = (await request(convs.get(id))) || summary(id);
+      const record = { conversation_id: id, seq: conv.next_seq, ...message };
+      tx.objectStore('messages').put(record);
+      conv.next_seq += 1;
+      conv.updated_at = record.ts;
+      convs.put(conv);
+      await committed(tx);
+      return record;
+    },
+
+    async putMessage(record) {
+      const tx = db.transaction('messages', 'readwrite');
+      tx.objectStore('messages').put(record);
+      await committed(tx);
+    },
+
+    async deleteMessage(id, seq) {
+      const tx = db.transaction('messages', 'readwrite');
+      tx.objectStore('messages').delete([id, seq]);
+      await committed(tx);
+    },
+
+    async replace(conv, messages) {
+      const tx = db.transaction(['conversations', 'messages'], 'readwrite');
+      const store = tx.objectStore('messages');
+      store.delete(range(conv.id));
+      messages.forEach(m => store.put(m));
+      tx.objectStore('conversations').put(conv);
+      await committed(tx);
+    },
+
+    async remove(id) {
+      const tx = db.transaction(['conversations', 'messages'], 'readwrite');
+      tx.objectStore('conversations').delete(id);
+      tx.objectStore('messages').delete(range(id));
+      await committed(tx);
+    },
+
+    async clear() {
+      const tx = db.transaction(['conversations', 'messages'], 'readwrite');
+      tx.objectStore('conversations').clear();
+      tx.objectStore('messages').clear();
+      await committed(tx);
+    },
+  };
+}
+
+function memoryBackend() {
+  const convs = new Map();
+  const messages = new Map();   // conversation id -> Map(seq -> record)
+  const ordered = id => Array.from((messages.get(id) || new Map()).values()).sort((a, b) => a.seq - b.seq);
+
+  return {
+    async get(id) {
+      const conv = convs.get(id);
+      return conv ? { ...conv, messages: ordered(id) } : null;
+    },
+    async list() {
+      return Array.from(convs.values(), c => ({ ...c })).sort((a, b) => b.updated_at - a.updated_at);
+    },
+    async create(id, title) {
+      if (!convs.has(id)) convs.set(id, summary(id, title));
+      return { ...convs.get(id) };
+    },
+    async append(id, message) {
+      if (!convs.has(id)) convs.set(id, summary(id));
+      const conv = convs.get(id);
+      const record = { conversation_id: id, seq: conv.next_seq, ...message };
+      if (!messages.has(id)) messages.set(id, new Map());
+      messages.get(id).set(record.seq, record);
+      conv.next_seq += 1;
+      conv.updated_at = record.ts;
+      return record;
+    },
+    async putMessage(record) {
+      const list = messages.get(record.conversation_id);
+      if (list) list.set(record.seq, { ...record });
+    },
+    async deleteMessage(id, seq) {
+      const list = messages.get(id);
+      if (list) list.delete(seq);
+    },
+    async replace(conv, list) {
+      convs.set(conv.id, { ...conv });
+      messages.set(conv.id, new Map(list.map(m => [m.seq, m])));
+    },
+    async remove(id) {
+      convs.delete(id);
+      messages.delete(id);
+    },
+    async clear() {
+      convs.clear();
+      messages.clear();
+    },
+  };
 }
 
 /**
  * Get conversation object by id.
  * Returns { id, title, messages: [] } or a fresh skeleton if missing.
  */
-export function getConversation(id) {
+export async function getConversation(id) {
   if (!id) return { id: null, title: null, messages: [] };
-  const raw = readRaw(key(id));
-  let conv = safeParse(raw);
-  if (!conv) {
-    // return skeleton when there is no stored conversation in the new format
-    return { id, title: id, messages: [] };
-  }
-  // expected new-format shape: messages is an array
-  conv.messages = Array.isArray(conv.messages) ? conv.messages : [];
-  return { id: conv.id || id, title: conv.title || id, messages: conv.messages };
+  const conv = await (await backend()).get(id);
+  if (!conv) return { id, title: id, messages: [] };
+  return { id: conv.id, title: conv.title || id, messages: conv.messages.map(publicMessage) };
 }
 
-/** Persist a full conversation object */
-export function saveConversation(conv) {
+/** Persist a full conversation object, replacing its stored messages */
+export async function saveConversation(conv) {
   if (!conv || !conv.id) throw new Error('Conversation must have an id');
-  const out = {
-    id: conv.id,
-    title: conv.title || conv.id,
-    messages: Array.isArray(conv.messages) ? conv.messages : [],
-    created_at: conv.created_at || Date.now(),
-    updated_at: Date.now(),
-  };
-  writeRaw(key(conv.id), JSON.stringify(out));
+  const now = Date.now();
+  const list = Array.isArray(conv.messages) ? conv.messages : [];
+  const out = summary(conv.id, conv.title, conv.created_at || now);
+  out.updated_at = now;
+  out.next_seq = list.length;
+  const records = list.map((m, seq) => ({
+    conversation_id: conv.id,
+    seq,
+    role: m.role || 'user',
+    content: m.content == null ? '' : m.content,
+    ts: m.ts || now,
+  }));
+  await (await backend()).replace(out, records);
 }
 
 /** Create a conversation if missing */
-export function addConversation(id, title = null) {
+export async function addConversation(id, title = null) {
   if (!id) throw new Error('id required');
-  const existing = getConversation(id);
-  if (existing && existing.messages && existing.messages.length) return existing;
-  const conv = { id, title: title || id, messages: [], created_at: Date.now(), updated_at: Date.now() };
-  saveConversation(conv);
-  return conv;
+  const conv = await (await backend()).create(id, title);
+  return { id: conv.id, title: conv.title, messages: [] };
 }
 
 /** Append a message to a conversation and persist it.
  * message: role: 'user'|'assistant'|'system', content: string
  */
-export function addMessage(id, role, content) {
+export async function addMessage(id, role, content) {
   if (!id) throw new Error('Conversation id required');
-  const conv = getConversation(id);
-  const msg = { role: role || 'user', content: (content == null ? '' : content), ts: Date.now() };
-  conv.messages.push(msg);
-  saveConversation(conv);
-  return msg;
-}
-
-/** List all stored conversations (returns array of conversation objects) */
-export function listConversations() {
-  const out = [];
-  if (storageAvailable()) {
-    for (let i = 0; i < localStorage.length; i++) {
-      const k = localStorage.key(i);
-      if (!k || !k.startsWith(PREFIX)) continue;
-      const conv = safeParse(localStorage.getItem(k));
-      if (conv && conv.id) out.push(conv);
-    }
-  } else {
-    for (const [k, v] of inMemory.entries()) {
-      if (!k.startsWith(PREFIX)) continue;
-      const conv = safeParse(v);
-      if (conv && conv.id) out.push(conv);
-    }
-  }
-  out.sort((a, b) => (b.updated_at || 0) - (a.updated_at || 0));
-  return out;
+  const record = await (await backend()).append(id, {
+    role: role || 'user',
+    content: content == null ? '' : content,
+    ts: Date.now(),
+  });
+  return publicMessage(record);
+}
+
+/**
+ * Append a message whose content is still arriving (a streamed answer).
+ * update(content) may be called on every chunk; the record is rewritten
+ * at most once per FLUSH_MS, so a reload mid-stream keeps what had been
+ * received. finish(content) writes the final text, discard() drops the
+ * message (e.g. when nothing arrived).
+ */
+export async function startMessage(id, role = 'assistant') {
+  if (!id) throw new Error('Conversation id required');
+  const store = await backend();
+  const record = await store.append(id, { role, content: '', ts: Date.now() });
+  let latest = '';
+  let timer = null;
+  let writing = Promise.resolve();
+
+  const flush = () => {
+    timer = null;
+    const snapshot = { ...record, content: latest };
+    writing = writing.then(() => store.putMessage(snapshot)).catch(console.error);
+    return writing;
+  };
+
+  return {
+    update(content) {
+      latest = content == null ? '' : content;
+      if (!timer) timer = setTimeout(flush, FLUSH_MS);
+    },
+    async finish(content) {
+      if (content != null) latest = content;
+      clearTimeout(timer);
+      await flush();
+    },
+    async discard() {
+      clearTimeout(timer);
+      timer = null;
+      await writing;
+      await store.deleteMessage(id, record.seq);
+    },
+  };
+}
+
+/** List stored conversations, most recently updated first (summaries, without messages) */
+export async function listConversations() {
+  return (await backend()).list();
 }
 
 /** Delete single conversation */
-export function deleteConversation(id) {
+export async function deleteConversation(id) {
   if (!id) return false;
-  if (storageAvailable()) localStorage.removeItem(key(id));
-  else inMemory.delete(key(id));
+  await (await backend()).remove(id);
   return true;
 }
 
-/** Remove all conversations stored under the prefix */
-export function clearConversations() {
-  if (storageAvailable()) {
-    const toRemove = [];
-    for (let i = 0; i < localStorage.length; i++) {
-      const k = localStorage.key(i);
-      if (k && k.startsWith(PREFIX)) toRemove.push(k);
-    }
-    toRemove.forEach(k => localStorage.removeItem(k));
-  } else {
-    for (const k of Array.from(inMemory.keys())) {
-      if (k.startsWith(PREFIX)) inMemory.delete(k);
-    }
-  }
+/** Remove all stored conversations */
+export async function clearConversations() {
+  await (await backend()).clear();
   return true;
 }
-
-// Legacy migration removed: this store only supports the new `conv:` format.
@@ -0,0 +1,61 @@
+# gunicorn settings for production serving, read from the "serving" and
+# "site_config" blocks of config.json (or CONFIG_PATH). Start with:
+#
+#     gunicorn
+#
+# `kill -HUP <master>` replaces the workers gracefully: old workers stop
+# accepting connections and get `graceful_timeout` seconds to finish the
+# streams they are serving.
+
+import os
+from json import load
+from multiprocessing import cpu_count
+
+SERVING_DEFAULTS = {
+    'mode': 'flask',
+    # 0 means one worker per CPU
+    'workers': 0,
+    # threads per worker in flask mode; each open stream holds one
+    'threads': 32,
+    # seconds in-flight streams get to finish on reload or shutdown
+    'graceful_timeout': 120,
+    'timeout': 60,
+    'keepalive': 5,
+    # recycle workers after this many requests (0 = never)
+    'max_requests': 0,
+    # load the app once in the master and fork workers from it
+    'preload': True,
+}
+
+with open(os.getenv('CONFIG_PATH') or 'config.json', 'r') as f:
+    _config = load(f)
+_serving = {**SERVING_DEFAULTS, **_config.get('serving', {})}
+_site = _config['site_config']
+_mode = os.getenv('SERVING_MODE') or _serving['mode']
+
+wsgi_app = 'wsgi:application'
+bind = f"{_site['host']}:{_site['port']}"
+workers = int(os.getenv('WEB_CONCURRENCY') or _serving['workers'] or cpu_count())
+if _mode == 'asgi':
+    worker_class = 'uvicorn_worker.UvicornWorker'
+else:
+    worker_class = 'gthread'
+    threads = _serving['threads']
+preload_app = _serving['preload']
+graceful_timeout = _serving['graceful_timeout']
+timeout = _serving['timeout']
+keepalive = _serving['keepalive']
+max_requests = _serving['max_requests']
+max_requests_jitter = max_requests // 10
+
+
+def post_fork(server, worker):
+    import wsgi
+
+    wsgi.init_worker()
+
+
+def worker_exit(server, worker):
+    import wsgi
+
+    wsgi.shutdown_worker()
@@ -25,5 +25,5 @@ COPY . .
 
 ENV PATH=/root/.local/bin:$PATH
 
-CMD ["python3", "./run.py"]
+CMD ["gunicorn"]
 EOF
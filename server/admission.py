@@ -0,0 +1,227 @@
+#Admission control for upstream generations: concurrency cap, per-client rate and fair queueing
+
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from math import ceil
+from time import monotonic
+
+# Defaults for the optional "admission" block of config.json.
+ADMISSION_DEFAULTS = {
+    'enable': True,
+    # upstream generations open at once in this process
+    'max_concurrent': 64,
+    # requests allowed to wait for a slot, and for how long (seconds)
+    'max_queue': 256,
+    'max_wait': 15,
+    # per-client token bucket: sustained requests/second and burst size
+    'rate': 1.0,
+    'burst': 10,
+    # client buckets kept before refilled ones are pruned
+    'max_clients': 10000,
+}
+
+
+class AdmissionRejected(Exception):
+    """Raised instead of admitting a request. `status` is 429 or 503."""
+
+    def __init__(self, status: int, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.status = status
+        self.retry_after = max(1, ceil(retry_after))
+
+
+class Ticket:
+    """An admitted request's upstream slot. release() is idempotent."""
+
+    def __init__(self, controller, queued_for: float = 0.0) -> None:
+        self._controller = controller
+        # taken by the first release(); the disconnect monitor, the response's
+        # close and the producer can all release the same ticket at once
+        self._released = threading.Lock()
+        self.queued_for = queued_for
+
+    def release(self) -> None:
+        if self._released.acquire(blocking=False):
+            self._controller._release()
+
+
+class _Waiter:
+    def __init__(self, client: str, wake) -> None:
+        self.client = client
+        self.wake = wake
+        self.granted = False
+        self.cancelled = False
+
+
+class AdmissionController:
+    """
+    Bounds concurrent upstream generations.
+
+    A request first takes a token from its client's bucket (429 when empty),
+    then either gets one of `max_concurrent` slots or waits in a bounded
+    queue (503 when the queue is full). Waiting requests are granted slots
+    round-robin across clients, so one busy client can't starve the rest,
+    and give up with 503 after `max_wait` seconds. Rejections carry a
+    Retry-After estimate.
+    """
+
+    def __init__(self, max_concurrent: int = 64, max_queue: int = 256, max_wait: float = 15,
+                 rate: float = 1.0, burst: int = 10, max_clients: int = 10000) -> None:
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+
+        self._lock = threading.Lock()
+        self._active = 0
+        self._queued = 0
+        self._queues = OrderedDict()   # client -> deque of _Waiter, in round-robin order
+        self._buckets = {}             # client -> (tokens, updated_at)
+
+        self.admitted = 0
+        self.rejected_rate = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.wait_seconds = 0.0
+
+    def _take_token(self, client: str, now: float) -> None:
+        if self.rate <= 0:
+            return
+        tokens, updated = self._buckets.get(client, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self._buckets[client] = (tokens, now)
+            self.rejected_rate += 1
+            raise AdmissionRejected(429, 'Too many requests, slow down', (1 - tokens) / self.rate)
+        self._buckets[client] = (tokens - 1, now)
+
+        if len(self._buckets) > self.max_clients:
+            # forget clients whose bucket has refilled completely
+            full_after = self.burst / self.rate
+            self._buckets = {c: b for c, b in self._buckets.items() if now - b[1] < full_after}
+
+    def _admit_or_enqueue(self, client: str, wake, rate_limited: bool = True):
+        """Returns None when admitted right away, otherwise the queued _Waiter."""
+        now = monotonic()
+        with self._lock:
+            if rate_limited:
+                self._take_token(client, now)
+            if self._active < self.max_concurrent and not self._queued:
+                self._active += 1
+                self.admitted += 1
+                return None
+            if self._queued >= self.max_queue:
+                self.rejected_full += 1
+                raise AdmissionRejected(503, 'Server is busy, try again shortly', self.max_wait / 2)
+            waiter = _Waiter(client, wake)
+            self._queues.setdefault(client, deque()).append(waiter)
+            self._queued += 1
+            return waiter
+
+    def _grant_next(self) -> None:
+        # caller holds the lock and has a free slot to hand out
+        while self._queues:
+            client, queue = self._queues.popitem(last=False)
+            waiter = queue.popleft()
+            if queue:
+                # back of the line for this client's next waiter
+                self._queues[client] = queue
+            self._queued -= 1
+            if waiter.cancelled:
+                continue
+            waiter.granted = True
+            self._active += 1
+            self.admitted += 1
+            waiter.wake()
+            return
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """Timeout path: True if the waiter was granted meanwhile and now owns a slot."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiter.cancelled = True
+            queue = self._queues.get(waiter.client)
+            if queue is not None and waiter in queue:
+                queue.remove(waiter)
+                self._queued -= 1
+                if not queue:
+                    del self._queues[waiter.client]
+            self.rejected_timeout += 1
+            return False
+
+    def _release(self) -> None:
+        with self._lock:
+            self._active -= 1
+            if self._active < self.max_concurrent:
+                self._grant_next()
+
+    def acquire(self, client: str, max_wait: float = None, rate_limited: bool = True) -> Ticket:
+        """
+        Wait for a slot. `rate_limited=False` skips the client's token bucket,
+        for callers that pace themselves (batch jobs); they still queue fairly.
+        """
+        # a request's deadline may allow less than max_wait
+        max_wait = self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+        event = threading.Event()
+        started = monotonic()
+        waiter = self._admit_or_enqueue(client, event.set, rate_limited)
+        if waiter is None:
+            return Ticket(self)
+
+        if not event.wait(max_wait) and not self._abandon(waiter):
+            raise AdmissionRejected(503, f'Request waited {max_wait:.1f}s for capacity', self.max_wait / 2)
+        queued_for = monotonic() - started
+        self.wait_seconds += queued_for
+        return Ticket(self, queued_for)
+
+    async def aacquire(self, client: str, max_wait: float = None) -> Ticket:
+        max_wait = self.max_wait if max_wait is None else min(max_wait, self.max_wait)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(None))
+
+        started = monotonic()
+        waiter = self._admit_or_enqueue(client, wake)
+        if waiter is None:
+            return Ticket(self)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max_wait)
+        except asyncio.TimeoutError:
+            if not self._abandon(waiter):
+                raise AdmissionRejected(503, f'Request waited {max_wait:.1f}s for capacity', self.max_wait / 2)
+        except asyncio.CancelledError:
+            # client went away while queued; give back a slot granted meanwhile
+            if self._abandon(waiter):
+                self._release()
+            raise
+        queued_for = monotonic() - started
+        self.wait_seconds += queued_for
+        return Ticket(self, queued_for)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'active': self._active,
+                'queued': self._queued,
+                'max_concurrent': self.max_concurrent,
+                'admitted': self.admitted,
+                'rejected_rate': self.rejected_rate,
+                'rejected_full': self.rejected_full,
+                'rejected_timeout': self.rejected_timeout,
+                'wait_seconds': self.wait_seconds,
+            }
+
+
+def create_admission_controller(options: dict):
+    """Build the configured admission controller, or None when it is disabled."""
+    options = {**ADMISSION_DEFAULTS, **options}
+    if not options.pop('enable'):
+        return None
+    return AdmissionController(**options)
@@ -0,0 +1,565 @@
+#ASGI entry point: async conversation streaming, everything else served by Flask
+
+import asyncio
+from json import dumps, loads
+from math import inf
+from urllib.parse import parse_qs
+from time import monotonic
+
+import httpx
+from a2wsgi import WSGIMiddleware
+
+from server.admission import AdmissionRejected
+from server.backend import (search_context, sse_event, request_fingerprint, admission_key, rejection_body,
+                            deadline_body, resume_expired_body, provider_label)
+from server.cancellation import CANCELLATIONS, DeadlineExceeded
+from server.resume import StreamGone, event_frame, parse_event_id
+from server.single_flight import coalesce_key
+from server.upstream import UPSTREAM_DEFAULTS
+from server.database import ModelConfig
+from server.history import estimate_tokens
+from server.metrics import RequestTimer
+
+
+def _proxy_url(address: str) -> str:
+    # config.json stores proxies as "host:port"
+    return address if '://' in address else f'http://{address}'
+
+
+class AsyncBackend:
+    """
+    Async twin of Backend_Api._conversation. Prompt building is shared with
+    the Flask route through the Backend_Api instance; upstream search and
+    Gemini streaming run on one httpx.AsyncClient, so an open stream costs a
+    coroutine instead of a worker thread.
+    """
+
+    def __init__(self, backend_api, config: dict) -> None:
+        self.backend = backend_api
+        options = {**UPSTREAM_DEFAULTS, **config.get('upstream', {})}
+        limits = httpx.Limits(
+            max_connections=None,
+            max_keepalive_connections=options['pool_maxsize'],
+        )
+
+        proxy = config.get('proxy', {})
+        mounts = None
+        if proxy.get('enable'):
+            mounts = {
+                'http://': httpx.AsyncHTTPTransport(proxy=_proxy_url(proxy['http']), limits=limits, retries=options['retries']),
+                'https://': httpx.AsyncHTTPTransport(proxy=_proxy_url(proxy['https']), limits=limits, retries=options['retries']),
+            }
+
+        self.client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(limits=limits, retries=options['retries']),
+            mounts=mounts,
+            timeout=httpx.Timeout(60, connect=10),
+            trust_env=False,
+        )
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def _team_skills(self, build, payload: dict):
+        # the team skills prompt only touches the database while its cache is
+        # cold (or, reading the directory tables, for each new selection);
+        # keep that blocking work off the event loop
+        if self.backend.team_skills.blocking:
+            return await asyncio.to_thread(build, payload)
+        if not self.backend.team_skills.loaded:
+            await asyncio.to_thread(self.backend.team_skills.get)
+        return build(payload)
+
+    async def _call(self, cache, fn, *args):
+        # database-backed caches would block the event loop
+        if cache.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    async def _open_stream(self, url: str, headers: dict, body: dict, deadline) -> httpx.Response:
+        budget = deadline.budget('upstream_connect', deadline.connect)
+        req = self.client.build_request('POST', url, headers=headers, json=body,
+                                        timeout=httpx.Timeout(budget, connect=min(10, budget)))
+        return await self.client.send(req, stream=True)
+
+    async def _open_gemini(self, model: str, url: str, headers: dict, body: dict, static_contents: int,
+                           deadline) -> tuple:
+        """_open_upstream() on httpx: (streaming response, model serving it)."""
+        fallback_model = self.backend.fallback_model
+        served_model = model
+        send_body, context_key = self.backend._context_body(model, body, static_contents)
+        gpt_resp = await self._open_stream(url, headers, send_body, deadline)
+
+        # the cached prefix expired or was deleted upstream; send it inline
+        if context_key is not None and gpt_resp.status_code in (400, 403, 404):
+            err = await _error_body(gpt_resp)
+            print(f'Gemini rejected cached content ({gpt_resp.status_code}), retrying inline: {err}')
+            self.backend.context_cache.invalidate(context_key)
+            gpt_resp = await self._open_stream(url, headers, body, deadline)
+
+        # If we got a 404 (model not found) and the model isn't already
+        # the fallback, retry once with the fallback model.
+        if gpt_resp.status_code == 404 and model != fallback_model:
+            err = await _error_body(gpt_resp)
+            print(f"Gemini model {model} not found (404). Retrying with fallback {fallback_model}: {err}")
+            self.backend.models.mark_missing(model)
+            served_model = fallback_model
+            gpt_resp = await self._open_stream(ModelConfig.build_gemini_url(fallback_model), headers, body, deadline)
+        return gpt_resp, served_model
+
+    async def _open(self, model: str, url: str, headers: dict, body: dict, conversation: list, payload: dict,
+                    deadline) -> tuple:
+        """Backend_Api._open() on httpx: (stream, served model, route or None)."""
+        static_contents = self.backend._static_contents(payload, conversation)
+        router = self.backend.router
+        if router is None:
+            return (*await self._open_gemini(model, url, headers, body, static_contents, deadline), None)
+
+        async def opener(route) -> tuple:
+            if route.kind == 'gemini':
+                route_url = url if route.model == model else ModelConfig.build_gemini_url(route.model)
+                return await self._open_gemini(route.model, route_url, headers, body, static_contents, deadline)
+            openai_url, openai_headers, openai_body = self.backend._openai_request(route, conversation, payload)
+            return await self._open_stream(openai_url, openai_headers, openai_body, deadline), route.model
+
+        return await router.aopen(model, opener, deadline.budget('upstream_connect', deadline.connect))
+
+    def _produce(self, record, payload: dict, gpt_resp: httpx.Response, model: str, cache_key: str, ticket,
+                 timer: RequestTimer, deadline, fragments: list) -> None:
+        """
+        Read the upstream stream into `record` in a task of its own, so the
+        generation outlives a dropped client connection and a reconnect can
+        pick it up. Readers follow it through _tail().
+        """
+        loop = asyncio.get_running_loop()
+        cache = self.backend.response_cache
+
+        async def run() -> None:
+            outcome = 'disconnected'
+            try:
+                async for frame in self.backend.relay.aframes(gpt_resp.aiter_bytes(), fragments):
+                    timer.first_frame()
+                    record.append(frame)
+                outcome = 'ok'
+                # only complete generations are cached
+                if cache_key is not None:
+                    await self._call(cache, self.backend._store_response, cache_key, model, ''.join(fragments))
+            except asyncio.CancelledError:
+                outcome = 'deadline' if record.cancel_reason == 'deadline' else 'disconnected'
+            except Exception as e:
+                outcome = 'stream_error'
+                print('Gemini stream error:', e)
+            finally:
+                # hand the keep-alive connection back to the pool
+                await gpt_resp.aclose()
+                text = ''.join(fragments or ())
+                record.finish(text if fragments is not None else None)
+                if ticket is not None:
+                    ticket.release()
+                timer.finish(outcome, estimate_tokens(text) if text else 0)
+                self.backend._record_answer(payload, text)
+
+        task = asyncio.ensure_future(run())
+        record.producer = task
+        # _detached() calls this from a timer thread
+        record.cancel = lambda: loop.call_soon_threadsafe(task.cancel)
+        record.start()
+
+        remaining = deadline.remaining()
+        if remaining != inf:
+            def expire() -> None:
+                record.cancel_reason = 'deadline'
+                CANCELLATIONS.inc(reason='deadline')
+                task.cancel()
+            handle = loop.call_later(remaining, expire)
+            task.add_done_callback(lambda _: handle.cancel())
+
+    async def _tail(self, record, after: int, send, watcher: asyncio.Future) -> None:
+        """
+        Stream the frames of `record` after seq `after`, following the
+        generation until it is done or the client goes away (`watcher`
+        finishes). Frames carry their SSE event id only when resume is on.
+        """
+        record.attach()
+        resumable = self.backend.resume is not None
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/event-stream; charset=utf-8')],
+            })
+            while True:
+                read = asyncio.ensure_future(record.aread(after, 1.0))
+                await asyncio.wait({read, watcher}, return_when=asyncio.FIRST_COMPLETED)
+                if not read.done():
+                    read.cancel()
+                    return
+                frames, done = read.result()
+                if frames:
+                    after = frames[-1][0]
+                    body = b''.join(event_frame(record.stream_id, seq, frame) if resumable else frame
+                                    for seq, frame in frames)
+                    await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+                if done:
+                    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+                    return
+        except StreamGone as e:
+            print(f'Stream reader fell behind: {e}')
+        except Exception as e:
+            print('Stream relay error:', e)
+        finally:
+            watcher.cancel()
+            if record.detach():
+                self.backend._detached(record)
+
+    async def _resume(self, payload: dict, last_event_id: str, timer: RequestTimer, send, watcher) -> None:
+        """Replay what a reconnecting client missed and follow the generation, instead of generating again."""
+        resume = self.backend.resume
+        event = parse_event_id(last_event_id)
+        record = await self._call(resume, resume.get, payload.get('conversation_id'), event[0]) if event else None
+        if record is not None:
+            try:
+                await self._call(resume, record.frames_after, event[1])
+            except StreamGone:
+                record = None
+        if record is None:
+            watcher.cancel()
+            timer.finish('resume_expired')
+            return await _send_json(send, resume_expired_body(), 410)
+        timer.finish('resumed')
+        await self._tail(record, event[1], send, watcher)
+
+    async def conversation(self, scope, receive, send) -> None:
+        disconnected = asyncio.Event()
+
+        async def read_body() -> bytes:
+            chunks = []
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    disconnected.set()
+                    break
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            return b''.join(chunks)
+
+        async def watch_disconnect() -> None:
+            while not disconnected.is_set():
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    disconnected.set()
+
+        timer = RequestTimer(log=self.backend.metrics['log_timings'])
+        deadline = self.backend._deadline()
+        ticket = None
+        record = None
+        watcher = None
+        streaming = False
+        try:
+            payload = loads(await read_body())
+            # from here on a disconnect is noticed while we wait on anything
+            watcher = asyncio.ensure_future(watch_disconnect())
+
+            # a client that lost the connection mid-answer picks the stream up again
+            last_event_id = _header(scope, b'last-event-id')
+            if last_event_id and self.backend.resume is not None:
+                return await self._resume(payload, last_event_id, timer, send, watcher)
+            internet_access = payload['meta']['content']['internet_access']
+            prompt = payload['meta']['content']['parts'][0]
+
+            # run the web search concurrently with prompt building
+            search = None
+            search_started = monotonic()
+            if internet_access:
+                search = asyncio.ensure_future(self.backend.search.asearch(
+                    self.client, prompt['content'], deadline.budget('search', self.backend.search.timeout)))
+
+            # database work below is bounded by the deadline's db budget
+            # (to_thread carries the active deadline into the thread)
+            with deadline.activate():
+                if self.backend.conversations is not None:
+                    with timer.phase('history_load'):
+                        await asyncio.to_thread(self.backend._load_history, payload)
+                with timer.phase('prompt_build'):
+                    system_message = await self._team_skills(self.backend._system_message, payload)
+                    selection = await self._team_skills(self.backend._skills_selection, payload)
+
+            extra = []
+            if search is not None:
+                extra = search_context(await search)
+                timer.record('search', monotonic() - search_started)
+
+            with timer.phase('prompt_build'):
+                if self.backend.history.mode == 'summarize':
+                    # summarizing pushed-out turns is a blocking upstream call
+                    conversation = await asyncio.to_thread(self.backend._build_conversation, payload, system_message, extra, selection)
+                else:
+                    conversation = self.backend._build_conversation(payload, system_message, extra, selection)
+
+            if not self.backend.gemini_key and self.backend.router is None:
+                timer.finish('error')
+                return await _send_json(send, {
+                    '_action': '_ask',
+                    'success': False,
+                    "error": "No Gemini key configured and no router provider is available."
+                }, 400)
+
+            with timer.phase('prompt_build'):
+                model, url, headers, body = self.backend._gemini_request(payload, conversation)
+
+            cache = self.backend.response_cache
+            cache_key = None
+            if cache is not None:
+                cache_key = request_fingerprint(model, body)
+                with deadline.activate():
+                    cached = await self._call(cache, self.backend._cached_response, cache_key)
+                if cached is not None:
+                    self.backend._record_answer(payload, cached)
+                    timer.finish('cache_hit')
+                    return await _send_sse(send, [sse_event(cached).encode()])
+
+            # the same request already in flight: follow its generation (no
+            # admission slot, no upstream call) unless it fails
+            coalescer = self.backend.coalescer
+            if coalescer is not None:
+                shared, leader = coalescer.acquire(coalesce_key(model, body),
+                                                   lambda: self.backend._new_record(payload))
+                if leader:
+                    record = shared
+                else:
+                    with timer.phase('coalesce_wait'):
+                        started = await shared.await_started(deadline.budget('coalesce_wait', coalescer.wait))
+                    if started:
+                        self.backend._follow(shared, payload)
+                        timer.finish('coalesced')
+                        streaming = True
+                        return await self._tail(shared, 0, send, watcher)
+                    coalescer.fallbacks += 1
+
+            # wait for an upstream slot, held until the stream is closed
+            admission = self.backend.admission
+            if admission is not None:
+                ticket = await admission.aacquire(admission_key(payload),
+                                                  deadline.budget('admission_wait', admission.max_wait))
+                timer.record('admission_wait', ticket.queued_for)
+
+            # the client may have given up while queued
+            if disconnected.is_set():
+                if ticket is not None:
+                    ticket.release()
+                timer.finish('disconnected')
+                return
+
+            with timer.phase('upstream_connect'):
+                gpt_resp, served_model, route = await self._open(model, url, headers, body, conversation,
+                                                                 payload, deadline)
+
+            if gpt_resp.status_code >= 400:
+                err = await _error_body(gpt_resp)
+                if ticket is not None:
+                    ticket.release()
+                timer.finish('upstream_error')
+                return await _send_json(send, {
+                    'successs': False,
+                    'message': f'{provider_label(route)} request failed: {gpt_resp.status_code} {err}'
+                }, gpt_resp.status_code)
+
+            if route is None or route.kind == 'gemini':
+                self.backend.models.mark_available(served_model)
+            streaming = True
+
+        except AdmissionRejected as e:
+            timer.finish('rejected')
+            return await _send_json(send, rejection_body(e), e.status, [(b'retry-after', str(e.retry_after).encode())])
+
+        except DeadlineExceeded as e:
+            if ticket is not None:
+                ticket.release()
+            timer.finish('deadline')
+            return await _send_json(send, deadline_body(e), e.status)
+
+        except asyncio.CancelledError:
+            if ticket is not None:
+                ticket.release()
+            timer.finish('disconnected')
+            raise
+
+        except Exception as e:
+            if ticket is not None:
+                ticket.release()
+            timer.finish('error')
+            print(e)
+            print(e.__traceback__.tb_next)
+            return await _send_json(send, {
+                '_action': '_ask',
+                'success': False,
+                "error": f"an error occurred {str(e)}"}, 400)
+
+        finally:
+            if watcher is not None and not streaming:
+                watcher.cancel()
+            if record is not None and not streaming:
+                # followers waiting on it generate themselves
+                record.fail()
+
+        # the answer text is only assembled when something keeps it (or
+        # counts its tokens)
+        keep_text = cache is not None or self.backend.conversations is not None or self.backend.metrics['enable']
+        fragments = [] if keep_text else None
+
+        if record is None and self.backend.resume is not None:
+            record = self.backend.resume.begin(payload.get('conversation_id'))
+        if record is not None:
+            self._produce(record, payload, gpt_resp, model, cache_key, ticket, timer, deadline, fragments)
+            return await self._tail(record, 0, send, watcher)
+
+        outcome = 'disconnected'
+        started = False
+
+        async def pump() -> None:
+            nonlocal outcome, started
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [(b'content-type', b'text/event-stream; charset=utf-8')],
+            })
+            started = True
+            async for frame in self.backend.relay.aframes(gpt_resp.aiter_bytes(), fragments):
+                timer.first_frame()
+                await send({'type': 'http.response.body', 'body': frame, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            outcome = 'ok'
+            # only complete generations are cached
+            if cache_key is not None:
+                await self._call(cache, self.backend._store_response, cache_key, model, ''.join(fragments))
+
+        # stop reading upstream the moment the client leaves or the deadline
+        # passes, not when the next frame arrives
+        pumping = asyncio.ensure_future(pump())
+        try:
+            remaining = deadline.remaining()
+            await asyncio.wait({pumping, watcher}, timeout=remaining if remaining != inf else None,
+                               return_when=asyncio.FIRST_COMPLETED)
+            if pumping.done():
+                pumping.result()
+            else:
+                reason = 'disconnect' if disconnected.is_set() else 'deadline'
+                CANCELLATIONS.inc(reason=reason)
+                outcome = 'disconnected' if reason == 'disconnect' else 'deadline'
+                pumping.cancel()
+                await asyncio.wait({pumping})
+                if reason == 'deadline' and started:
+                    # end the truncated answer cleanly
+                    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        except Exception as e:
+            if not disconnected.is_set():
+                outcome = 'stream_error'
+                print('Gemini stream error:', e)
+        finally:
+            watcher.cancel()
+            pumping.cancel()
+            # hand the keep-alive connection back to the pool
+            await gpt_resp.aclose()
+            if ticket is not None:
+                ticket.release()
+            text = ''.join(fragments or ())
+            timer.finish(outcome, estimate_tokens(text) if text else 0)
+            # keep whatever was generated, even if the client left early
+            self.backend._record_answer(payload, text)
+
+
+def _header(scope, name: bytes):
+    for key, value in scope.get('headers', ()):
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
+
+
+async def _error_body(resp: httpx.Response):
+    await resp.aread()
+    await resp.aclose()
+    try:
+        return resp.json()
+    except Exception:
+        return resp.text
+
+
+async def _send_sse(send, frames: list) -> None:
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream; charset=utf-8')],
+    })
+    await send({'type': 'http.response.body', 'body': b''.join(frames)})
+
+
+async def _send_json(send, data: dict, status: int, headers: list = ()) -> None:
+    body = dumps(data).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()), *headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def serve_asset(assets, scope, send) -> bool:
+    """Answer GET/HEAD /assets/<folder>/<file> from the asset store. False if not an asset URL."""
+    parts = scope['path'].split('/')
+    if len(parts) != 4:
+        return False
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope.get('headers', ())}
+    version = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('v', [None])[0]
+    found = assets.respond(
+        parts[2], parts[3],
+        version = version,
+        if_none_match = headers.get('if-none-match'),
+        accept_encoding = headers.get('accept-encoding'),
+    )
+    if found is None:
+        return False
+    status, response_headers, body = found
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in response_headers],
+    })
+    await send({'type': 'http.response.body', 'body': b'' if scope['method'] == 'HEAD' else body})
+    return True
+
+
+def create_asgi_app(flask_app, backend_api, config: dict):
+    """
+    ASGI application for uvicorn. POST /backend-api/v2/conversation is served
+    by AsyncBackend and /assets/ from the in-memory asset store; every other
+    route (pages) goes to the Flask app.
+    """
+    async_backend = AsyncBackend(backend_api, config)
+    wsgi = WSGIMiddleware(flask_app)
+    assets = flask_app.extensions.get('assets')
+    async_routes = {
+        ('POST', '/backend-api/v2/conversation'): async_backend.conversation,
+    }
+
+    async def app(scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await async_backend.aclose()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        handler = async_routes.get((scope.get('method'), scope.get('path')))
+        if handler is not None:
+            return await handler(scope, receive, send)
+        # static assets come straight from memory, without a WSGI thread
+        if assets is not None and scope.get('method') in ('GET', 'HEAD') and scope['path'].startswith('/assets/'):
+            if await serve_asset(assets, scope, send):
+                return
+        return await wsgi(scope, receive, send)
+
+    return app
@@ -0,0 +1,212 @@
+#Static assets served from memory with content-hash ETags and precompressed variants
+
+import gzip
+import mimetypes
+import os
+import threading
+from hashlib import sha256
+from json import dumps
+
+try:
+    import brotli
+except ImportError:   # optional; gzip is always available
+    brotli = None
+
+CLIENT_DIR = os.path.normpath(os.path.join(os.path.dirname(__file__), '..', 'client'))
+
+# Defaults for the optional "assets" block of config.json.
+ASSETS_DEFAULTS = {
+    'root': CLIENT_DIR,
+    # sub-folders of root served under /assets/<folder>/<file>
+    'folders': ['css', 'js', 'img'],
+    # Cache-Control max-age for fingerprinted (?v=<hash>) URLs
+    'max_age': 31536000,
+    # build gzip (and brotli, when installed) variants of text assets
+    'precompress': True,
+    'min_size': 256,
+    # re-read files whose mtime changed (development)
+    'reload': False,
+}
+
+mimetypes.add_type('application/manifest+json', '.webmanifest')
+mimetypes.add_type('text/javascript', '.js')
+
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/manifest+json',
+                      'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon')
+
+
+def _compressors() -> dict:
+    compressors = {'gzip': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        compressors['br'] = lambda data: brotli.compress(data, quality=11)
+    return compressors
+
+
+def accepted_encodings(header: str) -> set:
+    """Content codings the client accepts (q > 0) from an Accept-Encoding header."""
+    accepted = set()
+    for item in (header or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if coding and q > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class Asset:
+    __slots__ = ('path', 'mimetype', 'version', 'mtime', 'variants')
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.mtime = os.stat(path).st_mtime
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.version = sha256(data).hexdigest()[:16]
+        self.variants = {'identity': data}   # content coding -> body
+
+    def precompress(self, compressors: dict, min_size: int) -> None:
+        data = self.variants['identity']
+        if len(data) < min_size or not self.mimetype.startswith(COMPRESSIBLE_TYPES):
+            return
+        for coding, compress in compressors.items():
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                self.variants[coding] = compressed
+
+
+class AssetStore:
+    """
+    Everything under the served client folders, read once at startup.
+
+    Each file is identified by a hash of its content, used as ETag and as
+    the ?v= fingerprint added by url(). Requests carrying the current
+    fingerprint are cacheable forever; bare URLs must revalidate, which is
+    answered with 304 when the ETag still matches. Compressed variants are
+    built up front and chosen by Accept-Encoding.
+    """
+
+    def __init__(self, root: str = CLIENT_DIR, folders: list = ('css', 'js', 'img'), max_age: int = 31536000,
+                 precompress: bool = True, min_size: int = 256, reload: bool = False) -> None:
+        self.root = root
+        self.folders = list(folders)
+        self.max_age = max_age
+        self.compressors = _compressors() if precompress else {}
+        self.min_size = min_size
+        self.reload = reload
+        self._assets = {}   # (folder, file) -> Asset
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.not_modified = 0
+        self.misses = 0
+
+    def _build(self, path: str) -> Asset:
+        asset = Asset(path)
+        asset.precompress(self.compressors, self.min_size)
+        return asset
+
+    def load(self) -> int:
+        assets = {}
+        for folder in self.folders:
+            directory = os.path.join(self.root, folder)
+            if not os.path.isdir(directory):
+                continue
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                if os.path.isfile(path) and not name.startswith('.'):
+                    assets[(folder, name)] = self._build(path)
+        with self._lock:
+            self._assets = assets
+        return len(assets)
+
+    def get(self, folder: str, file: str):
+        asset = self._assets.get((folder, file))
+        if asset is not None and self.reload:
+            try:
+                changed = os.stat(asset.path).st_mtime != asset.mtime
+            except OSError:
+                changed = False
+            if changed:
+                asset = self._build(asset.path)
+                with self._lock:
+                    self._assets[(folder, file)] = asset
+        return asset
+
+    def url(self, path: str) -> str:
+        """Fingerprinted URL of an asset given as '<folder>/<file>', for templates."""
+        folder, _, file = path.partition('/')
+        asset = self.get(folder, file)
+        if asset is None:
+            return f'/assets/{path}'
+        return f'/assets/{path}?v={asset.version}'
+
+    def importmap(self) -> str:
+        """
+        Import map pointing every JS module at its fingerprinted URL, so
+        relative imports between modules are cached like the entry point.
+        """
+        with self._lock:
+            scripts = sorted(file for folder, file in self._assets if folder == 'js' and file.endswith('.js'))
+        imports = {f'/assets/js/{file}': self.url(f'js/{file}') for file in scripts}
+        return dumps({'imports': imports}, indent=2)
+
+    def respond(self, folder: str, file: str, version: str = None, if_none_match: str = None,
+                accept_encoding: str = None):
+        """
+        (status, headers, body) for a request, or None when the asset does
+        not exist. Framework neutral so Flask and the ASGI app can share it.
+        """
+        asset = self.get(folder, file)
+        if asset is None:
+            self.misses += 1
+            return None
+
+        accepted = accepted_encodings(accept_encoding)
+        coding = next((c for c in ('br', 'gzip') if c in asset.variants and c in accepted), 'identity')
+        etag = f'"{asset.version}"' if coding == 'identity' else f'"{asset.version}-{coding}"'
+
+        headers = [('ETag', etag), ('Vary', 'Accept-Encoding')]
+        if version == asset.version:
+            headers.append(('Cache-Control', f'public, max-age={self.max_age}, immutable'))
+        else:
+            headers.append(('Cache-Control', 'no-cache'))
+
+        if if_none_match:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+            # any representation of the same content is still current
+            if '*' in tags or any(tag.strip('"').split('-')[0] == asset.version for tag in tags):
+                self.not_modified += 1
+                return 304, headers, b''
+
+        body = asset.variants[coding]
+        headers.append(('Content-Type', asset.mimetype))
+        headers.append(('Content-Length', str(len(body))))
+        if coding != 'identity':
+            headers.append(('Content-Encoding', coding))
+        self.hits += 1
+        return 200, headers, body
+
+    def stats(self) -> dict:
+        with self._lock:
+            assets = list(self._assets.values())
+        return {
+            'assets': len(assets),
+            'bytes': sum(len(a.variants['identity']) for a in assets),
+            'compressed_variants': sum(len(a.variants) - 1 for a in assets),
+            'hits': self.hits,
+            'not_modified': self.not_modified,
+            'misses': self.misses,
+        }
+
+
+def create_asset_store(options: dict) -> AssetStore:
+    """Build the asset store from the "assets" config block and load it."""
+    store = AssetStore(**{**ASSETS_DEFAULTS, **options})
+    store.load()
+    return store
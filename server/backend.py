@@ -1,76 +1,35 @@
 from json import dumps
-from time import time
+from time import time, monotonic
 from flask import request
 from hashlib import sha256
 from datetime import datetime
 import requests
 from json     import loads
 import os
+import threading
 
 from server.config import special_instructions
 
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from contextlib import contextmanager
-import os
-from dotenv import load_dotenv
-
-load_dotenv()
-
-# Database configuration
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'localhost'),
-    'database': os.getenv('DB_NAME', 'mydb'),
-    'user': os.getenv('DB_USER', 'postgres'),
-    'password': os.getenv('DB_PASSWORD', 'password'),
-    'port': os.getenv('DB_PORT', '5432')
-}
-
-@contextmanager
-def get_db_connection():
-    """
-    Context manager for database connections.
-    Automatically handles commit/rollback and connection closing.
-    
-    Usage:
-        with get_db_connection() as conn:
-            with conn.cursor() as cur:
-                cur.execute('SELECT * FROM table')
-                results = cur.fetchall()
-    """
-    conn = psycopg2.connect(**DB_CONFIG)
-    try:
-        yield conn
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        conn.close()
-
-@contextmanager
-def get_db_cursor(dict_cursor=True):
-    """
-    Context manager that provides both connection and cursor.
-    Automatically handles commit/rollback and cleanup.
-    
-    Usage:
-        with get_db_cursor() as (conn, cur):
-            cur.execute('SELECT * FROM table')
-            results = cur.fetchall()
-    """
-    conn = psycopg2.connect(**DB_CONFIG)
-    cursor_factory = RealDictCursor if dict_cursor else None
-    cur = conn.cursor(cursor_factory=cursor_factory)
-    try:
-        yield conn, cur
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
-    finally:
-        cur.close()
-        conn.close()
+from server.pool import DB_CONFIG, get_db_connection, get_db_cursor, get_pool
+from server.skills import TeamSkillsPrompt, TEAM_SKILLS_CONFIG, load_team_skills_file
+from server.directory import DirectorySkillsPrompt, SkillDirectory
+from server.upstream import UpstreamClient, UpstreamError
+from server.search import WebSearch
+from server.cache import create_response_cache
+from server.history import HistoryManager
+from server.conversations import create_conversation_store
+from server.relay import SSERelay
+from server.database import ModelConfig, ModelRegistry
+from server.admission import AdmissionRejected, create_admission_controller
+from server.history import estimate_tokens
+from server.context_cache import create_context_cache
+from server.cancellation import (CANCELLATIONS, CANCELLATION_DEFAULTS, Deadline, DeadlineExceeded,
+                                 abort_response, client_gone, client_socket, create_disconnect_monitor)
+from server.resume import StreamGone, create_resume_store, event_frame, parse_event_id
+from server.single_flight import coalesce_key, create_single_flight
+from server.batch import create_batch_jobs
+from server.router import create_router
+from server.metrics import METRICS_DEFAULTS, PHASE_SECONDS, RequestTimer, registry
 
 def init_db():
     """
@@ -80,307 +39,937 @@ def init_db():
     Returns:
         list: Query results from team_skills table
     """
-    with get_db_cursor() as (conn, cur):
-        cur.execute('SELECT * FROM team_skills;')
-        results = cur.fetchall()
+    with PHASE_SECONDS.time(phase='db_fetch'):
+        with get_db_cursor() as (conn, cur):
+            cur.execute('SELECT * FROM team_skills;')
+            results = cur.fetchall()
     return results
 
 
 
+HISTORY_SUMMARY_INSTRUCTION = 'Summarize the following chat between a user and an AI assistant in a few short ' \
+                              'paragraphs. Keep names, decisions, open questions and any facts the assistant may ' \
+                              'need later. Reply with the summary only.\n\n'
+
+# leads the team skills selection when it is sent outside the cached system message
+TEAM_SKILLS_MATCH_NOTE = 'From the team skills list, these teammates have skills that come up in this conversation:\n\n'
+
+
+def search_context(results: list) -> list:
+    """Turn ddg search results into the extra user message sent ahead of the prompt."""
+    blob = ''
+
+    for index, result in enumerate(results):
+        blob += f'[{index}] "{result["snippet"]}"\nURL:{result["link"]}\n\n'
+
+    date = datetime.now().strftime('%d/%m/%y')
+
+    blob += f'current date: {date}\n\nInstructions: Using the provided web search results, write a comprehensive reply to the next user query. Make sure to cite results using [[number](URL)] notation after the reference. If the provided search results refer to multiple subjects with the same name, write separate answers for each subject. Ignore your previous response if any.'
+
+    return [{'role': 'user', 'content': blob}]
+
+
+def candidate_texts(payload: dict) -> list:
+    """Text parts of every candidate in a Gemini (stream)GenerateContent response."""
+    texts = []
+    candidates = payload.get('candidates', [])
+    for cand in candidates:
+        content = cand.get('content', {})
+        parts = content.get('parts', [])
+        for p in parts:
+            text = p.get('text')
+            if text:
+                texts.append(text)
+    return texts
+
+
+def request_fingerprint(model: str, body: dict) -> str:
+    """
+    Response cache key: sha256 over the model and the complete upstream body,
+    which carries the system instruction (team skills and date included), the
+    jailbreak prelude, history, prompt and generationConfig.
+    """
+    return sha256(dumps([model, body], sort_keys=True).encode()).hexdigest()
+
+
+def admission_key(payload: dict) -> str:
+    """Who a request is rate limited as: the site's user id, else the chat id."""
+    user_id = payload['meta'].get('user', {}).get('user_id')
+    if user_id:
+        return f'user:{user_id}'
+    return f"conversation:{payload.get('conversation_id') or 'anonymous'}"
+
+
+def rejection_body(e: AdmissionRejected) -> dict:
+    return {
+        '_action': '_ask',
+        'success': False,
+        'error': str(e),
+        'retry_after': e.retry_after,
+    }
+
+
+def deadline_body(e: DeadlineExceeded) -> dict:
+    return {
+        '_action': '_ask',
+        'success': False,
+        'error': str(e),
+    }
+
+
+def resume_expired_body() -> dict:
+    return {
+        '_action': '_ask',
+        'success': False,
+        'error': 'This answer can no longer be resumed, please ask again.',
+    }
+
+
+def provider_label(route) -> str:
+    """Provider name for error messages; Gemini when the router isn't in use."""
+    return 'Gemini' if route is None or route.kind == 'gemini' else route.provider
+
+
+# generationConfig keys and their OpenAI chat completions names
+OPENAI_GENERATION_CONFIG = {
+    'temperature': 'temperature',
+    'topP': 'top_p',
+    'maxOutputTokens': 'max_tokens',
+    'stopSequences': 'stop',
+    'presencePenalty': 'presence_penalty',
+    'frequencyPenalty': 'frequency_penalty',
+}
+
+
+def openai_generation_config(config: dict) -> dict:
+    return {OPENAI_GENERATION_CONFIG[k]: v for k, v in config.items() if k in OPENAI_GENERATION_CONFIG}
+
+
+def sse_event(text) -> str:
+    """
+    Emit a proper SSE 'data:' framed event so clients reading the response as
+    an Event Stream (or raw fetch stream) receive complete events. We
+    JSON-encode the payload to safely transport newlines.
+    """
+    try:
+        s = dumps({'text': text})
+    except Exception:
+        s = dumps({'text': str(text)})
+    return f"data: {s}\n\n"
+
+
 class Backend_Api:
-    def __init__(self, app, config: dict) -> None:
+    def __init__(self, app, config: dict, start_background: bool = True) -> None:
         self.app = app
         self.openai_key = os.getenv("OPENAI_API_KEY") or config['openai_key']
         self.openai_api_base = os.getenv("OPENAI_API_BASE") or config['openai_api_base']
         # optional Gemini key — when present we'll call Gemini instead of OpenAI
         self.gemini_key = os.getenv("GEMINI_API_KEY") or config.get('gemini_key')
+        # Allow a configurable fallback model (env or default) when the
+        # requested model is not available. This helps UX when the UI
+        # sends an alias or unsupported model name.
+        self.fallback_model = ModelConfig.get_fallback_model()
         self.proxy = config['proxy']
+        # one pooled keep-alive client per worker for Gemini and search calls
+        self.upstream = UpstreamClient(self.proxy, **config.get('upstream', {}))
+        # cached, deduplicated web search with a time budget
+        self.search = WebSearch(self.upstream.session, **config.get('search', {}))
+        # opt-in replay of completed responses for identical requests
+        self.response_cache = create_response_cache(config.get('response_cache', {}))
+        # keeps forwarded history within the model's token budget
+        self.history = HistoryManager(
+            summarize = self._summarize_history if self.gemini_key else None,
+            **config.get('history', {}),
+        )
+        # rendered team skills context, reloaded off the request path
+        if TEAM_SKILLS_CONFIG['file']:
+            self.team_skills = TeamSkillsPrompt(lambda: load_team_skills_file(TEAM_SKILLS_CONFIG['file']),
+                                                ttl=TEAM_SKILLS_CONFIG['ttl'])
+        elif TEAM_SKILLS_CONFIG['source'] == 'tables':
+            # normalized members/skills tables; only matching members are fetched
+            self.team_skills = DirectorySkillsPrompt(SkillDirectory(), ttl=TEAM_SKILLS_CONFIG['ttl'],
+                                                     max_members=TEAM_SKILLS_CONFIG['max_members'])
+        else:
+            self.team_skills = TeamSkillsPrompt(lambda: init_db()[0], ttl=TEAM_SKILLS_CONFIG['ttl'])
+        # known-good / known-missing models, so unsupported ones are
+        # rewritten to the fallback before the request instead of after a 404
+        self.models_config = config.get('models', {})
+        self.models = ModelRegistry(
+            available_ttl = self.models_config.get('available_ttl', ModelRegistry.DEFAULT_AVAILABLE_TTL),
+            missing_ttl = self.models_config.get('missing_ttl', ModelRegistry.DEFAULT_MISSING_TTL),
+            max_entries = self.models_config.get('max_entries', ModelRegistry.DEFAULT_MAX_ENTRIES),
+        )
+        # re-frames (or passes through) the upstream SSE stream
+        self.relay = SSERelay(**config.get('relay', {}))
+        # server-side history; when enabled the client only sends new messages
+        self.conversations = create_conversation_store(config.get('conversation_store', {}))
+        self.app.config['SERVER_HISTORY'] = self.conversations is not None
+        # provider-side cache of the static system instruction prefix
+        self.context_cache = create_context_cache(config.get('context_cache', {}), self.upstream.session, self.gemini_key)
+        # picks Gemini or an OpenAI-compatible API per request by observed
+        # latency and health, with failover and optional hedging
+        router_config = config.get('router', {})
+        self.router = create_router(router_config, {'gemini': self.gemini_key, 'openai': self.openai_key})
+        if self.router is None and router_config.get('enable'):
+            print('Routing needs a provider with an API key; the router is disabled')
+        if self.router is not None and self.relay.mode == 'passthrough':
+            print('Routing between providers needs relay mode "coalesce" or "parse"; the router is disabled')
+            self.router = None
+        # caps concurrent upstream generations, fairly across clients
+        self.admission = create_admission_controller(config.get('admission', {}))
+        # per-request deadline, and aborting upstream streams nobody reads
+        self.cancellation = {**CANCELLATION_DEFAULTS, **config.get('cancellation', {})}
+        self.disconnects = create_disconnect_monitor(self.cancellation)
+        # recorded streams a reconnecting client can pick up again
+        self.resume = create_resume_store(config.get('resume', {}))
+        if self.resume is not None and self.relay.mode == 'passthrough':
+            print('Resumable streams need relay mode "coalesce" or "parse"; resume is disabled')
+            self.resume = None
+        # identical concurrent requests follow one upstream generation
+        self.coalescer = create_single_flight(config.get('single_flight', {}))
+        if self.coalescer is not None and self.relay.mode == 'passthrough':
+            print('Single-flight requests need relay mode "coalesce" or "parse"; single_flight is disabled')
+            self.coalescer = None
+        # phase timings and component stats for Prometheus
+        self.metrics = {**METRICS_DEFAULTS, **config.get('metrics', {})}
         self.routes = {
             '/backend-api/v2/conversation': {
                 'function': self._conversation,
                 'methods': ['POST']
             }
         }
+        # JSONL batch jobs through the same pipeline, opt-in
+        self.batches = create_batch_jobs(config.get('batch', {}), self.complete)
+        if self.batches is not None:
+            self.routes.update(self.batches.routes)
+        if self.metrics['enable']:
+            self._register_collectors()
+            self.routes[self.metrics['path']] = {
+                'function': self._metrics,
+                'methods': ['GET']
+            }
+        # threads and connections belong to the process that uses them; a
+        # preloading server starts them in each worker after the fork
+        if start_background:
+            self.start_background()
+
+    def start_background(self) -> None:
+        """Start the team skills listener and the model probe, if configured."""
+        if TEAM_SKILLS_CONFIG['listen']:
+            self.team_skills.listen()
+        if self.gemini_key and self.models_config.get('probe'):
+            self.models.probe_in_background(self.upstream.session, self.gemini_key)
+
+    def warm(self) -> None:
+        """Load the team skills prompt and open upstream connections before taking traffic."""
+        try:
+            self.team_skills.warm()
+        except Exception as e:
+            print(f'Team skills warm-up failed: {e}')
+        urls = [self.search.url]
+        if self.gemini_key:
+            urls.append(ModelConfig.build_gemini_models_url())
+        self.upstream.warm(urls)
+
+    def _register_collectors(self) -> None:
+        registry.register_collector('db_pool', lambda: get_pool().stats())
+        registry.register_collector('upstream', self.upstream.stats, label='host')
+        registry.register_collector('search', self.search.stats)
+        registry.register_collector('relay', self.relay.stats)
+        registry.register_collector('models', self.models.stats)
+        registry.register_collector('history', self.history.stats)
+        if self.router is not None:
+            registry.register_collector('router', self.router.stats, label='route')
+        for name, component in (('response_cache', self.response_cache),
+                                ('context_cache', self.context_cache),
+                                ('conversation_store', self.conversations),
+                                ('admission', self.admission),
+                                ('cancellation', self.disconnects),
+                                ('resume', self.resume),
+                                ('single_flight', self.coalescer),
+                                ('batch', self.batches)):
+            if component is not None:
+                registry.register_collector(name, component.stats)
+
+    def _deadline(self) -> Deadline:
+        """Time budget for a new conversation request (unlimited when cancellation is disabled)."""
+        options = self.cancellation
+        if not options['enable']:
+            return Deadline()
+        return Deadline(options['deadline'], db=options['db'], connect=options['connect'])
+
+    def _metrics(self):
+        return self.app.response_class(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    def _system_message(self, payload: dict) -> str:
+        current_date = datetime.now().strftime("%Y-%m-%d")
+
+        # 3. Modify the system_message to include the new context
+        system_message = f'You are ChatGPT also known as ChatGPT, a large language model trained by OpenAI. Strictly follow the users instructions. Knowledge cutoff: 2021-09-01 Current date: {current_date}'
+        if TEAM_SKILLS_CONFIG['select'] and self.context_cache is None:
+            # only list teammates whose skills come up in the recent chat
+            system_message += self.team_skills.select(self._skills_query(payload))
+        else:
+            # with the context cache the whole list keeps the system message the
+            # same on every request, so it is cached once; the teammates matching
+            # this request are sent separately by _skills_selection()
+            system_message += self.team_skills.get() # Appending the cached team skills context
+        return system_message
+
+    def _skills_query(self, payload: dict) -> str:
+        """The recent chat and the prompt, searched for skill terms."""
+        _conversation = payload['meta']['content']['conversation']
+        prompt = payload['meta']['content']['parts'][0]
+        recent = _conversation[-TEAM_SKILLS_CONFIG['context_turns']:] if TEAM_SKILLS_CONFIG['context_turns'] > 0 else []
+        return '\n'.join([m.get('content', '') for m in recent] + [prompt.get('content', '')])
+
+    def _skills_selection(self, payload: dict) -> list:
+        """
+        With the context cache on, the teammates whose skills come up in the
+        recent chat, as a user message ahead of the prompt (outside the cached
+        prefix); otherwise they are already in the system message.
+        """
+        if not TEAM_SKILLS_CONFIG['select'] or self.context_cache is None:
+            return []
+        matched = self.team_skills.matches(self._skills_query(payload))
+        return [{'role': 'user', 'content': TEAM_SKILLS_MATCH_NOTE + matched}] if matched else []
+
+    def _build_conversation(self, payload: dict, system_message: str, extra: list, selection: list = ()) -> list:
+        """Full message list: system message, search results, jailbreak prelude, history, team skills selection, prompt."""
+        jailbreak = payload['jailbreak']
+        _conversation = self.history.compact(
+            payload.get('conversation_id'),
+            payload['meta']['content']['conversation'],
+            ModelConfig.get_model_name(payload),
+        )
+        prompt = payload['meta']['content']['parts'][0]
+
+        return [{'role': 'system', 'content': system_message}] + \
+            extra + special_instructions[jailbreak] + \
+            _conversation + list(selection) + [prompt]
+
+    def _summarize_history(self, messages: list, previous_summary: str = None) -> str:
+        """Running summary of `messages` (continuing `previous_summary`) from the fallback model."""
+        transcript = '\n\n'.join(f"{m.get('role', 'user')}: {m.get('content', '')}" for m in messages)
+        if previous_summary:
+            transcript = f'Summary so far:\n{previous_summary}\n\nLater messages:\n{transcript}'
+
+        resp = self.upstream.post(
+            ModelConfig.build_gemini_generate_url(self.fallback_model),
+            headers = {
+                'Content-Type': 'application/json',
+                'x-goog-api-key': self.gemini_key
+            },
+            json = {'contents': [{'role': 'user', 'parts': [{'text': HISTORY_SUMMARY_INSTRUCTION + transcript}]}]},
+            timeout = 30,
+        )
+        resp.raise_for_status()
+        return ''.join(candidate_texts(resp.json()))
+
+    def _gemini_request(self, payload: dict, conversation: list) -> tuple:
+        """Returns (model, url, headers, body) for a Gemini streaming call."""
+        # Map internal messages to Gemini 'contents' array. We skip the
+        # system message here because it will be passed as systemInstruction.
+        contents = []
+        system_instruction_text = ''
+        for msg in conversation:
+            role = msg.get('role', 'user')
+            if role == 'system':
+                # Use the content of the first system message
+                # (which now includes team skills) as the systemInstruction
+                system_instruction_text = msg.get('content', '')
+                continue
+            mapped_role = 'user' if role == 'user' else 'model'
+            contents.append({
+                'role': mapped_role,
+                'parts': [{'text': msg.get('content', '')}]
+            })
+
+        # skip models already known to be missing instead of paying for a 404
+        model = self.models.resolve(ModelConfig.get_model_name(payload), self.fallback_model)
+        url = ModelConfig.build_gemini_url(model)
+
+        headers = {
+            'Content-Type': 'application/json',
+            'x-goog-api-key': self.gemini_key
+        }
+
+        body = {
+            'contents': contents,
+            'systemInstruction': {'parts': [{'text': system_instruction_text}]}, # Use the modified system message
+            'generationConfig': payload.get('generationConfig', {})
+        }
+        return model, url, headers, body
+
+    def _static_contents(self, payload: dict, conversation: list) -> int:
+        """
+        How many leading Gemini contents are the same on every turn: the
+        jailbreak prelude, unless search results were put in front of it.
+        """
+        prelude = special_instructions.get(payload.get('jailbreak'), [])
+        return len(prelude) if conversation[1:1 + len(prelude)] == prelude else 0
+
+    def _context_body(self, model: str, body: dict, static_contents: int) -> tuple:
+        """(body to send, context cache key) with the static prefix replaced by a cached handle when one is live."""
+        if self.context_cache is None:
+            return body, None
+        return self.context_cache.apply(model, body, static_contents)
+
+    def _load_history(self, payload: dict) -> None:
+        """
+        Fill in meta.content.conversation from the conversation store when the
+        client left it out: the sending user's history of that chat id.
+        """
+        if self.conversations is None:
+            return
+        content = payload['meta']['content']
+        conversation_id = payload.get('conversation_id')
+        if content.get('conversation') is None:
+            user_id = payload['meta'].get('user', {}).get('user_id')
+            content['conversation'] = self.conversations.history(conversation_id, user_id) if conversation_id else []
+
+    def _record_answer(self, payload: dict, text: str) -> None:
+        # the prompt is stored with its answer, so a failed generation
+        # doesn't leave an unanswered turn that every later request replays
+        if self.conversations is not None and text:
+            prompt = payload['meta']['content']['parts'][0]
+            self.conversations.append(payload.get('conversation_id'), [
+                {'role': prompt.get('role', 'user'), 'content': prompt.get('content', '')},
+                {'role': 'assistant', 'content': text},
+            ], payload['meta'].get('user', {}).get('user_id'))
+
+    def _cached_response(self, key: str):
+        try:
+            return self.response_cache.get(key)
+        except Exception as e:
+            print(f'Response cache lookup failed: {e}')
+            return None
+
+    def _store_response(self, key: str, model: str, text: str) -> None:
+        try:
+            self.response_cache.put(key, model, text)
+        except Exception as e:
+            print(f'Response cache write failed: {e}')
+
+    def _open_upstream(self, session, model: str, url: str, headers: dict, body: dict,
+                       static_contents: int, deadline: Deadline) -> tuple:
+        """
+        (streaming Gemini response, model serving it). A rejected cached
+        prefix is retried inline and a missing model with the fallback.
+        """
+        fallback_model = self.fallback_model
+        served_model = model
+        send_body, context_key = self._context_body(model, body, static_contents)
+        gpt_resp = session.post(
+            url,
+            headers = headers,
+            json = send_body,
+            stream = True,
+            timeout = deadline.budget('upstream_connect', deadline.connect),
+        )
+
+        # the cached prefix expired or was deleted upstream; send it inline
+        if context_key is not None and gpt_resp.status_code in (400, 403, 404):
+            print(f'Gemini rejected cached content ({gpt_resp.status_code}), retrying inline: {gpt_resp.text[:200]}')
+            gpt_resp.close()
+            self.context_cache.invalidate(context_key)
+            gpt_resp = session.post(
+                url,
+                headers = headers,
+                json = body,
+                stream = True,
+                timeout = deadline.budget('upstream_connect', deadline.connect),
+            )
+
+        # If we got a 404 (model not found) and the model isn't already
+        # the fallback, retry once with the fallback model.
+        if gpt_resp.status_code == 404 and model != fallback_model:
+            try:
+                err = gpt_resp.json()
+            except Exception:
+                err = gpt_resp.text
+            print(f"Gemini model {model} not found (404). Retrying with fallback {fallback_model}: {err}")
+            self.models.mark_missing(model)
+            # rebuild URL for fallback
+            fallback_url = ModelConfig.build_gemini_url(fallback_model)
+            served_model = fallback_model
+            gpt_resp = session.post(
+                fallback_url,
+                headers = headers,
+                json = body,
+                stream = True,
+                timeout = deadline.budget('upstream_connect', deadline.connect),
+            )
+        return gpt_resp, served_model
+
+    def _openai_request(self, route, conversation: list, payload: dict) -> tuple:
+        """Returns (url, headers, body) for an OpenAI-compatible chat completions stream."""
+        provider = self.router.providers[route.provider]
+        base = provider.get('base') or self.openai_api_base
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f"Bearer {provider.get('key') or self.openai_key}",
+        }
+        body = {
+            'model': route.model,
+            'messages': [{'role': m.get('role', 'user'), 'content': m.get('content', '')} for m in conversation],
+            'stream': True,
+            **openai_generation_config(payload.get('generationConfig', {})),
+        }
+        return f"{base.rstrip('/')}/v1/chat/completions", headers, body
+
+    def _open(self, session, model: str, url: str, headers: dict, body: dict, conversation: list,
+              payload: dict, deadline: Deadline) -> tuple:
+        """
+        (stream, served model, route): from the router's pick when it is
+        enabled (route None otherwise). With the router the stream has
+        already produced its first token.
+        """
+        static_contents = self._static_contents(payload, conversation)
+        if self.router is None:
+            return (*self._open_upstream(session, model, url, headers, body, static_contents, deadline), None)
+
+        def opener(route) -> tuple:
+            if route.kind == 'gemini':
+                route_url = url if route.model == model else ModelConfig.build_gemini_url(route.model)
+                return self._open_upstream(session, route.model, route_url, headers, body, static_contents, deadline)
+            openai_url, openai_headers, openai_body = self._openai_request(route, conversation, payload)
+            resp = session.post(openai_url, headers=openai_headers, json=openai_body, stream=True,
+                                timeout=deadline.budget('upstream_connect', deadline.connect))
+            return resp, route.model
+
+        return self.router.open(model, opener, deadline.budget('upstream_connect', deadline.connect))
+
+    def _generate(self, payload: dict, session, model: str, url: str, headers: dict, body: dict,
+                  conversation: list, cache_key: str, ticket, timer: RequestTimer, deadline: Deadline,
+                  record=None):
+        """Upstream model call and the streaming response around it, produced into `record` when given."""
+        with timer.phase('upstream_connect'):
+            gpt_resp, served_model, route = self._open(session, model, url, headers, body, conversation,
+                                                       payload, deadline)
+
+        if gpt_resp.status_code >= 400:
+            try:
+                err = gpt_resp.json()
+            except Exception:
+                err = gpt_resp.text
+            if ticket is not None:
+                ticket.release()
+            if record is not None:
+                record.fail()
+            timer.finish('upstream_error')
+            return {
+                'successs': False,
+                'message': f'{provider_label(route)} request failed: {gpt_resp.status_code} {err}'
+            }, gpt_resp.status_code
+
+        if route is None or route.kind == 'gemini':
+            self.models.mark_available(served_model)
+
+        # the answer text is only assembled when something keeps it (or
+        # counts its tokens)
+        keep_text = self.response_cache is not None or self.conversations is not None or self.metrics['enable']
+        fragments = [] if keep_text else None
+
+        if record is None and self.resume is not None:
+            record = self.resume.begin(payload.get('conversation_id'))
+        if record is not None:
+            # attached before the generation starts, so a follower leaving
+            # early can't leave it without readers
+            response = self._tail(record, 0)
+            self._produce(record, payload, gpt_resp, model, cache_key, ticket, timer, deadline, fragments)
+            return response
+
+        # abort the upstream read as soon as the client is gone or the
+        # deadline passes, instead of on the next frame written
+        watch = None
+        if self.disconnects is not None:
+            def cancel(reason: str) -> None:
+                CANCELLATIONS.inc(reason=reason)
+                abort_response(gpt_resp)
+                if ticket is not None:
+                    ticket.release()
+            watch = self.disconnects.watch(client_socket(request.environ), deadline, cancel)
+
+        def stream():
+            outcome = 'disconnected'
+            try:
+                for frame in self.relay.frames(gpt_resp.iter_content(chunk_size=None), fragments):
+                    timer.first_frame()
+                    yield frame
+                outcome = 'ok'
+                # only complete generations are cached
+                if cache_key is not None:
+                    self._store_response(cache_key, model, ''.join(fragments))
+            except GeneratorExit:
+                return
+            except Exception as e:
+                if watch is not None and watch.reason is not None:
+                    # aborted by the monitor
+                    outcome = 'disconnected' if watch.reason == 'disconnect' else 'deadline'
+                    return
+                outcome = 'stream_error'
+                print('Gemini stream error:', e)
+                return
+            finally:
+                if watch is not None:
+                    watch.close()
+                # hand the keep-alive connection back to the pool
+                gpt_resp.close()
+                text = ''.join(fragments or ())
+                timer.finish(outcome, estimate_tokens(text) if text else 0)
+                # keep whatever was generated, even if the client left early
+                self._record_answer(payload, text)
+
+        response = self.app.response_class(stream(), mimetype='text/event-stream')
+        # runs when the server closes the response, also if the stream was
+        # never started
+        if ticket is not None:
+            response.call_on_close(ticket.release)
+        if watch is not None:
+            response.call_on_close(watch.close)
+        response.call_on_close(lambda: timer.finish('disconnected'))
+        return response
+
+    def _produce(self, record, payload: dict, gpt_resp, model: str, cache_key: str, ticket,
+                 timer: RequestTimer, deadline: Deadline, fragments: list) -> None:
+        """
+        Read the upstream stream into `record` on a thread of its own, so the
+        generation outlives a dropped client connection and a reconnect can
+        pick it up. Readers follow it through _tail().
+        """
+        def cancel() -> None:
+            abort_response(gpt_resp)
+            if ticket is not None:
+                ticket.release()
+        record.cancel = cancel
+        record.start()
+
+        watch = None
+        if self.disconnects is not None:
+            def expire(reason: str) -> None:
+                record.cancel_reason = reason
+                CANCELLATIONS.inc(reason=reason)
+                cancel()
+            # the deadline only; the readers' clients are watched by _tail()
+            watch = self.disconnects.watch(None, deadline, expire)
+
+        def run() -> None:
+            outcome = 'disconnected'
+            try:
+                for frame in self.relay.frames(gpt_resp.iter_content(chunk_size=None), fragments):
+                    timer.first_frame()
+                    record.append(frame)
+                outcome = 'ok'
+                # only complete generations are cached
+                if cache_key is not None:
+                    self._store_response(cache_key, model, ''.join(fragments))
+            except Exception as e:
+                if record.cancel_reason is not None:
+                    outcome = 'deadline' if record.cancel_reason == 'deadline' else 'disconnected'
+                else:
+                    outcome = 'stream_error'
+                    print('Gemini stream error:', e)
+            finally:
+                if watch is not None:
+                    watch.close()
+                # hand the keep-alive connection back to the pool
+                gpt_resp.close()
+                text = ''.join(fragments or ())
+                record.finish(text if fragments is not None else None)
+                if ticket is not None:
+                    ticket.release()
+                timer.finish(outcome, estimate_tokens(text) if text else 0)
+                self._record_answer(payload, text)
+
+        threading.Thread(target=run, name='generation', daemon=True).start()
+
+    def _tail(self, record, after: int):
+        """
+        Streaming response with the frames of `record` after seq `after`,
+        following the generation until it is done or this client goes away.
+        Frames carry their SSE event id only when resume is enabled; without
+        it a reconnecting client would get a new answer, not the rest.
+        """
+        record.attach()
+        resumable = self.resume is not None
+        watch = None
+        if self.disconnects is not None:
+            # wake the read below as soon as this client is gone
+            watch = self.disconnects.watch(client_socket(request.environ), Deadline(), lambda reason: record.wake())
+
+        def stream():
+            position = after
+            try:
+                while True:
+                    frames, done = record.read(position, 1.0)
+                    for seq, frame in frames:
+                        yield event_frame(record.stream_id, seq, frame) if resumable else frame
+                        position = seq
+                    if done or (watch is not None and watch.reason is not None):
+                        return
+            except GeneratorExit:
+                return
+            except StreamGone as e:
+                print(f'Stream reader fell behind: {e}')
+
+        closed = []
+
+        def close() -> None:
+            # runs when the server closes the response, also if the stream
+            # was never started
+            if closed:
+                return
+            closed.append(True)
+            if watch is not None:
+                watch.close()
+            if record.detach():
+                self._detached(record)
+
+        response = self.app.response_class(stream(), mimetype='text/event-stream')
+        response.call_on_close(close)
+        return response
+
+    def complete(self, payload: dict, client: str = None) -> dict:
+        """
+        Answer a conversation payload in one piece instead of streaming it,
+        through the same pipeline as the route: history, team skills, search,
+        response cache, admission. For batch jobs, which pass their own
+        admission `client` and are exempt from its rate limit. Returns
+        {'text', 'model', 'cached'}; raises AdmissionRejected,
+        DeadlineExceeded or UpstreamError.
+        """
+        if not self.gemini_key and self.router is None:
+            raise UpstreamError(400, 'No Gemini key configured and no router provider is available.')
+        timer = RequestTimer(log=self.metrics['log_timings'])
+        deadline = self._deadline()
+        conversation, model, url, headers, body = self._prepare(payload, timer, deadline)
+
+        cache_key = None
+        if self.response_cache is not None:
+            cache_key = request_fingerprint(model, body)
+            with deadline.activate():
+                cached = self._cached_response(cache_key)
+            if cached is not None:
+                self._record_answer(payload, cached)
+                timer.finish('cache_hit')
+                return {'text': cached, 'model': model, 'cached': True}
+
+        ticket = None
+        if self.admission is not None:
+            ticket = self.admission.acquire(client or admission_key(payload),
+                                            deadline.budget('admission_wait', self.admission.max_wait),
+                                            rate_limited=client is None)
+            timer.record('admission_wait', ticket.queued_for)
+        watch = None
+        fragments = []
+        try:
+            with timer.phase('upstream_connect'):
+                gpt_resp, served_model, route = self._open(self.upstream.session, model, url, headers, body,
+                                                           conversation, payload, deadline)
+            try:
+                if gpt_resp.status_code >= 400:
+                    timer.finish('upstream_error')
+                    raise UpstreamError(gpt_resp.status_code, f'{provider_label(route)} request failed: '
+                                                              f'{gpt_resp.status_code} {gpt_resp.text[:500]}')
+                if route is None or route.kind == 'gemini':
+                    self.models.mark_available(served_model)
+                if self.disconnects is not None:
+                    watch = self.disconnects.watch(None, deadline, lambda reason: abort_response(gpt_resp))
+                for _ in self.relay.frames(gpt_resp.iter_content(chunk_size=None), fragments):
+                    timer.first_frame()
+            except Exception as e:
+                if watch is not None and watch.reason is not None:
+                    CANCELLATIONS.inc(reason='deadline')
+                    timer.finish('deadline')
+                    raise DeadlineExceeded('Request deadline passed while generating') from e
+                timer.finish('stream_error')
+                raise
+            finally:
+                if watch is not None:
+                    watch.close()
+                gpt_resp.close()
+        except BaseException:
+            timer.finish('error')
+            raise
+        finally:
+            if ticket is not None:
+                ticket.release()
+
+        text = ''.join(fragments)
+        if cache_key is not None:
+            self._store_response(cache_key, model, text)
+        timer.finish('ok', estimate_tokens(text) if text else 0)
+        self._record_answer(payload, text)
+        return {'text': text, 'model': served_model, 'cached': False}
+
+    def _detached(self, record) -> None:
+        """
+        The last reader of a live generation left: cancel it, after the
+        resume grace period unless somebody reconnects in time, or right
+        away when streams are not resumable (a coalesced generation).
+        """
+        if self.resume is None:
+            if record.cancel is not None and record.readers == 0 and not record.done:
+                record.cancel_reason = 'disconnect'
+                CANCELLATIONS.inc(reason='disconnect')
+                record.cancel()
+            return
+
+        def check() -> None:
+            if record.cancel is not None and self.resume.abandoned(record):
+                record.cancel_reason = 'abandoned'
+                CANCELLATIONS.inc(reason='abandoned')
+                record.cancel()
+
+        timer = threading.Timer(self.resume.detach_grace, check)
+        timer.daemon = True
+        timer.start()
+
+    def _new_record(self, payload: dict):
+        """Record for a generation that others may follow; a resumable one when resume is on."""
+        if self.resume is not None:
+            return self.resume.begin(payload.get('conversation_id'))
+        return self.coalescer.new_record(payload.get('conversation_id'))
+
+    def _follow(self, record, payload: dict) -> None:
+        """Make `record`, led by another request, this request's answer too."""
+        if self.resume is not None:
+            self.resume.share(record, payload.get('conversation_id'))
+        record.add_finish_callback(lambda text: self._record_answer(payload, text))
+
+    def _resume(self, payload: dict, last_event_id: str, timer: RequestTimer):
+        """Replay what a reconnecting client missed and follow the generation, instead of generating again."""
+        event = parse_event_id(last_event_id)
+        record = self.resume.get(payload.get('conversation_id'), event[0]) if event else None
+        if record is not None:
+            try:
+                record.frames_after(event[1])
+            except StreamGone:
+                record = None
+        if record is None:
+            timer.finish('resume_expired')
+            return resume_expired_body(), 410
+        timer.finish('resumed')
+        return self._tail(record, event[1])
+
+    def _prepare(self, payload: dict, timer: RequestTimer, deadline: Deadline) -> tuple:
+        """History, team skills, web search and prompt: (conversation, model, url, headers, body)."""
+        internet_access = payload['meta']['content']['internet_access']
+        prompt = payload['meta']['content']['parts'][0]
+
+        # start the web search first so it overlaps with prompt building
+        search_started = monotonic()
+        pending_search = self.search.submit(prompt["content"]) if internet_access else None
+
+        # database work below is bounded by the deadline's db budget
+        with timer.phase('history_load'), deadline.activate():
+            self._load_history(payload)
+        with timer.phase('prompt_build'), deadline.activate():
+            system_message = self._system_message(payload)
+            selection = self._skills_selection(payload)
+
+        extra = []
+        if pending_search is not None:
+            extra = search_context(self.search.results(pending_search, deadline.budget('search', self.search.timeout)))
+            timer.record('search', monotonic() - search_started)
+
+        with timer.phase('prompt_build'):
+            conversation = self._build_conversation(payload, system_message, extra, selection)
+            model, url, headers, body = self._gemini_request(payload, conversation)
+        return conversation, model, url, headers, body
 
     def _conversation(self):
+        timer = RequestTimer(log=self.metrics['log_timings'])
+        deadline = self._deadline()
         try:
+            payload = request.json
 
-            # --- START of user requested modification ---
-            team_skills_row = init_db()[0]
-            # 2. Construct the skills context string for the AI
-            team_skills_context = "\n\n--- CRITICAL CONTEXT: TEAM SKILLS ---\n" \
-                                  "You are an AI assistant for a specific team. Below is a list of your team members and their skills. " \
-                                  "**THIS IS YOUR MOST IMPORTANT KNOWLEDGE.**\n" \
-                                  "BEFORE answering any query about skills, programming, tools, or learning a topic (like 'React', 'Python', 'Docker', etc.), " \
-                                  "you MUST FIRST check this list. If the user's query matches a skill in this list, your PRIMARY response " \
-                                  "MUST be to identify the team member(s) who have that skill and suggest the user approach them.\n" \
-                                  "DO NOT provide general advice or external links for a topic if a team member is listed with that skill. " \
-                                  "Only provide general advice if no team member has the skill.\n\n" \
-                                  "Example:\n" \
-                                  "User: 'How do I learn React?'\n" \
-                                  "Your Correct Response: 'For questions about React, **user3@example.com** is the best person on our team to ask! They have it listed as one of their skills.'\n" \
-                                  "User: 'Who knows Docker?'\n" \
-                                  "Your Correct Response: 'That would be **user4@example.com**. They have experience with Docker and Kubernetes.'\n\n" \
-                                  "--- Team Skills List ---\n"
-
-            user_ids = team_skills_row.get("user_id", {})
-            soft_skills = team_skills_row.get("soft_skills", {})
-            hard_skills = team_skills_row.get("hard_skills", {})
-
-            for user_key, internal_id in user_ids.items():
-                team_skills_context += f"User: {user_ids[user_key]} \n"
-                
-                # Add soft skills
-                if user_key in soft_skills and soft_skills[user_key]:
-                    team_skills_context += f"  Soft Skills: {', '.join(soft_skills[user_key])}\n"
-                    
-                # Add hard skills
-                if user_key in hard_skills:
-                    user_hard_skills = hard_skills[user_key]
-                    hard_skill_parts = []
-                    if user_hard_skills.get("programming"):
-                        hard_skill_parts.append(f"Programming: {', '.join(user_hard_skills['programming'])}")
-                    if user_hard_skills.get("tools"):
-                        hard_skill_parts.append(f"Tools: {', '.join(user_hard_skills['tools'])}")
-                    
-                    if hard_skill_parts:
-                        team_skills_context += f"  Hard Skills: {'; '.join(hard_skill_parts)}\n"
-                    else:
-                        team_skills_context += "  Hard Skills: None listed\n"
-                
-                team_skills_context += "\n" # Add a newline for spacing between users
-
-            team_skills_context += "--- End of Team Skills List ---\n"
-            
-            # --- END of user requested modification ---
-
-            jailbreak = request.json['jailbreak']
-            internet_access = request.json['meta']['content']['internet_access']
-            _conversation = request.json['meta']['content']['conversation']
-            prompt = request.json['meta']['content']['parts'][0]
-            current_date = datetime.now().strftime("%Y-%m-%d")
-            
-            # 3. Modify the system_message to include the new context
-            system_message = f'You are ChatGPT also known as ChatGPT, a large language model trained by OpenAI. Strictly follow the users instructions. Knowledge cutoff: 2021-09-01 Current date: {current_date}'
-            system_message += team_skills_context # Appending the new context
-
-            # Build proxies dict if proxy enabled in config. We'll prefer
-            # an explicit proxy from config.json but we create a session
-            # with trust_env=False to avoid using system environment proxy
-            # variables like HTTP_PROXY/HTTPS_PROXY.
-            proxies = None
-            if self.proxy.get('enable'):
-                proxies = {
-                    'http': self.proxy.get('http'),
-                    'https': self.proxy.get('https'),
-                }
-
-            session = requests.Session()
-            session.trust_env = False
-
-            extra = []
-            if internet_access:
-                search = session.get(
-                    'https://ddg-api.herokuapp.com/search',
-                    params={
-                        'query': prompt["content"],
-                        'limit': 3,
-                    },
-                    proxies=proxies,
-                    timeout=10,
-                )
-
-                blob = ''
-
-                for index, result in enumerate(search.json()):
-                    blob += f'[{index}] "{result["snippet"]}"\nURL:{result["link"]}\n\n'
-
-                date = datetime.now().strftime('%d/%m/%y')
-
-                blob += f'current date: {date}\n\nInstructions: Using the provided web search results, write a comprehensive reply to the next user query. Make sure to cite results using [[number](URL)] notation after the reference. If the provided search results refer to multiple subjects with the same name, write separate answers for each subject. Ignore your previous response if any.'
-
-                extra = [{'role': 'user', 'content': blob}]
-
-            conversation = [{'role': 'system', 'content': system_message}] + \
-                extra + special_instructions[jailbreak] + \
-                _conversation + [prompt]
+            # a client that lost the connection mid-answer picks the stream up again
+            last_event_id = request.headers.get('Last-Event-ID')
+            if last_event_id and self.resume is not None:
+                return self._resume(payload, last_event_id, timer)
 
-            # If a Gemini key is configured, call Gemini streaming endpoint.
-            if self.gemini_key:
-                # Map internal messages to Gemini 'contents' array. We skip the
-                # system message here because it will be passed as systemInstruction.
-                contents = []
-                system_instruction_text = system_message # Default system message
-                for msg in conversation:
-                    role = msg.get('role', 'user')
-                    if role == 'system':
-                        # Use the content of the first system message
-                        # (which now includes team skills) as the systemInstruction
-                        system_instruction_text = msg.get('content', '')
-                        continue
-                    mapped_role = 'user' if role == 'user' else 'model'
-                    contents.append({
-                        'role': mapped_role,
-                        'parts': [{'text': msg.get('content', '')}]
-                    })
-
-                model = request.json.get('model', 'gemini-2.5-flash')
-                url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:streamGenerateContent?alt=sse"
-
-                headers = {
-                    'Content-Type': 'application/json',
-                    'x-goog-api-key': self.gemini_key
-                }
-
-                body = {
-                    'contents': contents,
-                    'systemInstruction': {'parts': [{'text': system_instruction_text}]}, # Use the modified system message
-                    'generationConfig': request.json.get('generationConfig', {})
-                }
-
-                # Allow a configurable fallback model (env or default) when the
-                # requested model is not available. This helps UX when the UI
-                # sends an alias or unsupported model name.
-                fallback_model = os.getenv('GEMINI_FALLBACK_MODEL') or 'gemini-2.5-flash'
-
-                gpt_resp = session.post(
-                    url,
-                    headers = headers,
-                    json = body,
-                    proxies = proxies,
-                    stream = True,
-                    timeout = 60,
-                )
-
-                # If we got a 404 (model not found) and the model isn't already
-                # the fallback, retry once with the fallback model.
-                if gpt_resp.status_code == 404 and model != fallback_model:
-                    try:
-                        err = gpt_resp.json()
-                    except Exception:
-                        err = gpt_resp.text
-                    print(f"Gemini model {model} not found (404). Retrying with fallback {fallback_model}: {err}")
-                    # rebuild URL for fallback
-                    fallback_url = f"https://generativelanguage.googleapis.com/v1beta/models/{fallback_model}:streamGenerateContent?alt=sse"
-                    gpt_resp = session.post(
-                        fallback_url,
-                        headers = headers,
-                        json = body,
-                        proxies = proxies,
-                        stream = True,
-                        timeout = 60,
-                    )
+            # Shared keep-alive session; it already carries the config.json
+            # proxy and ignores HTTP_PROXY/HTTPS_PROXY from the environment.
+            session = self.upstream.session
 
-                if gpt_resp.status_code >= 400:
-                    try:
-                        err = gpt_resp.json()
-                    except Exception:
-                        err = gpt_resp.text
-                    return {
-                        'successs': False,
-                        'message': f'Gemini request failed: {gpt_resp.status_code} {err}'
-                    }, gpt_resp.status_code
-
-                def stream():
-                    try:
-                        for raw_line in gpt_resp.iter_lines(decode_unicode=True):
-                            if not raw_line:
-                                continue
-                            line = raw_line.strip()
-                            # SSE format: lines start with 'data:'
-                            if line.startswith('data:'):
-                                payload_str = line.split('data:', 1)[1].strip()
-                                # some SSE implementations send '[DONE]' or empty data
-                                if payload_str in ('[DONE]', ''):
-                                    continue
-                                try:
-                                    payload = loads(payload_str)
-                                except Exception:
-                                    # non-JSON data; skip
-                                    continue
-
-                                candidates = payload.get('candidates', [])
-                                for cand in candidates:
-                                    content = cand.get('content', {})
-                                    parts = content.get('parts', [])
-                                    for p in parts:
-                                        text = p.get('text')
-                                        if text:
-                                            # Emit a proper SSE 'data:' framed event so
-                                            # clients reading the response as an Event
-                                            # Stream (or raw fetch stream) receive
-                                            # complete events. We JSON-encode the
-                                            # payload to safely transport newlines.
-                                            try:
-                                                s = dumps({'text': text})
-                                            except Exception:
-                                                s = dumps({'text': str(text)})
-                                            yield f"data: {s}\n\n"
-                    except GeneratorExit:
-                        return
-                    except Exception as e:
-                        print('Gemini stream error:', e)
-                        return
+            conversation, model, url, headers, body = self._prepare(payload, timer, deadline)
 
-                return self.app.response_class(stream(), mimetype='text/event-stream')
-
-            # ----------------------------
-            # OpenAI path (commented out while using Gemini)
-            # ----------------------------
-            # url = f"{self.openai_api_base}/v1/chat/completions"
-            #
-            # gpt_resp = post(
-            #     url     = url,
-            #     proxies = proxies,
-            #     headers = {
-            #         'Authorization': 'Bearer %s' % self.openai_key
-            #     }, 
-            #     json    = {
-            #         'model'             : request.json['model'], 
-            #         'messages'          : conversation,
-            #         'stream'            : True
-            #     },
-            #     stream  = True
-            # )
-            #
-            # if gpt_resp.status_code >= 400:
-            #     error_data =gpt_resp.json().get('error', {})
-            #     error_code = error_data.get('code', None)
-            #     error_message = error_data.get('message', "An error occurred")
-            #     return {
-            #         'successs': False,
-            #         'error_code': error_code,
-            #         'message': error_message,
-            #         'status_code': gpt_resp.status_code
-            #     }, gpt_resp.status_code
-            #
-            # def stream_openai():
-            #     for chunk in gpt_resp.iter_lines():
-            #         try:
-            #             decoded_line = loads(chunk.decode("utf-8").split("data: ")[1])
-            #             token = decoded_line["choices"][0]['delta'].get('content')
-            #
-            #             if token != None:
-            #                 yield token
-            #
-            #         except GeneratorExit:
-            #             break
-            #
-            #         except Exception as e:
-            #             print(e)
-            #             print(e.__traceback__.tb_next)
-            #             continue
-            #
-            # return self.app.response_class(stream_openai(), mimetype='text/event-stream')
+            # If a Gemini key is configured, call Gemini streaming endpoint.
+            if self.gemini_key or self.router is not None:
+                cache_key = None
+                if self.response_cache is not None:
+                    cache_key = request_fingerprint(model, body)
+                    with deadline.activate():
+                        cached = self._cached_response(cache_key)
+                    if cached is not None:
+                        self._record_answer(payload, cached)
+                        timer.finish('cache_hit')
+                        return self.app.response_class(iter([sse_event(cached)]), mimetype='text/event-stream')
+
+                # the same request already in flight: follow its generation
+                # (no admission slot, no upstream call) unless it fails
+                record = None
+                if self.coalescer is not None:
+                    record, leader = self.coalescer.acquire(coalesce_key(model, body),
+                                                            lambda: self._new_record(payload))
+                    if not leader:
+                        with timer.phase('coalesce_wait'):
+                            started = record.wait_started(deadline.budget('coalesce_wait', self.coalescer.wait))
+                        if started:
+                            self._follow(record, payload)
+                            timer.finish('coalesced')
+                            return self._tail(record, 0)
+                        self.coalescer.fallbacks += 1
+                        record = None
+
+                # wait for an upstream slot; the ticket is held until the
+                # response stream is closed
+                ticket = None
+                try:
+                    if self.admission is not None:
+                        ticket = self.admission.acquire(admission_key(payload),
+                                                        deadline.budget('admission_wait', self.admission.max_wait))
+                        timer.record('admission_wait', ticket.queued_for)
+                    # the client may have given up while queued
+                    sock = client_socket(request.environ)
+                    if self.disconnects is not None and sock is not None and client_gone(sock):
+                        if ticket is not None:
+                            ticket.release()
+                        if record is not None:
+                            record.fail()
+                        timer.finish('disconnected')
+                        return '', 499
+                    return self._generate(payload, session, model, url, headers, body,
+                                          conversation, cache_key, ticket, timer,
+                                          deadline, record)
+                except BaseException:
+                    if ticket is not None:
+                        ticket.release()
+                    if record is not None:
+                        # followers waiting on it generate themselves
+                        record.fail()
+                    raise
 
             # If no provider available
+            timer.finish('error')
             return {
                 '_action': '_ask',
                 'success': False,
-                "error": "No Gemini key configured and OpenAI path is disabled."
+                "error": "No Gemini key configured and no router provider is available."
             }, 400
 
+        except AdmissionRejected as e:
+            timer.finish('rejected')
+            return rejection_body(e), e.status, {'Retry-After': str(e.retry_after)}
+
+        except DeadlineExceeded as e:
+            timer.finish('deadline')
+            return deadline_body(e), e.status
+
         except Exception as e:
+            timer.finish('error')
             print(e)
             print(e.__traceback__.tb_next)
             return {
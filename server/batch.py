@@ -0,0 +1,507 @@
+#Batch jobs: conversation payloads from a JSONL file answered in parallel into a JSONL file
+
+import argparse
+import copy
+import fcntl
+import json
+import os
+import re
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import monotonic, time
+from uuid import uuid4
+
+import requests
+from flask import Response, request
+
+from server.admission import AdmissionRejected
+from server.cancellation import DeadlineExceeded
+from server.upstream import UpstreamError
+
+# Defaults for the optional "batch" block of config.json.
+BATCH_DEFAULTS = {
+    # the HTTP job endpoints; the command line runner works regardless
+    'enable': False,
+    # where uploaded jobs keep their input, output and state
+    'dir': 'batch_jobs',
+    # items answered at once per job (admission still caps the process)
+    'concurrency': 4,
+    # attempts after the first for retryable errors (429, 5xx, timeouts),
+    # `backoff` seconds doubling each time
+    'retries': 3,
+    'backoff': 2.0,
+    # largest JSONL upload accepted
+    'max_bytes': 50_000_000,
+}
+
+JOB_ID = re.compile(r'[0-9a-f]{12}')
+
+
+class BatchBusy(Exception):
+    """Another runner holds the job's output file."""
+
+
+def error_status(e: Exception) -> int:
+    """HTTP-style status recorded for a failed item."""
+    if isinstance(e, UpstreamError):
+        return e.status
+    if isinstance(e, DeadlineExceeded):
+        return e.status
+    if isinstance(e, (KeyError, TypeError, ValueError)):
+        # not shaped like a conversation payload
+        return 400
+    if isinstance(e, requests.RequestException):
+        return 502
+    return 500
+
+
+def retryable(status: int) -> bool:
+    return status == 429 or status >= 500
+
+
+def read_results(output_path: str) -> dict:
+    """custom_id -> status of its last complete line in an output file."""
+    results = {}
+    if not os.path.exists(output_path):
+        return results
+    with open(output_path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            results[item.get('custom_id')] = item.get('status')
+    return results
+
+
+def complete_length(path: str, block: int = 65536) -> int:
+    """Bytes of a file up to and including its last newline."""
+    with open(path, 'rb') as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - block)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+class BatchJob:
+    """
+    One pass over an input JSONL file of conversation payloads, the same
+    shape /backend-api/v2/conversation accepts. Every payload is answered
+    by `answer(payload, client)` (Backend_Api.complete) with at most
+    `concurrency` in flight, and one line per item is appended to the
+    output file as soon as it is done, in completion order. Items are
+    matched by their `custom_id` (default: line-<n>). Running again on the
+    same files resumes: items already answered are skipped, failed ones
+    are tried again, and readers should take the last line per custom_id.
+    """
+
+    def __init__(self, answer, input_path: str, output_path: str, client: str = 'batch',
+                 concurrency: int = 4, retries: int = 3, backoff: float = 2.0) -> None:
+        self.answer = answer
+        self.input_path = input_path
+        self.output_path = output_path
+        self.client = client
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.state = 'queued'
+        self.total = 0
+        self.skipped = 0
+        self.ok = 0
+        self.failed = 0
+        self.attempts = 0
+        self.started_at = None
+        self.finished_at = None
+        # the counters are written by the runner and pool threads and read by status()
+        self._lock = threading.Lock()
+
+    def _items(self):
+        """(line number, custom_id, payload or None when the line isn't a JSON object)."""
+        with open(self.input_path, 'rb') as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    payload = json.loads(line)
+                except ValueError:
+                    payload = None
+                if not isinstance(payload, dict):
+                    payload = None
+                custom_id = payload.get('custom_id') if payload is not None else None
+                yield line_no, str(custom_id or f'line-{line_no}'), payload
+
+    def _answered(self, out) -> set:
+        """custom_ids answered by an earlier run; a torn last line is cut off."""
+        answered = set()
+        out.seek(0)
+        end = 0
+        for line in out:
+            if not line.endswith(b'\n'):
+                break
+            end += len(line)
+            try:
+                item = json.loads(line)
+            except ValueError:
+                continue
+            if item.get('status') == 'ok':
+                answered.add(item.get('custom_id'))
+        out.truncate(end)
+        out.seek(end)
+        return answered
+
+    def _answer_one(self, line_no: int, custom_id: str, payload: dict, stop: threading.Event):
+        """The output line for one item, or None when the job was stopped first."""
+        started = monotonic()
+        result = {'custom_id': custom_id, 'line': line_no}
+        if payload is None:
+            return {**result, 'status': 'error', 'attempts': 0,
+                    'error': {'status': 400, 'message': 'line is not a JSON object'}}
+
+        attempts = 0
+        while True:
+            attempts += 1
+            with self._lock:
+                self.attempts += 1
+            try:
+                # the pipeline fills in history; start every attempt afresh
+                response = self.answer(copy.deepcopy(payload), self.client)
+                return {**result, 'status': 'ok', 'attempts': attempts,
+                        'elapsed': round(monotonic() - started, 3), 'response': response}
+            except AdmissionRejected as e:
+                # the process is busy with interactive traffic: wait, it's not a failed attempt
+                attempts -= 1
+                delay = e.retry_after
+            except Exception as e:
+                status = error_status(e)
+                if attempts > self.retries or not retryable(status):
+                    return {**result, 'status': 'error', 'attempts': attempts,
+                            'elapsed': round(monotonic() - started, 3),
+                            'error': {'status': status, 'message': str(e)}}
+                delay = min(60, self.backoff * 2 ** (attempts - 1))
+            if stop.wait(delay):
+                return None
+
+    def _write(self, out, result) -> None:
+        if result is None:
+            return
+        with self._lock:
+            if result['status'] == 'ok':
+                self.ok += 1
+            else:
+                self.failed += 1
+        out.write(json.dumps(result).encode() + b'\n')
+        out.flush()
+
+    def run(self, stop: threading.Event = None) -> dict:
+        """Answer every item not answered yet. Raises BatchBusy when another runner has the output file."""
+        stop = stop or threading.Event()
+        os.makedirs(os.path.dirname(os.path.abspath(self.output_path)), exist_ok=True)
+        with open(self.output_path, 'a+b') as out:
+            try:
+                fcntl.flock(out, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise BatchBusy(f'{self.output_path} is being written by another batch runner')
+            with self._lock:
+                self.state = 'running'
+                self.started_at = time()
+            answered = self._answered(out)
+
+            with ThreadPoolExecutor(self.concurrency, thread_name_prefix='batch') as pool:
+                pending = set()
+                for line_no, custom_id, payload in self._items():
+                    with self._lock:
+                        self.total += 1
+                        if custom_id in answered:
+                            self.skipped += 1
+                            continue
+                    if stop.is_set():
+                        continue
+                    # a bounded window, so a huge input isn't read into memory
+                    while len(pending) >= self.concurrency * 2:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            self._write(out, future.result())
+                    pending.add(pool.submit(self._answer_one, line_no, custom_id, payload, stop))
+                while pending:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        self._write(out, future.result())
+
+        with self._lock:
+            self.state = 'interrupted' if stop.is_set() else 'done'
+            self.finished_at = time()
+        return self.stats()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'total': self.total,
+                'skipped': self.skipped,
+                'ok': self.ok,
+                'failed': self.failed,
+                'attempts': self.attempts,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+
+class BatchJobs:
+    """
+    The HTTP side: uploaded JSONL inputs become jobs under `dir`/<id>/ that
+    run on a thread of the process that received them. Their state is in
+    the files, so any worker can report on a job, and one interrupted by
+    a restart is picked up again with POST .../resume.
+    """
+
+    def __init__(self, answer, dir: str = 'batch_jobs', concurrency: int = 4, retries: int = 3,
+                 backoff: float = 2.0, max_bytes: int = 50_000_000) -> None:
+        self.answer = answer
+        self.dir = dir
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_bytes = max_bytes
+        self._running = {}      # job id -> BatchJob
+        self._lock = threading.Lock()
+        self.created = 0
+        self.items_ok = 0
+        self.items_failed = 0
+        self.routes = {
+            '/backend-api/v2/batch': {
+                'function': self._create,
+                'methods': ['POST']
+            },
+            '/backend-api/v2/batch/<job_id>': {
+                'function': self._status,
+                'methods': ['GET']
+            },
+            '/backend-api/v2/batch/<job_id>/output': {
+                'function': self._output,
+                'methods': ['GET']
+            },
+            '/backend-api/v2/batch/<job_id>/resume': {
+                'function': self._resume,
+                'methods': ['POST']
+            },
+        }
+
+    def _path(self, job_id: str, name: str) -> str:
+        return os.path.join(self.dir, job_id, name)
+
+    def _exists(self, job_id: str) -> bool:
+        return JOB_ID.fullmatch(job_id) is not None and os.path.exists(self._path(job_id, 'job.json'))
+
+    def _save(self, job_id: str, **fields) -> None:
+        path = self._path(job_id, 'job.json')
+        state = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+        state.update(fields)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    def start(self, job_id: str) -> bool:
+        """Run (or resume) a job on a thread of this process; False when it is already running."""
+        with open(self._path(job_id, 'job.json')) as f:
+            options = json.load(f)
+        job = BatchJob(self.answer, self._path(job_id, 'input.jsonl'), self._path(job_id, 'output.jsonl'),
+                       client=f'batch:{job_id}', concurrency=options.get('concurrency', self.concurrency),
+                       retries=self.retries, backoff=self.backoff)
+        with self._lock:
+            if job_id in self._running or self._locked(job_id):
+                return False
+            self._running[job_id] = job
+
+        def run() -> None:
+            try:
+                stats = job.run()
+                self._save(job_id, **stats)
+            except BatchBusy:
+                pass
+            except Exception as e:
+                print(f'Batch job {job_id} failed: {e}')
+                self._save(job_id, state='failed', error=str(e))
+            finally:
+                stats = job.stats()
+                with self._lock:
+                    self.items_ok += stats['ok']
+                    self.items_failed += stats['failed']
+                    self._running.pop(job_id, None)
+
+        self._save(job_id, state='running', started_at=time())
+        threading.Thread(target=run, name=f'batch-{job_id}', daemon=True).start()
+        return True
+
+    def _locked(self, job_id: str) -> bool:
+        """True while a runner (in any process on this host) holds the job's output file."""
+        path = self._path(job_id, 'output.jsonl')
+        if not os.path.exists(path):
+            return False
+        with open(path, 'rb') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+        return False
+
+    def status(self, job_id: str) -> dict:
+        with open(self._path(job_id, 'job.json')) as f:
+            state = json.load(f)
+        with open(self._path(job_id, 'input.jsonl'), 'rb') as f:
+            total = sum(1 for line in f if line.strip())
+        with self._lock:
+            job = self._running.get(job_id)
+        if job is not None:
+            stats = job.stats()
+            return {**state, **stats, 'id': job_id, 'total': total,
+                    'remaining': total - stats['skipped'] - stats['ok'] - stats['failed']}
+        results = read_results(self._path(job_id, 'output.jsonl'))
+        ok = sum(1 for status in results.values() if status == 'ok')
+        if state.get('state') == 'running' and not self._locked(job_id):
+            # its process went away mid-run
+            state['state'] = 'interrupted'
+        return {**state, 'id': job_id, 'total': total, 'ok': ok, 'failed': len(results) - ok,
+                'remaining': total - len(results)}
+
+    def _create(self):
+        if request.content_length and request.content_length > self.max_bytes:
+            return {'success': False, 'error': f'Batch input is larger than {self.max_bytes} bytes'}, 413
+        data = request.get_data()
+        if not data.strip():
+            return {'success': False, 'error': 'Send the conversation payloads as JSONL in the request body'}, 400
+        job_id = uuid4().hex[:12]
+        os.makedirs(os.path.join(self.dir, job_id))
+        with open(self._path(job_id, 'input.jsonl'), 'wb') as f:
+            f.write(data)
+        # a job may ask for fewer items in flight than configured, never more
+        concurrency = request.args.get('concurrency', type=int) or self.concurrency
+        self._save(job_id, created_at=time(), concurrency=min(max(1, concurrency), self.concurrency), state='queued')
+        with self._lock:
+            self.created += 1
+        output = f'/backend-api/v2/batch/{job_id}/output'
+        if not self.start(job_id):
+            # still queued; POST .../resume starts it
+            return {**self.status(job_id), 'output': output, 'success': False,
+                    'error': 'The batch job could not be started yet, resume it later'}, 409
+        return {**self.status(job_id), 'output': output}, 202
+
+    def _status(self, job_id: str):
+        if not self._exists(job_id):
+            return {'success': False, 'error': 'Unknown batch job'}, 404
+        return self.status(job_id)
+
+    def _output(self, job_id: str):
+        path = self._path(job_id, 'output.jsonl')
+        if not self._exists(job_id) or not os.path.exists(path):
+            return {'success': False, 'error': 'No output for this batch job yet'}, 404
+        # complete lines only: a running job may be halfway through writing the last one
+        length = complete_length(path)
+
+        def lines():
+            with open(path, 'rb') as f:
+                remaining = length
+                while remaining > 0:
+                    chunk = f.read(min(65536, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+
+        return Response(lines(), mimetype='application/x-ndjson', headers={'Content-Length': str(length)})
+
+    def _resume(self, job_id: str):
+        if not self._exists(job_id):
+            return {'success': False, 'error': 'Unknown batch job'}, 404
+        if not self.start(job_id):
+            return {**self.status(job_id), 'success': False, 'error': 'The batch job is already running'}, 409
+        return self.status(job_id), 202
+
+    def stats(self) -> dict:
+        with self._lock:
+            running = [job.stats() for job in self._running.values()]
+            return {
+                'running': len(running),
+                'created': self.created,
+                'items_ok': self.items_ok + sum(stats['ok'] for stats in running),
+                'items_failed': self.items_failed + sum(stats['failed'] for stats in running),
+            }
+
+
+def create_batch_jobs(options: dict, answer):
+    """Build the HTTP batch job runner, or None when the endpoints are disabled."""
+    options = {**BATCH_DEFAULTS, **options}
+    if not options.pop('enable'):
+        return None
+    return BatchJobs(answer, **options)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description='Answer a JSONL file of conversation payloads into a JSONL file; rerun to resume.')
+    parser.add_argument('input', help='one /backend-api/v2/conversation payload per line')
+    parser.add_argument('output', help='results are appended here as they finish')
+    parser.add_argument('--config', default=os.getenv('CONFIG_PATH') or 'config.json')
+    parser.add_argument('--concurrency', type=int, help='items in flight (default: batch.concurrency)')
+    parser.add_argument('--retries', type=int, help='retries per item (default: batch.retries)')
+    parser.add_argument('--restart', action='store_true', help='discard earlier output instead of resuming')
+    args = parser.parse_args(argv)
+
+    from server.app import app
+    from server.backend import Backend_Api
+
+    with open(args.config) as f:
+        config = json.load(f)
+    options = {**BATCH_DEFAULTS, **config.get('batch', {})}
+    backend = Backend_Api(app, config, start_background=False)
+    if args.restart and os.path.exists(args.output):
+        os.remove(args.output)
+
+    job = BatchJob(backend.complete, args.input, args.output,
+                   concurrency=args.concurrency or options['concurrency'],
+                   retries=options['retries'] if args.retries is None else args.retries,
+                   backoff=options['backoff'])
+    stop = threading.Event()
+    finished = threading.Event()
+    errors = []
+
+    def run() -> None:
+        try:
+            job.run(stop)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            finished.set()
+
+    # the main thread only waits, so Ctrl-C reaches it and stops the job cleanly
+    threading.Thread(target=run, name='batch', daemon=True).start()
+    try:
+        while not finished.wait(5):
+            stats = job.stats()
+            print(f"{stats['ok'] + stats['failed'] + stats['skipped']} done ({stats['ok']} ok, "
+                  f"{stats['failed']} failed, {stats['skipped']} from an earlier run)", file=sys.stderr)
+    except KeyboardInterrupt:
+        print('Stopping after the items in flight; run again to resume', file=sys.stderr)
+        stop.set()
+        finished.wait()
+    if errors:
+        print(f'Batch failed: {errors[0]}', file=sys.stderr)
+        return 2
+    stats = job.stats()
+    print(json.dumps(stats))
+    return 0 if stats['state'] == 'done' and not stats['failed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
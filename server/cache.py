@@ -0,0 +1,170 @@
+#Opt-in cache of completed model responses, keyed on the full request fingerprint
+
+import threading
+from collections import OrderedDict
+from time import time
+
+from server.pool import get_db_cursor
+
+# Defaults for the optional "response_cache" block of config.json.
+RESPONSE_CACHE_DEFAULTS = {
+    'enable': False,
+    # "memory" (per process) or "postgres" (shared by every worker)
+    'backend': 'memory',
+    'ttl': 86400,
+    'max_entries': 1000,
+    # memory backend only: total size of cached response text
+    'max_bytes': 50_000_000,
+}
+
+
+class MemoryResponseCache:
+    """Per-process LRU of response texts bounded by entry count and bytes."""
+
+    # get()/put() never block, safe to call from the event loop
+    blocking = False
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (expires_at, text)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time():
+                if entry is not None:
+                    self._pop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, model: str, text: str) -> None:
+        size = len(text)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (time() + self.ttl, text)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key: str) -> None:
+        _, text = self._entries.pop(key)
+        self._bytes -= len(text)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class PostgresResponseCache:
+    """
+    Response cache shared by all workers through the response_cache table.
+    Expired and least recently used rows beyond `max_entries` are pruned
+    every `prune_every` writes.
+    """
+
+    blocking = True
+
+    TABLE_SQL = """
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key          CHAR(64) PRIMARY KEY,
+            model        TEXT NOT NULL,
+            response     TEXT NOT NULL,
+            created_at   TIMESTAMPTZ NOT NULL DEFAULT now(),
+            last_hit_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+            hits         INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS response_cache_last_hit_at ON response_cache (last_hit_at);
+    """
+
+    def __init__(self, ttl: float, max_entries: int, prune_every: int = 100, **_) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self._writes = 0
+        self._ready = False
+        self.hits = 0
+        self.misses = 0
+
+    def _ensure_table(self, cur) -> None:
+        if not self._ready:
+            cur.execute(self.TABLE_SQL)
+            self._ready = True
+
+    def get(self, key: str):
+        with get_db_cursor(dict_cursor=False) as (conn, cur):
+            self._ensure_table(cur)
+            cur.execute(
+                "UPDATE response_cache SET hits = hits + 1, last_hit_at = now() "
+                "WHERE key = %s AND created_at > now() - make_interval(secs => %s) "
+                "RETURNING response",
+                (key, self.ttl),
+            )
+            row = cur.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key: str, model: str, text: str) -> None:
+        with get_db_cursor(dict_cursor=False) as (conn, cur):
+            self._ensure_table(cur)
+            cur.execute(
+                "INSERT INTO response_cache (key, model, response) VALUES (%s, %s, %s) "
+                "ON CONFLICT (key) DO UPDATE SET response = EXCLUDED.response, "
+                "created_at = now(), last_hit_at = now()",
+                (key, model, text),
+            )
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                cur.execute(
+                    "DELETE FROM response_cache WHERE created_at <= now() - make_interval(secs => %s)",
+                    (self.ttl,),
+                )
+                cur.execute(
+                    "DELETE FROM response_cache WHERE key IN ("
+                    "SELECT key FROM response_cache ORDER BY last_hit_at DESC OFFSET %s)",
+                    (self.max_entries,),
+                )
+
+    def stats(self) -> dict:
+        return {
+            'backend': 'postgres',
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+RESPONSE_CACHE_BACKENDS = {
+    'memory': MemoryResponseCache,
+    'postgres': PostgresResponseCache,
+}
+
+
+def create_response_cache(options: dict):
+    """Build the configured response cache, or None when it is disabled."""
+    options = {**RESPONSE_CACHE_DEFAULTS, **options}
+    if not options.pop('enable'):
+        return None
+    backend = options.pop('backend')
+    if backend not in RESPONSE_CACHE_BACKENDS:
+        raise ValueError(f'unknown response_cache backend {backend!r}')
+    return RESPONSE_CACHE_BACKENDS[backend](**options)
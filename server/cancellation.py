@@ -0,0 +1,266 @@
+#Per-request deadlines and early cancellation of upstream streams when the client goes away
+
+import selectors
+import socket
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from math import inf
+from time import monotonic
+
+from server.metrics import registry
+
+# Defaults for the optional "cancellation" block of config.json.
+CANCELLATION_DEFAULTS = {
+    'enable': True,
+    # budget for a whole conversation request, from arrival to the last
+    # streamed byte (0 = no limit); the phases below each get their own cap
+    # and never more than what is left of it. Search is capped by
+    # search.timeout, generation gets the rest.
+    'deadline': 300,
+    # database work on the request path (pool checkout and each statement)
+    'db': 2,
+    # until the model answers with response headers
+    'connect': 60,
+    # how often open streams are checked for a closed client or a passed deadline
+    'poll_interval': 0.25,
+}
+
+CANCELLATIONS = registry.counter(
+    'upstream_cancellations_total', 'Upstream generations stopped before they were complete', ('reason',))
+
+_current_deadline = ContextVar('deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    """Nothing is left of the request's time budget."""
+
+    status = 504
+
+
+class Deadline:
+    """
+    Time budget of one request. budget() hands a phase its cap, bounded by
+    what is left, so an early slow phase shortens the later ones instead of
+    pushing the request past the deadline.
+    """
+
+    def __init__(self, seconds: float = 0, db: float = None, connect: float = 60) -> None:
+        self.expires_at = monotonic() + seconds if seconds else inf
+        self.db = db
+        self.connect = connect
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - monotonic())
+
+    def budget(self, phase: str, cap: float = None) -> float:
+        """Seconds `phase` may take. Raises DeadlineExceeded when the deadline has passed."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f'Request deadline passed before {phase}')
+        return remaining if not cap else min(cap, remaining)
+
+    @contextmanager
+    def activate(self):
+        """Make this the deadline db_budget() sees in the current thread or task (and threads started from it)."""
+        token = _current_deadline.set(self)
+        try:
+            yield self
+        finally:
+            _current_deadline.reset(token)
+
+
+def db_budget():
+    """Seconds database work may take under the active request deadline, or None outside a request."""
+    deadline = _current_deadline.get()
+    if deadline is None or (deadline.db is None and deadline.expires_at == inf):
+        return None
+    return deadline.budget('database access', deadline.db)
+
+
+def client_socket(environ: dict):
+    """The client connection of a WSGI request, where the server exposes it (gunicorn, werkzeug)."""
+    return environ.get('gunicorn.socket') or environ.get('werkzeug.socket')
+
+
+def client_gone(sock) -> bool:
+    """Non-blocking check whether the peer closed `sock`. Unread request data counts as still connected."""
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except ValueError:
+        # TLS sockets can't peek; treat them as connected
+        return False
+    except OSError:
+        return True
+
+
+def abort_response(resp) -> None:
+    """
+    Stop a requests streaming response that another thread may be reading.
+    Closing alone doesn't wake a blocked recv(); shutting the socket down
+    does, the reader fails at once, and its close() frees the pool slot.
+    """
+    connection = getattr(resp.raw, 'connection', None)
+    sock = getattr(connection, 'sock', None)
+    if sock is None:
+        resp.close()
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class Watch:
+    """One stream registered with the DisconnectMonitor."""
+
+    __slots__ = ('monitor', 'sock', 'expires_at', 'on_cancel', 'reason', 'closed')
+
+    def __init__(self, monitor, sock, expires_at: float, on_cancel) -> None:
+        self.monitor = monitor
+        self.sock = sock
+        self.expires_at = expires_at
+        self.on_cancel = on_cancel
+        self.reason = None
+        self.closed = False
+
+    def cancel(self, reason: str) -> None:
+        """Run on_cancel once with 'disconnect' or 'deadline', unless the stream already ended."""
+        with self.monitor._lock:
+            if self.closed or self.reason is not None:
+                return
+            self.reason = reason
+        try:
+            self.on_cancel(reason)
+        except Exception as e:
+            print(f'Cancelling a stream ({reason}) failed: {e}')
+
+    def close(self) -> None:
+        """The stream is over; stop watching. Safe to call more than once."""
+        self.monitor._remove(self)
+
+
+class DisconnectMonitor:
+    """
+    One background thread watching the client sockets of open streams. A
+    stream blocked waiting for the next upstream chunk would only notice a
+    closed client on its next write; the monitor notices within
+    `poll_interval`, and also when a request runs past its deadline, and
+    calls the stream's on_cancel so the upstream response is aborted, its
+    connection slot and admission ticket freed right away.
+    """
+
+    def __init__(self, poll_interval: float = 0.25) -> None:
+        self.poll_interval = poll_interval
+        self._selector = selectors.DefaultSelector()
+        self._watches = set()
+        self._added = []
+        self._removed = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.watched = 0
+        self.disconnects = 0
+        self.deadlines = 0
+
+    def watch(self, sock, deadline: Deadline, on_cancel) -> Watch:
+        """Start watching a stream; `sock` may be None when the server doesn't expose it (deadline only)."""
+        watch = Watch(self, sock, deadline.expires_at, on_cancel)
+        with self._lock:
+            self._added.append(watch)
+            self.watched += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='disconnect-monitor', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return watch
+
+    def _remove(self, watch: Watch) -> None:
+        with self._lock:
+            if watch.closed:
+                return
+            watch.closed = True
+            self._removed.append(watch)
+
+    def _apply_changes(self) -> None:
+        # the selector is only touched from the monitor thread
+        with self._lock:
+            added, self._added = self._added, []
+            removed, self._removed = self._removed, []
+        # removals first: a keep-alive connection's next request may be
+        # registering the same socket
+        for watch in removed:
+            self._forget(watch)
+        for watch in added:
+            if watch.closed:
+                continue
+            self._watches.add(watch)
+            if watch.sock is not None:
+                try:
+                    self._selector.register(watch.sock, selectors.EVENT_READ, watch)
+                except (ValueError, OSError, KeyError):
+                    # closed already; only the deadline is left to watch
+                    watch.sock = None
+
+    def _forget(self, watch: Watch) -> None:
+        self._watches.discard(watch)
+        self._unregister(watch)
+
+    def _unregister(self, watch: Watch) -> None:
+        if watch.sock is not None:
+            try:
+                self._selector.unregister(watch.sock)
+            except (KeyError, ValueError, OSError):
+                pass
+            watch.sock = None
+
+    def _run(self) -> None:
+        while True:
+            self._apply_changes()
+            if not self._watches:
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+
+            if self._selector.get_map():
+                events = self._selector.select(self.poll_interval)
+            else:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                events = ()
+
+            for key, _ in events:
+                watch = key.data
+                if client_gone(key.fileobj):
+                    self.disconnects += 1
+                    watch.cancel('disconnect')
+                    self._forget(watch)
+                else:
+                    # unread data (a pipelined request) would wake the loop
+                    # constantly; keep watching only the deadline
+                    self._unregister(watch)
+
+            now = monotonic()
+            for watch in [w for w in self._watches if w.expires_at <= now]:
+                self.deadlines += 1
+                watch.cancel('deadline')
+                self._forget(watch)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'active': len(self._watches),
+                'watched': self.watched,
+                'disconnects': self.disconnects,
+                'deadlines': self.deadlines,
+            }
+
+
+def create_disconnect_monitor(options: dict):
+    """Build the configured monitor, or None when cancellation is disabled."""
+    options = {**CANCELLATION_DEFAULTS, **options}
+    if not options['enable']:
+        return None
+    return DisconnectMonitor(options['poll_interval'])
@@ -0,0 +1,210 @@
+#Gemini context caching (cachedContents) for the static system instruction prefix
+
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps
+from time import time
+
+from server.database import ModelConfig
+from server.history import estimate_tokens
+
+# Defaults for the optional "context_cache" block of config.json.
+CONTEXT_CACHE_DEFAULTS = {
+    'enable': False,
+    # lifetime requested for each cached content (seconds)
+    'ttl': 3600,
+    # extend a handle's ttl once less than this is left
+    'refresh_margin': 300,
+    # prefixes estimated below this are always sent inline; Gemini rejects
+    # caches under its per-model minimum (1024-4096 tokens)
+    'min_tokens': 1024,
+    # handles kept; older ones are deleted upstream
+    'max_entries': 32,
+    # after a failed create, send that prefix inline for this long
+    'retry_after': 600,
+}
+
+
+class _Entry:
+    __slots__ = ('name', 'expires_at', 'failed_until', 'refreshing')
+
+    def __init__(self) -> None:
+        self.name = None
+        self.expires_at = 0.0
+        self.failed_until = 0.0
+        self.refreshing = False
+
+
+class ContextCache:
+    """
+    Keeps Gemini cachedContents handles for the static start of a request:
+    the systemInstruction (persona, date, team skills) and the jailbreak
+    prelude. Handles are keyed by a hash of the model and that prefix, so a
+    change of the skills data or the date simply produces a new key.
+
+    apply() never blocks: an unknown prefix is sent inline while its handle
+    is created in the background, and handles close to expiry are extended
+    in the background. Failed creates (unsupported model, prefix below the
+    minimum size) are remembered and the prefix is sent inline.
+    """
+
+    def __init__(self, session, api_key: str, ttl: float = 3600, refresh_margin: float = 300,
+                 min_tokens: int = 1024, max_entries: int = 32, retry_after: float = 600) -> None:
+        self.session = session
+        self.api_key = api_key
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_tokens = min_tokens
+        self.max_entries = max_entries
+        self.retry_after = retry_after
+        self._entries = OrderedDict()   # key -> _Entry
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.create_failures = 0
+        self.refreshed = 0
+        self.invalidated = 0
+
+    def _headers(self) -> dict:
+        return {'Content-Type': 'application/json', 'x-goog-api-key': self.api_key}
+
+    def apply(self, model: str, body: dict, static_contents: int = 0) -> tuple:
+        """
+        Returns (body to send, cache key or None). With a live handle the
+        systemInstruction and the first `static_contents` contents are
+        replaced by a cachedContent reference.
+        """
+        prefix = {
+            'systemInstruction': body.get('systemInstruction'),
+            'contents': body['contents'][:static_contents],
+        }
+        text = ''.join(part.get('text', '') for part in (prefix['systemInstruction'] or {}).get('parts', []))
+        text += ''.join(part.get('text', '') for c in prefix['contents'] for part in c.get('parts', []))
+        if estimate_tokens(text) < self.min_tokens:
+            return body, None
+
+        key = sha256(dumps([model, prefix], sort_keys=True).encode()).hexdigest()
+        now = time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Entry()
+                entry.refreshing = True
+                self._evict()
+                start = 'create'
+            elif entry.refreshing or entry.failed_until > now:
+                start = None
+            elif entry.name is None or entry.expires_at <= now:
+                entry.refreshing = True
+                start = 'create'
+            elif entry.expires_at - now < self.refresh_margin:
+                entry.refreshing = True
+                start = 'refresh'
+            else:
+                start = None
+            self._entries.move_to_end(key)
+            name = entry.name if entry.expires_at > now else None
+
+        if start == 'create':
+            self._background(self._create, key, entry, model, prefix)
+        elif start == 'refresh':
+            self._background(self._refresh, entry)
+
+        if name is None:
+            self.misses += 1
+            return body, None
+        self.hits += 1
+        cached = {k: v for k, v in body.items() if k != 'systemInstruction'}
+        cached['contents'] = body['contents'][static_contents:]
+        cached['cachedContent'] = name
+        return cached, key
+
+    def invalidate(self, key: str) -> None:
+        """Forget a handle the API no longer accepts; the next request recreates it."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.invalidated += 1
+
+    def _background(self, fn, *args) -> None:
+        threading.Thread(target=fn, args=args, name='context-cache', daemon=True).start()
+
+    def _create(self, key: str, entry: _Entry, model: str, prefix: dict) -> None:
+        try:
+            resp = self.session.post(
+                ModelConfig.build_gemini_cache_url(),
+                headers = self._headers(),
+                json = {
+                    'model': f'models/{model}',
+                    **{k: v for k, v in prefix.items() if v},
+                    'ttl': f'{int(self.ttl)}s',
+                },
+                timeout = 30,
+            )
+            if resp.status_code >= 400:
+                raise RuntimeError(f'{resp.status_code} {resp.text[:200]}')
+            entry.name = resp.json()['name']
+            # the request above took a while; don't trust the last seconds
+            entry.expires_at = time() + self.ttl - 30
+            self.created += 1
+        except Exception as e:
+            entry.failed_until = time() + self.retry_after
+            self.create_failures += 1
+            print(f'Context cache create for {model} failed, sending the prompt inline: {e}')
+        finally:
+            entry.refreshing = False
+
+    def _refresh(self, entry: _Entry) -> None:
+        try:
+            resp = self.session.patch(
+                ModelConfig.build_gemini_cache_url(entry.name),
+                params = {'updateMask': 'ttl'},
+                headers = self._headers(),
+                json = {'ttl': f'{int(self.ttl)}s'},
+                timeout = 30,
+            )
+            if resp.status_code >= 400:
+                raise RuntimeError(f'{resp.status_code} {resp.text[:200]}')
+            entry.expires_at = time() + self.ttl - 30
+            self.refreshed += 1
+        except Exception as e:
+            # let it run out; the next request after expiry creates a new one
+            print(f'Context cache refresh of {entry.name} failed: {e}')
+        finally:
+            entry.refreshing = False
+
+    def _delete(self, name: str) -> None:
+        try:
+            self.session.delete(ModelConfig.build_gemini_cache_url(name), headers=self._headers(), timeout=30).close()
+        except Exception as e:
+            print(f'Context cache delete of {name} failed: {e}')
+
+    def _evict(self) -> None:
+        # caller holds the lock
+        while len(self._entries) > self.max_entries:
+            _, entry = self._entries.popitem(last=False)
+            if entry.name is not None and entry.expires_at > time():
+                self._background(self._delete, entry.name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            live = sum(1 for e in self._entries.values() if e.name is not None and e.expires_at > time())
+        return {
+            'handles': live,
+            'hits': self.hits,
+            'misses': self.misses,
+            'created': self.created,
+            'create_failures': self.create_failures,
+            'refreshed': self.refreshed,
+            'invalidated': self.invalidated,
+        }
+
+
+def create_context_cache(options: dict, session, api_key: str):
+    """Build the configured context cache, or None when it is disabled or there is no Gemini key."""
+    options = {**CONTEXT_CACHE_DEFAULTS, **options}
+    if not options.pop('enable') or not api_key:
+        return None
+    return ContextCache(session, api_key, **options)
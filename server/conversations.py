@@ -0,0 +1,206 @@
+#Server-side conversation store with write-behind batching of new messages
+
+import atexit
+import threading
+from collections import deque
+
+from psycopg2.extras import execute_values
+
+from server.pool import get_db_cursor
+
+# Defaults for the optional "conversation_store" block of config.json.
+CONVERSATION_STORE_DEFAULTS = {
+    'enable': False,
+    # most messages written per INSERT, and how long the writer waits to
+    # let a batch fill up
+    'batch_size': 200,
+    'flush_interval': 0.05,
+    # messages loaded per conversation (newest kept)
+    'max_history': 500,
+}
+
+CONVERSATION_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS conversations (
+        id          TEXT PRIMARY KEY,
+        user_id     TEXT,
+        created_at  TIMESTAMPTZ NOT NULL DEFAULT now(),
+        updated_at  TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE TABLE IF NOT EXISTS conversation_messages (
+        id               BIGSERIAL PRIMARY KEY,
+        conversation_id  TEXT NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+        role             TEXT NOT NULL,
+        content          TEXT NOT NULL,
+        created_at       TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE INDEX IF NOT EXISTS conversation_messages_conversation
+        ON conversation_messages (conversation_id, id);
+"""
+
+
+class ConversationStore:
+    """
+    Postgres-backed history keyed by the chat ids the site hands out.
+
+    append() only queues the messages; a writer thread drains the queue every
+    `flush_interval` seconds and writes up to `batch_size` messages with one
+    multi-row INSERT, so streaming responses never wait on the database.
+    Messages still queued are merged into history() so a follow-up request
+    sees them before they are flushed.
+
+    A conversation belongs to the user id that first wrote to it. history()
+    returns nothing to anyone else, and their messages are dropped when the
+    batch is written, so a known or guessed chat id reveals nothing.
+    """
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 0.05, max_history: int = 500) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_history = max_history
+
+        self._queue = deque()     # (conversation_id, user_id, message)
+        self._pending = {}        # conversation_id -> [(user_id, message), ...] not yet written
+        self._cond = threading.Condition()
+        # held while a batch is committed and its messages leave _pending, so
+        # history() never sees a message both in the table and the queue
+        self._flush_lock = threading.Lock()
+        self._ready = False
+        self._writer = None
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+
+    def _ensure_schema(self) -> None:
+        if not self._ready:
+            with get_db_cursor(dict_cursor=False) as (conn, cur):
+                cur.execute(CONVERSATION_SCHEMA_SQL)
+            self._ready = True
+
+    def start(self) -> None:
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run, name='conversation-writer', daemon=True)
+            self._writer.start()
+            # the writer is a daemon thread; drain what's queued on exit
+            atexit.register(self.flush)
+
+    def append(self, conversation_id: str, messages: list, user_id: str = None) -> None:
+        """Queue `messages` ({'role', 'content'} dicts) for writing, in order."""
+        if not conversation_id:
+            return
+        with self._cond:
+            for message in messages:
+                self._queue.append((conversation_id, user_id, message))
+                self._pending.setdefault(conversation_id, []).append((user_id, message))
+            self._cond.notify()
+        self.start()
+
+    def history(self, conversation_id: str, user_id: str = None) -> list:
+        """Messages of `user_id`'s conversation, oldest first, including ones still queued."""
+        self._ensure_schema()
+        with self._flush_lock:
+            with get_db_cursor(dict_cursor=False) as (conn, cur):
+                cur.execute(
+                    "SELECT role, content FROM ("
+                    "SELECT m.id, m.role, m.content FROM conversation_messages m "
+                    "JOIN conversations c ON c.id = m.conversation_id "
+                    "WHERE m.conversation_id = %s AND c.user_id IS NOT DISTINCT FROM %s "
+                    "ORDER BY m.id DESC LIMIT %s) newest ORDER BY id",
+                    (conversation_id, user_id, self.max_history),
+                )
+                rows = cur.fetchall()
+            with self._cond:
+                pending = [message for owner, message in self._pending.get(conversation_id, ()) if owner == user_id]
+
+        messages = [{'role': role, 'content': content} for role, content in rows] + pending
+        return messages[-self.max_history:]
+
+    def _take_batch(self) -> list:
+        with self._cond:
+            while not self._queue:
+                self._cond.wait()
+        # let concurrent streams add to this batch
+        threading.Event().wait(self.flush_interval)
+        with self._cond:
+            count = min(self.batch_size, len(self._queue))
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _write(self, batch: list) -> None:
+        self._ensure_schema()
+        conversations = {}
+        for conversation_id, user_id, _ in batch:
+            # a new conversation belongs to its first writer
+            conversations.setdefault(conversation_id, user_id)
+
+        with self._flush_lock:
+            with get_db_cursor(dict_cursor=False) as (conn, cur):
+                execute_values(
+                    cur,
+                    "INSERT INTO conversations (id, user_id) VALUES %s "
+                    "ON CONFLICT (id) DO UPDATE SET updated_at = now() "
+                    "WHERE conversations.user_id IS NOT DISTINCT FROM EXCLUDED.user_id",
+                    list(conversations.items()),
+                )
+                # messages from anyone but the owner are dropped
+                execute_values(
+                    cur,
+                    "INSERT INTO conversation_messages (conversation_id, role, content) "
+                    "SELECT v.conversation_id, v.role, v.content "
+                    "FROM (VALUES %s) v (position, conversation_id, user_id, role, content) "
+                    "JOIN conversations c ON c.id = v.conversation_id "
+                    "AND c.user_id IS NOT DISTINCT FROM v.user_id "
+                    "ORDER BY v.position",
+                    [(position, conversation_id, user_id, m['role'], m['content'])
+                     for position, (conversation_id, user_id, m) in enumerate(batch)],
+                )
+            with self._cond:
+                for conversation_id, user_id, message in batch:
+                    pending = self._pending.get(conversation_id)
+                    if pending:
+                        pending.remove((user_id, message))
+                        if not pending:
+                            del self._pending[conversation_id]
+
+    def _run(self) -> None:
+        while True:
+            batch = self._take_batch()
+            try:
+                self._write(batch)
+                self.written += len(batch)
+                self.batches += 1
+            except Exception as e:
+                self.failures += 1
+                print(f'Conversation store write failed, retrying {len(batch)} messages: {e}')
+                with self._cond:
+                    self._queue.extendleft(reversed(batch))
+                threading.Event().wait(1)
+
+    def flush(self, timeout: float = 5) -> bool:
+        """Wait until every queued message has been written. Returns False on timeout."""
+        deadline = threading.Event()
+        waited = 0.0
+        while True:
+            with self._cond:
+                if not self._queue and not self._pending:
+                    return True
+            if waited >= timeout:
+                return False
+            deadline.wait(0.05)
+            waited += 0.05
+
+    def stats(self) -> dict:
+        with self._cond:
+            queued = len(self._queue)
+        return {
+            'queued': queued,
+            'written': self.written,
+            'batches': self.batches,
+            'failures': self.failures,
+        }
+
+
+def create_conversation_store(options: dict):
+    """Build the configured conversation store, or None when it is disabled."""
+    options = {**CONVERSATION_STORE_DEFAULTS, **options}
+    if not options.pop('enable'):
+        return None
+    return ConversationStore(**options)
@@ -1,6 +1,9 @@
 #Database module for model config and management
 
 import os
+import threading
+from collections import OrderedDict
+from time import time
 from typing import Optional, Dict, Any
 from dotenv import load_dotenv
 
@@ -9,11 +12,22 @@ load_dotenv()
 #Centralized model configuration management
 class ModelConfig:
     DEFAULT_GEMINI_MODEL = 'gemini-2.5-flash'
-    GEMINI_API_BASE_URL = 'https://generativelanguage.googleapis.com/v1beta'
+    GEMINI_API_BASE_URL = os.getenv('GEMINI_API_BASE') or 'https://generativelanguage.googleapis.com/v1beta'
     GEMINI_STREAM_ENDPOINT = 'streamGenerateContent'
+    GEMINI_GENERATE_ENDPOINT = 'generateContent'
+
+    # Estimated tokens of conversation history forwarded per request. Older
+    # turns beyond the budget are dropped or summarized (see server/history.py).
+    HISTORY_TOKEN_BUDGETS = {
+        'gemini-2.5-pro': 64000,
+        'gemini-2.5-flash': 32000,
+        'gemini-2.5-flash-lite': 16000,
+        'gemini-2.0-flash': 16000,
+    }
+    DEFAULT_HISTORY_TOKEN_BUDGET = 16000
 
     #Extracts and validates the model name from request data, normalizing it with defaults
-    @static method
+    @staticmethod
     def get_model_name(request_data: Dict[str, Any]) -> str:
         model = request_data.get('model', ModelConfig.DEFAULT_GEMINI_MODEL)
 
@@ -26,21 +40,45 @@ class ModelConfig:
 
 
     #Retrieves fallback model name from environment or uses default
-    @static method
+    @staticmethod
     def get_fallback_model() -> str:
-        return os.get env('GEMINI_FALLBACK_MODEL') or ModelConfig.DEFAULT_GEMINI_MODEL
+        return os.getenv('GEMINI_FALLBACK_MODEL') or ModelConfig.DEFAULT_GEMINI_MODEL
+
+
+    #Returns the history token budget for a model; HISTORY_TOKEN_BUDGET overrides it for every model
+    @staticmethod
+    def get_history_budget(model: str) -> int:
+        override = os.getenv('HISTORY_TOKEN_BUDGET')
+        if override:
+            return int(override)
+        return ModelConfig.HISTORY_TOKEN_BUDGETS.get(model, ModelConfig.DEFAULT_HISTORY_TOKEN_BUDGET)
 
 
     #Constructs the Gemini API streaming endpoint URL for the given model
-    @static method
+    @staticmethod
     def build_gemini_url(model: str) -> str:
         return (
             f"{ModelConfig.GEMINI_API_BASE_URL}/models/{model}:"
             f"{ModelConfig.GEMINI_STREAM_ENDPOINT}?alt=sse"
         )
 
+    #Constructs the non-streaming Gemini generateContent URL for the given model
+    @staticmethod
+    def build_gemini_generate_url(model: str) -> str:
+        return f"{ModelConfig.GEMINI_API_BASE_URL}/models/{model}:{ModelConfig.GEMINI_GENERATE_ENDPOINT}"
+
+    #Constructs the Gemini ListModels URL
+    @staticmethod
+    def build_gemini_models_url() -> str:
+        return f"{ModelConfig.GEMINI_API_BASE_URL}/models"
+
+    #Constructs the cachedContents URL, or the URL of one cached content by its name
+    @staticmethod
+    def build_gemini_cache_url(name: Optional[str] = None) -> str:
+        return f"{ModelConfig.GEMINI_API_BASE_URL}/{name or 'cachedContents'}"
+
     #Prepares the request body for the Gemini API call with proper formatting
-    @static method
+    @staticmethod
     def prepare_gemini_request_body(
         contents: list,
         system_instruction: str,
@@ -59,15 +97,124 @@ class ModelConfig:
         return body
 
     #Validates that a model name is non-empty and properly formatted
-    @static method
+    @staticmethod
     def validate_model_name(model: str) -> bool:
-        if not model or not is instance(model, str):
+        if not model or not isinstance(model, str):
             return False
 
         model_trimmed = model.strip()
         return len(model_trimmed) > 0
 
 
+#Remembers which models Gemini serves so unknown ones go straight to the fallback
+class ModelRegistry:
+    DEFAULT_AVAILABLE_TTL = 3600
+    DEFAULT_MISSING_TTL = 600
+    DEFAULT_MAX_ENTRIES = 256
+
+    def __init__(self, available_ttl: float = DEFAULT_AVAILABLE_TTL, missing_ttl: float = DEFAULT_MISSING_TTL,
+                 max_entries: int = DEFAULT_MAX_ENTRIES) -> None:
+        self.available_ttl = available_ttl
+        self.missing_ttl = missing_ttl
+        self.max_entries = max_entries
+        # model -> (available, expires_at); names come from client requests,
+        # so the least recently recorded beyond max_entries are dropped
+        self._models: "OrderedDict[str, tuple]" = OrderedDict()
+        # authoritative ListModels result and when it expires
+        self._listed: Optional[set] = None
+        self._listed_until = 0.0
+        self._lock = threading.Lock()
+        self.rewrites = 0
+
+    #True/False when the model is known to be served / missing, None when unknown
+    def is_available(self, model: str) -> Optional[bool]:
+        now = time()
+        with self._lock:
+            entry = self._models.get(model)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+            if self._listed is not None and self._listed_until > now:
+                return model in self._listed
+        return None
+
+    #Returns the model to call: the requested one unless it is known to be missing
+    def resolve(self, model: str, fallback_model: str) -> str:
+        if model != fallback_model and self.is_available(model) is False:
+            self.rewrites += 1
+            return fallback_model
+        return model
+
+    #Records a successful call to the model
+    def mark_available(self, model: str) -> None:
+        self._remember(model, True, self.available_ttl)
+
+    #Records a 404 for the model, unless the current models list already says so
+    def mark_missing(self, model: str) -> None:
+        with self._lock:
+            if self._listed is not None and self._listed_until > time() and model not in self._listed:
+                return
+        self._remember(model, False, self.missing_ttl)
+
+    def _remember(self, model: str, available: bool, ttl: float) -> None:
+        with self._lock:
+            self._models[model] = (available, time() + ttl)
+            self._models.move_to_end(model)
+            while len(self._models) > self.max_entries:
+                self._models.popitem(last=False)
+
+    #Loads the models list from Gemini ListModels (following pagination) over the given session
+    def probe(self, session, api_key: str, timeout: float = 10) -> int:
+        names = set()
+        page_token = None
+        while True:
+            params = {'pageSize': 1000}
+            if page_token:
+                params['pageToken'] = page_token
+            resp = session.get(
+                ModelConfig.build_gemini_models_url(),
+                headers={'x-goog-api-key': api_key},
+                params=params,
+                timeout=timeout,
+            )
+            resp.raise_for_status()
+            data = resp.json()
+            for entry in data.get('models', []):
+                methods = entry.get('supportedGenerationMethods') or []
+                if methods and 'generateContent' not in methods:
+                    continue
+                names.add(entry.get('name', '').split('/', 1)[-1])
+            page_token = data.get('nextPageToken')
+            if not page_token:
+                break
+
+        with self._lock:
+            self._listed = names
+            self._listed_until = time() + self.available_ttl
+        return len(names)
+
+    #Runs probe() on a daemon thread so startup isn't delayed
+    def probe_in_background(self, session, api_key: str) -> None:
+        def run():
+            try:
+                count = self.probe(session, api_key)
+                print(f'Gemini models list loaded ({count} models)')
+            except Exception as e:
+                print(f'Gemini models probe failed, learning availability from requests: {e}')
+
+        threading.Thread(target=run, name='gemini-models-probe', daemon=True).start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            known = dict(self._models)
+            listed = len(self._listed) if self._listed is not None else None
+        return {
+            'available': sorted(m for m, (ok, _) in known.items() if ok),
+            'missing': sorted(m for m, (ok, _) in known.items() if not ok),
+            'listed': listed,
+            'rewrites': self.rewrites,
+        }
+
+
 #Convenience wrapper for model name from request data
 def get_model_from_request(request_data: Dict[str, Any]) -> str:
     return ModelConfig.get_model_name(request_data)
@@ -76,3 +223,6 @@ def get_model_from_request(request_data: Dict[str, Any]) -> str:
 def get_fallback_model() -> str:
     return ModelConfig.get_fallback_model()
 
+#Convenience wrapper for the history token budget of a model
+def get_history_budget(model: str) -> int:
+    return ModelConfig.get_history_budget(model)
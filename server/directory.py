@@ -0,0 +1,330 @@
+#Normalized team directory (members, skills, member_skills): import, migration and skill queries
+
+import argparse
+import json
+import sys
+from collections import OrderedDict
+from time import time
+
+from psycopg2.extras import execute_values
+
+from server.metrics import PHASE_SECONDS
+from server.pool import get_db_cursor
+from server.skills import (TEAM_SKILLS_FOOTER, TEAM_SKILLS_HEADER, TEAM_SKILLS_NOTIFY_SQL, SkillIndex,
+                           TeamSkillsPrompt, render_member, render_team_skills, skill_keys)
+
+DIRECTORY_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS members (
+        id          BIGSERIAL PRIMARY KEY,
+        member_key  TEXT NOT NULL UNIQUE,
+        email       TEXT NOT NULL,
+        position    INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS skills (
+        id      BIGSERIAL PRIMARY KEY,
+        name    TEXT NOT NULL UNIQUE,
+        keys    TEXT[] NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS skills_keys ON skills USING GIN (keys);
+    CREATE TABLE IF NOT EXISTS member_skills (
+        member_id  BIGINT NOT NULL REFERENCES members (id) ON DELETE CASCADE,
+        skill_id   BIGINT NOT NULL REFERENCES skills (id) ON DELETE CASCADE,
+        category   TEXT NOT NULL CHECK (category IN ('soft', 'programming', 'tools')),
+        position   INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (member_id, category, skill_id)
+    );
+    CREATE INDEX IF NOT EXISTS member_skills_skill ON member_skills (skill_id, member_id);
+"""
+
+DIRECTORY_TRIGGER_SQL = TEAM_SKILLS_NOTIFY_SQL + "".join(f"""
+DROP TRIGGER IF EXISTS team_skills_changed ON {table};
+CREATE TRIGGER team_skills_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_team_skills_changed();
+""" for table in ('members', 'skills', 'member_skills'))
+
+# skill keys (see skills.skill_keys) some member lists
+VOCABULARY_SQL = """
+    SELECT DISTINCT unnest(s.keys) FROM skills s
+    WHERE EXISTS (SELECT 1 FROM member_skills ms WHERE ms.skill_id = s.id)
+"""
+
+# members listing any of the skill keys, most matches first, with all their skills
+MATCHING_SQL = """
+    WITH matched AS (
+        SELECT ms.member_id, count(*) AS hits
+        FROM skills s
+        JOIN member_skills ms ON ms.skill_id = s.id
+        WHERE s.keys && %(keys)s::text[]
+        GROUP BY ms.member_id
+        ORDER BY hits DESC, ms.member_id
+        LIMIT %(limit)s
+    )
+    SELECT m.member_key, m.email, ms.category, s.name
+    FROM matched
+    JOIN members m ON m.id = matched.member_id
+    JOIN member_skills ms ON ms.member_id = m.id
+    JOIN skills s ON s.id = ms.skill_id
+    ORDER BY m.position, m.id, ms.position
+"""
+
+EVERYONE_SQL = """
+    SELECT m.member_key, m.email, ms.category, s.name
+    FROM members m
+    LEFT JOIN member_skills ms ON ms.member_id = m.id
+    LEFT JOIN skills s ON s.id = ms.skill_id
+    ORDER BY m.position, m.id, ms.position
+"""
+
+
+def members_from_row(team_skills_row: dict) -> list:
+    """
+    Members of a team_skills row, in its order, as import entries:
+    {"key", "email", "soft_skills": [...], "hard_skills": {"programming": [...], "tools": [...]}}.
+    """
+    soft_skills = team_skills_row.get("soft_skills") or {}
+    hard_skills = team_skills_row.get("hard_skills") or {}
+    return [
+        {
+            'key': user_key,
+            'email': email,
+            'soft_skills': soft_skills.get(user_key) or [],
+            'hard_skills': hard_skills.get(user_key) or {},
+        }
+        for user_key, email in (team_skills_row.get("user_id") or {}).items()
+    ]
+
+
+def member_skills(member: dict) -> list:
+    """(category, skill name) pairs of one import entry, in listed order."""
+    hard = member.get('hard_skills') or {}
+    pairs = [('soft', name) for name in member.get('soft_skills') or []]
+    pairs += [('programming', name) for name in hard.get('programming') or []]
+    pairs += [('tools', name) for name in hard.get('tools') or []]
+    return [(category, str(name).strip()) for category, name in pairs if str(name).strip()]
+
+
+def rows_to_team_skills(rows) -> dict:
+    """Rebuild the team_skills row shape from (member_key, email, category, name) rows."""
+    user_ids, soft_skills, hard_skills = {}, {}, {}
+    for member_key, email, category, name in rows:
+        user_ids[member_key] = email
+        if category == 'soft':
+            soft_skills.setdefault(member_key, []).append(name)
+        elif category is not None:
+            hard = hard_skills.setdefault(member_key, {'programming': [], 'tools': []})
+            hard[category].append(name)
+    return {'user_id': user_ids, 'soft_skills': soft_skills, 'hard_skills': hard_skills}
+
+
+def read_members(path: str) -> list:
+    """Import entries from a team_skills row (JSON object) or a JSONL file with one member per line."""
+    with open(path, 'r') as f:
+        text = f.read()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        data = None
+    if isinstance(data, dict) and 'user_id' in data:
+        return members_from_row(data)
+    if isinstance(data, dict):
+        return [data]
+    if isinstance(data, list):
+        return data
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+class SkillDirectory:
+    """
+    Team members and their skills in three tables instead of one JSON row.
+    Each distinct skill name is stored once with its index keys (the same
+    skill_keys() SkillIndex uses), so a lookup by skill terms is an index
+    scan that returns only the matching members however large the directory
+    gets.
+    """
+
+    def __init__(self) -> None:
+        self._ready = False
+
+    def _ensure_schema(self, cur) -> None:
+        if not self._ready:
+            cur.execute(DIRECTORY_SCHEMA_SQL)
+            self._ready = True
+
+    def import_members(self, members, replace: bool = False, page_size: int = 1000) -> dict:
+        """
+        Insert or update members and their skills in one transaction. A
+        member's skill lists are replaced by the imported ones; members not
+        in the import are kept unless `replace` is set.
+        """
+        by_key = OrderedDict()
+        for member in members:
+            if not member.get('key') or not member.get('email'):
+                raise ValueError(f'member entries need "key" and "email": {member!r}')
+            by_key[str(member['key'])] = member
+        names = OrderedDict((name, None) for member in by_key.values() for _, name in member_skills(member))
+
+        with get_db_cursor(dict_cursor=False) as (conn, cur):
+            self._ensure_schema(cur)
+            if replace:
+                cur.execute('TRUNCATE member_skills, members')
+            cur.execute('SELECT COALESCE(MAX(position) + 1, 0) FROM members')
+            start = cur.fetchone()[0]
+
+            # existing members keep their position, new ones go to the end
+            member_ids = dict(execute_values(
+                cur,
+                "INSERT INTO members (member_key, email, position) VALUES %s "
+                "ON CONFLICT (member_key) DO UPDATE SET email = EXCLUDED.email "
+                "RETURNING member_key, id",
+                [(key, member['email'], start + i) for i, (key, member) in enumerate(by_key.items())],
+                page_size=page_size, fetch=True,
+            ))
+            skill_ids = dict(execute_values(
+                cur,
+                "INSERT INTO skills (name, keys) VALUES %s "
+                "ON CONFLICT (name) DO UPDATE SET keys = EXCLUDED.keys "
+                "RETURNING name, id",
+                [(name, sorted(skill_keys(name))) for name in names],
+                page_size=page_size, fetch=True,
+            )) if names else {}
+
+            links = []
+            for key, member in by_key.items():
+                for position, (category, name) in enumerate(member_skills(member)):
+                    links.append((member_ids[key], skill_ids[name], category, position))
+            cur.execute('DELETE FROM member_skills WHERE member_id = ANY(%s)', (list(member_ids.values()),))
+            if links:
+                execute_values(
+                    cur,
+                    "INSERT INTO member_skills (member_id, skill_id, category, position) VALUES %s "
+                    "ON CONFLICT DO NOTHING",
+                    links, page_size=page_size,
+                )
+        return {'members': len(member_ids), 'skills': len(skill_ids), 'member_skills': len(links)}
+
+    def migrate(self, replace: bool = False) -> dict:
+        """Copy the members of the team_skills JSON row(s) into the tables."""
+        with get_db_cursor() as (conn, cur):
+            cur.execute('SELECT * FROM team_skills;')
+            rows = cur.fetchall()
+        members = [member for row in rows for member in members_from_row(row)]
+        return self.import_members(members, replace=replace)
+
+    def install_change_trigger(self) -> None:
+        """NOTIFY TEAM_SKILLS_CHANNEL on writes to the tables (see TeamSkillsPrompt.listen)."""
+        with get_db_cursor(dict_cursor=False) as (conn, cur):
+            self._ensure_schema(cur)
+            cur.execute(DIRECTORY_TRIGGER_SQL)
+
+    def _fetch(self, sql: str, params=None) -> list:
+        with PHASE_SECONDS.time(phase='db_fetch'):
+            with get_db_cursor(dict_cursor=False) as (conn, cur):
+                self._ensure_schema(cur)
+                cur.execute(sql, params)
+                return cur.fetchall()
+
+    def vocabulary(self) -> list:
+        """Every skill key listed by at least one member."""
+        return [key for key, in self._fetch(VOCABULARY_SQL)]
+
+    def matching(self, keys, limit: int) -> dict:
+        """team_skills row holding at most `limit` members listing any of the skill keys."""
+        return rows_to_team_skills(self._fetch(MATCHING_SQL, {'keys': list(keys), 'limit': limit}))
+
+    def row(self) -> dict:
+        """team_skills row of the whole directory."""
+        return rows_to_team_skills(self._fetch(EVERYONE_SQL))
+
+
+class DirectorySkillsPrompt(TeamSkillsPrompt):
+    """
+    TeamSkillsPrompt over a SkillDirectory. Only the skill vocabulary is
+    cached (and reloaded like the row); select() looks up the members listing
+    the skills found in the text, at most `max_members` of them, and keeps
+    the last `cache_size` renderings until the next reload. Text naming no
+    known skill gets an empty list instead of the whole directory, so the
+    prompt and the query stay small as the directory grows.
+    """
+
+    blocking = True
+
+    def __init__(self, directory: SkillDirectory, ttl: float = 300, max_members: int = 25,
+                 cache_size: int = 1024) -> None:
+        super().__init__(directory.row, ttl=ttl)
+        self.directory = directory
+        self.max_members = max_members
+        self.cache_size = cache_size
+        self._selections = OrderedDict()    # (version, keys) -> rendering
+        self._full = None                   # (version, row, rendering) for get()
+
+    def _load(self) -> None:
+        index = SkillIndex.from_terms(self.directory.vocabulary())
+        with self._lock:
+            self._state = (None, None, None, index)
+            self._loaded_at = time()
+            self.version += 1
+            self._selections.clear()
+
+    def _everyone(self) -> tuple:
+        self._current()
+        version, full = self.version, self._full
+        if full is None or full[0] != version:
+            row = self.directory.row()
+            full = self._full = (version, row, render_team_skills(row))
+        return full
+
+    def get(self) -> str:
+        """Team skills context listing every member (loaded once per reload)."""
+        return self._everyone()[2]
+
+    def row(self) -> dict:
+        return self._everyone()[1]
+
+    def matches(self, text: str) -> str:
+        index = self._current()[3]
+        keys = tuple(sorted(index.terms(text)))
+        cache_key = (self.version, keys)
+        with self._lock:
+            rendering = self._selections.get(cache_key)
+            if rendering is not None:
+                self._selections.move_to_end(cache_key)
+                return rendering
+
+        rendering = ''
+        if keys:
+            row = self.directory.matching(keys, self.max_members)
+            rendering = ''.join(render_member(user_key, row) for user_key in row.get('user_id', {}))
+        with self._lock:
+            self._selections[cache_key] = rendering
+            while len(self._selections) > self.cache_size:
+                self._selections.popitem(last=False)
+        return rendering
+
+    def select(self, text: str) -> str:
+        return ''.join([TEAM_SKILLS_HEADER, self.matches(text), TEAM_SKILLS_FOOTER])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Manage the normalized team directory tables.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate = commands.add_parser('migrate', help='copy the team_skills JSON row into the tables')
+    migrate.add_argument('--replace', action='store_true', help='drop members not in the row')
+    load = commands.add_parser('import', help='bulk import members from a file')
+    load.add_argument('file', help='a team_skills row (JSON) or one member per line (JSONL)')
+    load.add_argument('--replace', action='store_true', help='drop members not in the file')
+    commands.add_parser('trigger', help='install the NOTIFY trigger used by TEAM_SKILLS_LISTEN')
+    args = parser.parse_args(argv)
+
+    directory = SkillDirectory()
+    if args.command == 'migrate':
+        print(json.dumps(directory.migrate(replace=args.replace)))
+    elif args.command == 'import':
+        print(json.dumps(directory.import_members(read_members(args.file), replace=args.replace)))
+    else:
+        directory.install_change_trigger()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
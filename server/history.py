@@ -0,0 +1,130 @@
+#Token-budgeted compaction of the conversation history sent upstream
+
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+
+from server.database import ModelConfig
+
+# Defaults for the optional "history" block of config.json.
+HISTORY_DEFAULTS = {
+    'enable': True,
+    # "drop" replaces old turns with a one-line note; "summarize" asks the
+    # model for a running summary of them (cached per conversation id)
+    'mode': 'drop',
+    # conversations whose running summary is kept in memory
+    'max_conversations': 1000,
+}
+
+# rough per-message framing cost (role, separators) in tokens
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate: about four characters per token for English text."""
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message.get('content') or '') + MESSAGE_OVERHEAD
+
+
+def _digest(messages: list) -> str:
+    h = sha256()
+    for m in messages:
+        h.update(f"{m.get('role')}\0{m.get('content')}\0".encode())
+    return h.hexdigest()
+
+
+class HistoryManager:
+    """
+    Bounds the history forwarded to the model by the per-model budget from
+    ModelConfig.get_history_budget().
+
+    The newest messages that fit are kept verbatim; everything older is
+    either dropped (replaced by a note) or folded into a running summary
+    produced by `summarize(messages, previous_summary)`. Summaries are cached
+    per conversation id together with how many leading messages they cover,
+    so each turn only summarizes the messages newly pushed out of the window.
+    """
+
+    def __init__(self, summarize=None, **options) -> None:
+        options = {**HISTORY_DEFAULTS, **options}
+        self.enable = options['enable']
+        self.mode = options['mode'] if summarize is not None else 'drop'
+        self.max_conversations = options['max_conversations']
+        self.summarize = summarize
+        self._summaries = OrderedDict()   # conversation id -> (covered, digest, summary)
+        self._lock = threading.Lock()
+        self.compacted = 0
+        self.summaries_built = 0
+
+    def _split(self, messages: list, budget: int) -> int:
+        """Index of the first message kept verbatim."""
+        used = 0
+        start = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            used += message_tokens(messages[i])
+            # the newest message is kept even when it alone exceeds the budget
+            if used > budget and start < len(messages):
+                break
+            start = i
+        return start
+
+    def _summary(self, conversation_id: str, older: list) -> str:
+        with self._lock:
+            cached = self._summaries.get(conversation_id)
+
+        previous = None
+        covered = 0
+        if cached is not None:
+            covered, digest, summary = cached
+            if covered <= len(older) and digest == _digest(older[:covered]):
+                if covered == len(older):
+                    with self._lock:
+                        self._summaries.move_to_end(conversation_id)
+                    return summary
+                previous = summary
+            else:
+                # history was edited client-side; start over
+                covered = 0
+
+        summary = self.summarize(older[covered:], previous)
+        self.summaries_built += 1
+        with self._lock:
+            self._summaries[conversation_id] = (len(older), _digest(older), summary)
+            self._summaries.move_to_end(conversation_id)
+            while len(self._summaries) > self.max_conversations:
+                self._summaries.popitem(last=False)
+        return summary
+
+    def compact(self, conversation_id: str, messages: list, model: str) -> list:
+        if not self.enable or not messages:
+            return messages
+
+        budget = ModelConfig.get_history_budget(model)
+        if sum(message_tokens(m) for m in messages) <= budget:
+            return messages
+
+        # reserve room for the note / summary standing in for older turns
+        start = self._split(messages, budget * 9 // 10)
+        older, recent = messages[:start], messages[start:]
+        self.compacted += 1
+
+        if self.mode == 'summarize' and conversation_id:
+            try:
+                summary = self._summary(conversation_id, older)
+                return [{'role': 'user', 'content': f'Summary of the earlier conversation:\n{summary}'}] + recent
+            except Exception as e:
+                print(f'History summary failed, dropping old turns instead: {e}')
+
+        return [{'role': 'user', 'content': f'[{len(older)} earlier messages omitted]'}] + recent
+
+    def stats(self) -> dict:
+        with self._lock:
+            cached = len(self._summaries)
+        return {
+            'compacted': self.compacted,
+            'summaries_built': self.summaries_built,
+            'summaries_cached': cached,
+        }
@@ -0,0 +1,234 @@
+#Per-phase request timings and component stats in the Prometheus text format
+
+import threading
+from contextlib import contextmanager
+from json import dumps
+from time import monotonic, time
+
+# Defaults for the optional "metrics" block of config.json.
+METRICS_DEFAULTS = {
+    'enable': True,
+    'path': '/metrics',
+    # print one JSON line with the phase timings of every conversation request
+    'log_timings': False,
+}
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _number(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}   # label values -> total
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(labels.get(l, '') for l in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, _labels(zip(self.labels, key)), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}   # label values -> [bucket counts..., sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(labels.get(l, '') for l in self.labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - started, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(series)) for key, series in self._values.items()]
+        for key, series in values:
+            pairs = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f'{self.name}_bucket', _labels(pairs + [('le', _number(bound))]), cumulative
+            yield f'{self.name}_sum', _labels(pairs), series[-1]
+            yield f'{self.name}_count', _labels(pairs), cumulative
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms recorded on the request path, plus collectors:
+    callables returning a stats() dict whose numeric values are exported as
+    gauges when /metrics is scraped.
+    """
+
+    def __init__(self, namespace: str = 'chat') -> None:
+        self.namespace = namespace
+        self._metrics = []
+        self._collectors = []   # (prefix, fn, label)
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        metric = Counter(f'{self.namespace}_{name}', help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(f'{self.namespace}_{name}', help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, prefix: str, fn, label: str = 'key') -> None:
+        """Export fn()'s numbers as <namespace>_<prefix>_<key>; nested dicts get a `label` label."""
+        self._collectors = [c for c in self._collectors if c[0] != prefix] + [(prefix, fn, label)]
+
+    def _collect(self, prefix: str, fn, label: str) -> dict:
+        gauges = {}   # name -> [(labels, value)]
+        try:
+            stats = fn() or {}
+        except Exception as e:
+            print(f'Metrics collector {prefix} failed: {e}')
+            return gauges
+
+        def add(key, value, pairs):
+            if isinstance(value, (int, float)):
+                gauges.setdefault(f'{self.namespace}_{prefix}_{key}', []).append((_labels(pairs), value))
+
+        for key, value in stats.items():
+            if isinstance(value, dict):
+                for name, inner in value.items():
+                    if isinstance(inner, dict):
+                        for inner_key, inner_value in inner.items():
+                            add(inner_key, inner_value, [(label, name)])
+            else:
+                add(key, value, [])
+        return gauges
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_number(value)}')
+
+        for prefix, fn, label in self._collectors:
+            for name, samples in self._collect(prefix, fn, label).items():
+                lines.append(f'# TYPE {name} gauge')
+                for labels, value in samples:
+                    lines.append(f'{name}{labels} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+PHASE_SECONDS = registry.histogram(
+    'phase_seconds', 'Time spent in each phase of a conversation request', ('phase',))
+TOKENS_PER_SECOND = registry.histogram(
+    'stream_tokens_per_second', 'Estimated output tokens per second while streaming', buckets=RATE_BUCKETS)
+REQUESTS = registry.counter(
+    'conversation_requests_total', 'Conversation requests by outcome', ('outcome',))
+DISCONNECTS = registry.counter(
+    'client_disconnects_total', 'Streams the client closed before the answer was complete')
+
+
+class RequestTimer:
+    """
+    Phase timings of one conversation request. Phases recorded: history_load,
+    prompt_build, search, admission_wait, upstream_connect, ttft (request
+    start to first frame), stream (first frame to end) and total.
+    """
+
+    def __init__(self, log: bool = False) -> None:
+        self.log = log
+        self.started = monotonic()
+        self.phases = {}
+        self.first_frame_at = None
+        self.outcome = None
+
+    def record(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        started = monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, monotonic() - started)
+
+    def first_frame(self) -> None:
+        if self.first_frame_at is None:
+            self.first_frame_at = monotonic()
+            self.record('ttft', self.first_frame_at - self.started)
+
+    def finish(self, outcome: str, tokens: int = 0) -> None:
+        """Observe everything recorded; only the first call counts."""
+        if self.outcome is not None:
+            return
+        self.outcome = outcome
+        now = monotonic()
+        self.record('total', now - self.started)
+        if self.first_frame_at is not None:
+            streamed = now - self.first_frame_at
+            self.record('stream', streamed)
+            if tokens and streamed > 0:
+                TOKENS_PER_SECOND.observe(tokens / streamed)
+
+        for phase, seconds in self.phases.items():
+            PHASE_SECONDS.observe(seconds, phase=phase)
+        REQUESTS.inc(outcome=outcome)
+        if outcome == 'disconnected':
+            DISCONNECTS.inc()
+
+        if self.log:
+            print(dumps({
+                'event': 'conversation_timing',
+                'at': round(time(), 3),
+                'outcome': outcome,
+                'tokens': tokens,
+                **{phase: round(seconds, 4) for phase, seconds in self.phases.items()},
+            }))
@@ -0,0 +1,281 @@
+#Pooled PostgreSQL connections shared by every request in the process
+
+import os
+import threading
+from time import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+from dotenv import load_dotenv
+
+from server.cancellation import db_budget
+
+load_dotenv()
+
+# Database configuration
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', 'localhost'),
+    'database': os.getenv('DB_NAME', 'mydb'),
+    'user': os.getenv('DB_USER', 'postgres'),
+    'password': os.getenv('DB_PASSWORD', 'password'),
+    'port': os.getenv('DB_PORT', '5432')
+}
+
+# Pool sizing. min connections are opened by warm_db_pool() at startup,
+# max bounds how many Postgres backends this process may hold at once.
+DB_POOL_CONFIG = {
+    'minconn': int(os.getenv('DB_POOL_MIN', '2')),
+    'maxconn': int(os.getenv('DB_POOL_MAX', '10')),
+    # seconds a checkout waits for a free connection before giving up
+    'timeout': float(os.getenv('DB_POOL_TIMEOUT', '5')),
+    # connections idle for longer than this are pinged before reuse
+    'check_idle': float(os.getenv('DB_POOL_CHECK_IDLE', '30')),
+}
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of psycopg2 connections.
+
+    Checkouts block (up to `timeout` seconds) when all `maxconn` connections
+    are in use instead of opening new ones, so a burst of requests can never
+    exhaust Postgres max_connections. Connections that were idle for longer
+    than `check_idle` seconds are validated with `SELECT 1` before being
+    handed out; broken ones are discarded and replaced transparently.
+    """
+
+    def __init__(self, minconn: int, maxconn: int, timeout: float = 5, check_idle: float = 30, **dsn) -> None:
+        if maxconn < 1 or minconn > maxconn:
+            raise ValueError(f'invalid pool size min={minconn} max={maxconn}')
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.dsn = dsn
+
+        self._idle = []   # [(conn, returned_at)], most recently used last
+        self._size = 0    # open connections, idle + checked out
+        self._waiting = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        self._counters = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_seconds': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'discarded': 0,
+            'failed_checks': 0,
+        }
+
+    # The helpers below run without the lock held (a handshake or a ping
+    # must not hold up other checkouts); the Condition's lock is an RLock,
+    # so they can take it for the counters either way.
+    def _connect(self):
+        conn = psycopg2.connect(**self.dsn)
+        with self._cond:
+            self._counters['created'] += 1
+        return conn
+
+    def _healthy(self, conn, returned_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time() - returned_at < self.check_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except Exception:
+            with self._cond:
+                self._counters['failed_checks'] += 1
+            return False
+
+    def _discard(self, conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._counters['discarded'] += 1
+
+    def warm(self) -> int:
+        """Open connections until `minconn` are available. Returns pool size."""
+        with self._cond:
+            while self._size < self.minconn:
+                self._idle.append((self._connect(), time()))
+                self._size += 1
+            return self._size
+
+    def getconn(self, timeout: float = None):
+        # a request's deadline may leave less than the pool's own timeout
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        deadline = time() + timeout
+        waited_from = None
+        while True:
+            # under the lock only take an idle connection or reserve a slot
+            # (so concurrent checkouts can't overshoot maxconn)
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeout('connection pool is closed')
+                    if self._idle:
+                        conn, returned_at = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        conn = None
+                        break
+
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeout(f'no database connection available after {timeout:.1f}s '
+                                          f'(pool max {self.maxconn})')
+
+                    if waited_from is None:
+                        waited_from = time()
+                        self._counters['waits'] += 1
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+            elif not self._healthy(conn, returned_at):
+                self._discard(conn)
+                self._release_slot()
+                continue
+
+            with self._cond:
+                self._counters['checkouts'] += 1
+                if waited_from is not None:
+                    self._counters['wait_seconds'] += time() - waited_from
+            return conn
+
+    def _release_slot(self) -> None:
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def putconn(self, conn, close: bool = False) -> None:
+        with self._cond:
+            if close or self._closed or conn.closed:
+                self._discard(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, time()))
+            self._cond.notify()
+
+    def closeall(self) -> None:
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+                self._size -= 1
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        """Snapshot of pool occupancy and lifetime counters."""
+        with self._cond:
+            in_use = self._size - len(self._idle)
+            return {
+                'min': self.minconn,
+                'max': self.maxconn,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': in_use,
+                'waiting': self._waiting,
+                'saturation': in_use / self.maxconn,
+                **self._counters,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(**DB_POOL_CONFIG, **DB_CONFIG)
+    return _pool
+
+
+def warm_db_pool() -> bool:
+    """
+    Open the minimum number of pooled connections ahead of the first request.
+    Returns False (and logs) instead of raising when the database is down so
+    the site can still start.
+    """
+    try:
+        size = get_pool().warm()
+        print(f"Database pool ready ({size} connections, max {DB_POOL_CONFIG['maxconn']})")
+        return True
+    except Exception as e:
+        print(f'Database pool warm-up failed: {e}')
+        return False
+
+
+@contextmanager
+def get_db_connection():
+    """
+    Context manager for database connections.
+    Automatically handles commit/rollback and returns the connection to the pool.
+
+    Usage:
+        with get_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('SELECT * FROM table')
+                results = cur.fetchall()
+    """
+    pool = get_pool()
+    conn = pool.getconn(db_budget())
+    try:
+        yield conn
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        raise e
+    finally:
+        pool.putconn(conn)
+
+@contextmanager
+def get_db_cursor(dict_cursor=True):
+    """
+    Context manager that provides both connection and cursor.
+    Automatically handles commit/rollback and cleanup.
+
+    Usage:
+        with get_db_cursor() as (conn, cur):
+            cur.execute('SELECT * FROM table')
+            results = cur.fetchall()
+    """
+    with get_db_connection() as conn:
+        cursor_factory = RealDictCursor if dict_cursor else None
+        cur = conn.cursor(cursor_factory=cursor_factory)
+        try:
+            # on the request path, stop statements the deadline can't afford
+            budget = db_budget()
+            if budget is not None:
+                cur.execute('SET LOCAL statement_timeout = %s', (max(1, int(budget * 1000)),))
+            yield conn, cur
+        finally:
+            cur.close()
@@ -0,0 +1,248 @@
+#Streaming relay from the upstream Gemini SSE response to the client
+
+import asyncio
+import re
+from json import dumps, loads
+from json.decoder import scanstring
+from time import monotonic
+
+# Defaults for the optional "relay" block of config.json.
+RELAY_DEFAULTS = {
+    # "coalesce": merge text fragments into fewer {"text": ...} frames
+    # "parse":    one {"text": ...} frame per upstream fragment (legacy)
+    # "passthrough": forward upstream SSE bytes untouched
+    'mode': 'coalesce',
+    # coalesce: flush buffered text after `window` seconds or once it reaches
+    # `max_bytes`, whichever comes first
+    'window': 0.02,
+    'max_bytes': 1024,
+}
+
+_TEXT_KEY = '"text":'
+# OpenAI-compatible chunks carry their text in choices[].delta.content
+_CONTENT_KEY = '"content":'
+
+# Every object key of a payload. A quote inside a JSON string is escaped,
+# so an unescaped '"name":' is always a key.
+_KEY_RE = re.compile(r'"(\w+)"\s*:')
+
+# Keys of plain answer chunks, where every "text" (Gemini) or string
+# "content" (OpenAI) is answer text. Anything else, such as
+# groundingMetadata, functionCall or tool_calls, may hold other strings
+# under those names, and the payload is parsed instead of scanned.
+_PLAIN_KEYS = frozenset({
+    # Gemini
+    'candidates', 'content', 'parts', 'text', 'role', 'index', 'finishReason', 'safetyRatings',
+    'category', 'probability', 'blocked', 'usageMetadata', 'promptTokenCount', 'candidatesTokenCount',
+    'totalTokenCount', 'thoughtsTokenCount', 'cachedContentTokenCount', 'promptTokensDetails',
+    'candidatesTokensDetails', 'cacheTokensDetails', 'modality', 'tokenCount', 'modelVersion',
+    'responseId', 'avgLogprobs',
+    # OpenAI-compatible
+    'id', 'object', 'created', 'model', 'system_fingerprint', 'service_tier', 'choices', 'delta',
+    'logprobs', 'finish_reason', 'refusal', 'usage', 'prompt_tokens', 'completion_tokens', 'total_tokens',
+})
+
+
+def encode_frame(text: str) -> bytes:
+    return b'data: ' + dumps({'text': text}).encode() + b'\n\n'
+
+
+def extract_texts(data: str) -> list:
+    """
+    Answer text of one SSE data payload: candidates[].content.parts[].text
+    for Gemini, choices[].delta.content for OpenAI-compatible streams.
+
+    Plain answer chunks (only _PLAIN_KEYS) are scanned for "text" keys,
+    decoding just those string literals instead of the whole document;
+    without text parts, string "content" values are the OpenAI deltas
+    (Gemini's "content" is an object and never matches). Any other payload
+    is parsed, so text in grounding metadata or function calls isn't
+    relayed as part of the answer.
+    """
+    if not _PLAIN_KEYS.issuperset(_KEY_RE.findall(data)):
+        return _parse_texts(data)
+    return _scan_strings(data, _TEXT_KEY) or _scan_strings(data, _CONTENT_KEY)
+
+
+def _parse_texts(data: str) -> list:
+    try:
+        event = loads(data)
+    except ValueError:
+        return []
+    if not isinstance(event, dict):
+        return []
+    texts = []
+    for candidate in event.get('candidates') or []:
+        for part in ((candidate or {}).get('content') or {}).get('parts') or []:
+            text = part.get('text') if isinstance(part, dict) else None
+            if isinstance(text, str) and text:
+                texts.append(text)
+    for choice in event.get('choices') or []:
+        content = ((choice or {}).get('delta') or {}).get('content')
+        if isinstance(content, str) and content:
+            texts.append(content)
+    return texts
+
+
+def _scan_strings(data: str, key: str) -> list:
+    texts = []
+    pos = data.find(key)
+    while pos != -1:
+        start = pos + len(key)
+        while start < len(data) and data[start] in ' \t\r\n':
+            start += 1
+        if start < len(data) and data[start] == '"':
+            try:
+                text, start = scanstring(data, start + 1)
+            except ValueError:
+                break
+            if text:
+                texts.append(text)
+        pos = data.find(key, start)
+    return texts
+
+
+class SSEParser:
+    """Incremental SSE splitter: feed raw bytes, get back complete data payloads."""
+
+    def __init__(self) -> None:
+        self._buffer = b''
+
+    def feed(self, chunk: bytes) -> list:
+        if self._buffer:
+            chunk = self._buffer + chunk
+        end = chunk.rfind(b'\n')
+        if end == -1:
+            self._buffer = chunk
+            return []
+        self._buffer = chunk[end + 1:]
+
+        payloads = []
+        for line in chunk[:end].split(b'\n'):
+            if line.startswith(b'data:'):
+                data = line[5:].strip()
+                # some SSE implementations send '[DONE]' or empty data
+                if data and data != b'[DONE]':
+                    payloads.append(data.decode('utf-8', 'replace'))
+        return payloads
+
+
+class SSERelay:
+    """
+    Turns upstream SSE byte chunks into client frames.
+
+    In coalesce mode the sync path (Flask) merges everything that arrived in
+    one network read, or up to `max_bytes`, into a single frame; it never
+    holds text back waiting for the next read. The async path additionally
+    keeps collecting across reads for up to `window` seconds.
+
+    Texts are appended to `collect` when a list is passed, for callers that
+    need the full answer (response cache, conversation store).
+    """
+
+    def __init__(self, mode: str = 'coalesce', window: float = 0.02, max_bytes: int = 1024) -> None:
+        if mode not in ('coalesce', 'parse', 'passthrough'):
+            raise ValueError(f'unknown relay mode {mode!r}')
+        self.mode = mode
+        self.window = window
+        self.max_bytes = max_bytes
+        self.frames_sent = 0
+        self.fragments = 0
+
+    def _texts(self, parser: SSEParser, chunk: bytes, collect: list = None) -> list:
+        texts = []
+        for data in parser.feed(chunk):
+            texts += extract_texts(data)
+        self.fragments += len(texts)
+        if collect is not None:
+            collect += texts
+        return texts
+
+    def frames(self, chunks, collect: list = None):
+        parser = SSEParser()
+
+        if self.mode == 'passthrough':
+            for chunk in chunks:
+                if collect is not None:
+                    self._texts(parser, chunk, collect)
+                self.frames_sent += 1
+                yield chunk
+            return
+
+        pending = []
+        size = 0
+        for chunk in chunks:
+            for text in self._texts(parser, chunk, collect):
+                if self.mode == 'parse':
+                    self.frames_sent += 1
+                    yield encode_frame(text)
+                    continue
+                pending.append(text)
+                size += len(text)
+                if size >= self.max_bytes:
+                    self.frames_sent += 1
+                    yield encode_frame(''.join(pending))
+                    pending, size = [], 0
+            if pending:
+                self.frames_sent += 1
+                yield encode_frame(''.join(pending))
+                pending, size = [], 0
+
+    async def aframes(self, chunks, collect: list = None):
+        parser = SSEParser()
+
+        if self.mode != 'coalesce':
+            async for chunk in chunks:
+                if self.mode == 'passthrough':
+                    if collect is not None:
+                        self._texts(parser, chunk, collect)
+                    self.frames_sent += 1
+                    yield chunk
+                    continue
+                for text in self._texts(parser, chunk, collect):
+                    self.frames_sent += 1
+                    yield encode_frame(text)
+            return
+
+        iterator = chunks.__aiter__()
+        pending = []
+        size = 0
+        flush_at = None
+        next_chunk = None
+        try:
+            while True:
+                if next_chunk is None:
+                    next_chunk = asyncio.ensure_future(iterator.__anext__())
+                timeout = None if flush_at is None else max(0, flush_at - monotonic())
+                done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+
+                if done:
+                    try:
+                        chunk = next_chunk.result()
+                    except StopAsyncIteration:
+                        break
+                    next_chunk = None
+                    for text in self._texts(parser, chunk, collect):
+                        if not pending:
+                            flush_at = monotonic() + self.window
+                        pending.append(text)
+                        size += len(text)
+
+                if pending and (size >= self.max_bytes or monotonic() >= flush_at):
+                    self.frames_sent += 1
+                    yield encode_frame(''.join(pending))
+                    pending, size, flush_at = [], 0, None
+
+            if pending:
+                self.frames_sent += 1
+                yield encode_frame(''.join(pending))
+        finally:
+            if next_chunk is not None and not next_chunk.done():
+                next_chunk.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'mode': self.mode,
+            'frames': self.frames_sent,
+            'fragments': self.fragments,
+        }
@@ -0,0 +1,565 @@
+#Resumable conversation streams: recorded frames with SSE event ids, replayed on reconnect
+
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+from time import monotonic, sleep, time
+from uuid import uuid4
+
+from psycopg2.extras import execute_values
+
+from server.pool import get_db_cursor
+
+# Defaults for the optional "resume" block of config.json.
+RESUME_DEFAULTS = {
+    'enable': False,
+    # "memory" (per process) or "postgres" (frames are also written to
+    # Postgres, so a reconnect that lands on another worker can resume)
+    'backend': 'memory',
+    # finished streams stay resumable this long (seconds)
+    'ttl': 300,
+    # per stream ring buffer; the oldest frames are dropped beyond this and a
+    # reconnect that missed them has to ask again
+    'stream_bytes': 1_000_000,
+    # all streams together; the oldest finished ones are dropped first
+    'max_bytes': 50_000_000,
+    'max_streams': 1000,
+    # a generation whose readers all left keeps running this long, waiting
+    # for a reconnect, before it is cancelled
+    'detach_grace': 15,
+    # postgres: how often new frames are written, and how often a reader on
+    # another worker looks for them
+    'flush_interval': 0.1,
+    'poll_interval': 0.2,
+}
+
+RESUME_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS resumable_streams (
+        stream_id        TEXT PRIMARY KEY,
+        conversation_id  TEXT NOT NULL,
+        done             BOOLEAN NOT NULL DEFAULT false,
+        attached_at      TIMESTAMPTZ,
+        updated_at       TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    CREATE TABLE IF NOT EXISTS resumable_stream_frames (
+        stream_id  TEXT NOT NULL REFERENCES resumable_streams (stream_id) ON DELETE CASCADE,
+        seq        INTEGER NOT NULL,
+        frame      BYTEA NOT NULL,
+        PRIMARY KEY (stream_id, seq)
+    );
+    CREATE INDEX IF NOT EXISTS resumable_streams_updated_at ON resumable_streams (updated_at);
+"""
+
+
+class StreamGone(Exception):
+    """The frames a reader asked for were dropped from the ring buffer."""
+
+
+def parse_event_id(value: str):
+    """(stream id, seq) from a Last-Event-ID header value, or None if it isn't one of ours."""
+    stream_id, _, seq = (value or '').strip().rpartition(':')
+    if not stream_id or not seq.isdigit():
+        return None
+    return stream_id, int(seq)
+
+
+def event_frame(stream_id: str, seq: int, frame: bytes) -> bytes:
+    """An SSE frame from the relay with its event id in front."""
+    return b'id: %s:%d\n' % (stream_id.encode(), seq) + frame
+
+
+class StreamRecord:
+    """
+    The frames of one generation, kept while it is produced and for a while
+    after. Any number of readers tail it from a sequence number, blocking
+    (threads) or awaiting (asyncio) until the producer appends more.
+
+    A record can exist before its upstream call is made (see Coalescer):
+    start() marks the generation as running, fail() as never started.
+    """
+
+    def __init__(self, stream_id: str, conversation_id: str, max_bytes: int) -> None:
+        self.stream_id = stream_id
+        self.conversation_id = conversation_id
+        self.max_bytes = max_bytes
+        self._frames = deque()
+        self.first_seq = 1      # seq of _frames[0]
+        self.last_seq = 0
+        self.size = 0
+        self.started = False
+        self.failed = False
+        self.done = False
+        # the complete answer text, when the producer kept it
+        self.text = None
+        self.updated_at = monotonic()
+        self.readers = 0
+        self.detached_at = None
+        # why the generation was stopped early, for its outcome
+        self.cancel_reason = None
+        # set by the producer: stops the generation
+        self.cancel = None
+        # the asyncio task filling the record (ASGI)
+        self.producer = None
+        # postgres backend: what has been written so far
+        self.flushed_seq = 0
+        self.flushed_done = False
+        # other conversations following this generation (coalesced requests)
+        self.shared_with = set()
+        self._cond = threading.Condition()
+        self._async_waiters = []    # (loop, future)
+        self._finish_callbacks = []
+
+    def append(self, frame: bytes) -> int:
+        with self._cond:
+            self.last_seq += 1
+            self._frames.append(frame)
+            self.size += len(frame)
+            while self.size > self.max_bytes and len(self._frames) > 1:
+                self.size -= len(self._frames.popleft())
+                self.first_seq += 1
+            self.updated_at = monotonic()
+            self._wake()
+            return self.last_seq
+
+    def start(self) -> None:
+        """The upstream call was accepted; frames will follow."""
+        with self._cond:
+            self.started = True
+            self._wake()
+
+    def fail(self) -> None:
+        """The generation never started (upstream error, rejected, client gone). No-op once started."""
+        with self._cond:
+            if self.started or self.done:
+                return
+            self.failed = True
+        self.finish()
+
+    def finish(self, text: str = None) -> None:
+        with self._cond:
+            self.done = True
+            self.text = text
+            self.updated_at = monotonic()
+            self._wake()
+            callbacks, self._finish_callbacks = self._finish_callbacks, []
+        for callback in callbacks:
+            try:
+                callback(text)
+            except Exception as e:
+                print(f'Stream finish callback failed: {e}')
+
+    def add_finish_callback(self, callback) -> None:
+        """Call `callback(text)` when the generation ends; right away if it already has."""
+        with self._cond:
+            if not self.done:
+                self._finish_callbacks.append(callback)
+                return
+        callback(self.text)
+
+    def wait_started(self, timeout: float) -> bool:
+        """Wait until the generation started (True) or failed (False), at most `timeout` seconds."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.started or self.failed, timeout)
+            return self.started
+
+    async def await_started(self, timeout: float) -> bool:
+        loop = asyncio.get_running_loop()
+        end = monotonic() + timeout
+        while True:
+            with self._cond:
+                if self.started or self.failed:
+                    return self.started
+                remaining = end - monotonic()
+                if remaining <= 0:
+                    return False
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def wake(self) -> None:
+        """Wake every waiting reader, e.g. so one whose client left can stop."""
+        with self._cond:
+            self._wake()
+
+    def _wake(self) -> None:
+        # caller holds the condition
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda f=future: f.done() or f.set_result(None))
+
+    def _since(self, after: int) -> list:
+        # caller holds the condition
+        if after + 1 < self.first_seq:
+            raise StreamGone(f'frames after {after} of stream {self.stream_id} were dropped')
+        start = after + 1 - self.first_seq
+        return [(self.first_seq + start + i, frame) for i, frame in enumerate(islice(self._frames, start, None))]
+
+    def frames_after(self, after: int) -> list:
+        with self._cond:
+            return self._since(after)
+
+    def read(self, after: int, timeout: float) -> tuple:
+        """([(seq, frame), ...] after seq `after`, done), waiting up to `timeout` if there is nothing new yet."""
+        with self._cond:
+            if after >= self.last_seq and not self.done:
+                self._cond.wait(timeout)
+            return self._since(after), self.done
+
+    async def aread(self, after: int, timeout: float) -> tuple:
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            if after < self.last_seq or self.done:
+                return self._since(after), self.done
+            future = loop.create_future()
+            self._async_waiters.append((loop, future))
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._cond:
+            return self._since(after), self.done
+
+    def attach(self) -> None:
+        with self._cond:
+            self.readers += 1
+            self.detached_at = None
+
+    def detach(self) -> bool:
+        """Returns True when this was the last reader of an unfinished generation."""
+        with self._cond:
+            self.readers -= 1
+            if self.readers == 0 and not self.done:
+                self.detached_at = time()
+                return True
+            return False
+
+
+class MemoryResumeStore:
+    """
+    Per-process resumable streams: the latest generation of every
+    conversation, kept `ttl` seconds after it finished and bounded by
+    `max_streams` and `max_bytes` (oldest finished streams go first).
+    """
+
+    # begin()/get() never block, safe to call from the event loop
+    blocking = False
+
+    def __init__(self, ttl: float = 300, stream_bytes: int = 1_000_000, max_bytes: int = 50_000_000,
+                 max_streams: int = 1000, detach_grace: float = 15, **_) -> None:
+        self.ttl = ttl
+        self.stream_bytes = stream_bytes
+        self.max_bytes = max_bytes
+        self.max_streams = max_streams
+        self.detach_grace = detach_grace
+        self._records = OrderedDict()   # stream_id -> StreamRecord, oldest first
+        self._latest = {}               # conversation_id -> stream_id
+        self._lock = threading.Lock()
+        self.started = 0
+        self.resumed = 0
+        self.expired = 0
+        self.abandoned_streams = 0
+
+    def begin(self, conversation_id: str) -> StreamRecord:
+        """Start recording a new generation; it replaces the conversation's previous one."""
+        record = StreamRecord(uuid4().hex[:16], conversation_id or '', self.stream_bytes)
+        with self._lock:
+            previous = self._records.get(self._latest.get(record.conversation_id))
+            if previous is not None and previous.done:
+                self._pop(previous.stream_id)
+            self._records[record.stream_id] = record
+            self._latest[record.conversation_id] = record.stream_id
+            self._prune()
+        self.started += 1
+        return record
+
+    def local(self, conversation_id: str, stream_id: str):
+        with self._lock:
+            self._prune()
+            record = self._records.get(stream_id)
+        conversation_id = conversation_id or ''
+        if record is None or (record.conversation_id != conversation_id and conversation_id not in record.shared_with):
+            return None
+        return record
+
+    def share(self, record: StreamRecord, conversation_id: str) -> None:
+        """Let another conversation following `record` (a coalesced request) resume it too."""
+        conversation_id = conversation_id or ''
+        with self._lock:
+            record.shared_with.add(conversation_id)
+            previous = self._records.get(self._latest.get(conversation_id))
+            if previous is not None and previous is not record and previous.done:
+                self._pop(previous.stream_id)
+            self._latest[conversation_id] = record.stream_id
+
+    def get(self, conversation_id: str, stream_id: str):
+        """The stream to resume, or None when it is unknown or expired."""
+        record = self.local(conversation_id, stream_id)
+        if record is None:
+            self.expired += 1
+        else:
+            self.resumed += 1
+        return record
+
+    def abandoned(self, record: StreamRecord) -> bool:
+        """True when nobody reattached to `record` since its last reader left."""
+        if record.readers == 0 and not record.done:
+            self.abandoned_streams += 1
+            return True
+        return False
+
+    def _pop(self, stream_id: str) -> None:
+        # caller holds the lock
+        record = self._records.pop(stream_id)
+        for conversation_id in (record.conversation_id, *record.shared_with):
+            if self._latest.get(conversation_id) == stream_id:
+                del self._latest[conversation_id]
+
+    def _prune(self) -> None:
+        # caller holds the lock
+        now = monotonic()
+        for stream_id, record in list(self._records.items()):
+            if record.done and now - record.updated_at > self.ttl:
+                self._pop(stream_id)
+        size = sum(record.size for record in self._records.values())
+        while len(self._records) > self.max_streams or size > self.max_bytes:
+            oldest = next((r for r in self._records.values() if r.done), None)
+            if oldest is None:
+                # only live generations left; they are bounded by stream_bytes
+                break
+            size -= oldest.size
+            self._pop(oldest.stream_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            records = list(self._records.values())
+        return {
+            'backend': 'memory',
+            'streams': len(records),
+            'live': sum(1 for r in records if not r.done),
+            'bytes': sum(r.size for r in records),
+            'started': self.started,
+            'resumed': self.resumed,
+            'expired': self.expired,
+            'abandoned': self.abandoned_streams,
+        }
+
+
+class RemoteStream:
+    """
+    A stream produced by another worker, read back from Postgres. Same
+    reading interface as StreamRecord; new frames are polled for every
+    `poll_interval` seconds.
+    """
+
+    def __init__(self, store, stream_id: str, conversation_id: str) -> None:
+        self.store = store
+        self.stream_id = stream_id
+        self.conversation_id = conversation_id
+
+    def _fetch(self, after: int) -> tuple:
+        with get_db_cursor(dict_cursor=False) as (conn, cur):
+            cur.execute(
+                "SELECT seq, frame FROM resumable_stream_frames "
+                "WHERE stream_id = %s AND seq > %s ORDER BY seq LIMIT 500",
+                (self.stream_id, after),
+            )
+            rows = [(seq, bytes(frame)) for seq, frame in cur.fetchall()]
+            cur.execute("SELECT done FROM resumable_streams WHERE stream_id = %s", (self.stream_id,))
+            row = cur.fetchone()
+        if row is None or (rows and rows[0][0] != after + 1):
+            raise StreamGone(f'frames after {after} of stream {self.stream_id} were dropped')
+        # more rows may follow the LIMIT; only report done with the last page
+        return rows, row[0] and len(rows) < 500
+
+    def frames_after(self, after: int) -> list:
+        return self._fetch(after)[0]
+
+    def read(self, after: int, timeout: float) -> tuple:
+        waited = 0.0
+        while True:
+            rows, done = self._fetch(after)
+            if rows or done or waited >= timeout:
+                return rows, done
+            sleep(self.store.poll_interval)
+            waited += self.store.poll_interval
+
+    async def aread(self, after: int, timeout: float) -> tuple:
+        return await asyncio.to_thread(self.read, after, timeout)
+
+    def wake(self) -> None:
+        pass
+
+    def attach(self) -> None:
+        pass
+
+    def detach(self) -> bool:
+        return False
+
+
+class PostgresResumeStore(MemoryResumeStore):
+    """
+    Streams are recorded in memory as with the memory backend, and a writer
+    thread copies new frames to the resumable_streams tables every
+    `flush_interval` seconds. A reconnect that lands on a worker without
+    the stream in memory reads it back from there, following the live
+    generation until the producing worker marks it done.
+    """
+
+    blocking = True
+
+    def __init__(self, flush_interval: float = 0.1, poll_interval: float = 0.2, **options) -> None:
+        super().__init__(**options)
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        self._ready = False
+        self._writer = None
+        self.flushes = 0
+        self.failures = 0
+
+    def _ensure_schema(self) -> None:
+        if not self._ready:
+            with get_db_cursor(dict_cursor=False) as (conn, cur):
+                cur.execute(RESUME_SCHEMA_SQL)
+            self._ready = True
+
+    def begin(self, conversation_id: str) -> StreamRecord:
+        record = super().begin(conversation_id)
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, name='resume-writer', daemon=True)
+                    self._writer.start()
+        return record
+
+    def get(self, conversation_id: str, stream_id: str):
+        record = self.local(conversation_id, stream_id)
+        if record is not None:
+            self.resumed += 1
+            return record
+        self._ensure_schema()
+        with get_db_cursor(dict_cursor=False) as (conn, cur):
+            # marks the stream as wanted, for the producer's abandoned() check
+            cur.execute(
+                "UPDATE resumable_streams SET attached_at = now() "
+                "WHERE stream_id = %s AND conversation_id = %s "
+                "AND updated_at > now() - make_interval(secs => %s) RETURNING stream_id",
+                (stream_id, conversation_id or '', self.ttl),
+            )
+            found = cur.fetchone() is not None
+        if not found:
+            self.expired += 1
+            return None
+        self.resumed += 1
+        return RemoteStream(self, stream_id, conversation_id or '')
+
+    def abandoned(self, record: StreamRecord) -> bool:
+        if record.readers or record.done:
+            return False
+        try:
+            with get_db_cursor(dict_cursor=False) as (conn, cur):
+                cur.execute(
+                    "SELECT attached_at >= to_timestamp(%s) FROM resumable_streams WHERE stream_id = %s",
+                    (record.detached_at, record.stream_id),
+                )
+                row = cur.fetchone()
+        except Exception as e:
+            print(f'Resume store lookup failed: {e}')
+            row = None
+        if row is not None and row[0]:
+            # a reader on another worker is following it
+            return False
+        return super().abandoned(record)
+
+    def _flush(self) -> None:
+        with self._lock:
+            records = [r for r in self._records.values()
+                       if r.flushed_seq < r.last_seq or (r.done and not r.flushed_done)]
+        if not records:
+            return
+        self._ensure_schema()
+        # positions move only once the write has committed, so a failed flush
+        # is retried in full on the next pass; the stream row is upserted every
+        # time because the flush that first inserted it may have failed
+        streams, frames, flushed, finished = [], [], [], []
+        for record in records:
+            streams.append((record.stream_id, record.conversation_id))
+            try:
+                new = record.frames_after(record.flushed_seq)
+            except StreamGone:
+                # the ring dropped frames before they were written
+                new = record.frames_after(record.first_seq - 1)
+            frames += [(record.stream_id, seq, frame) for seq, frame in new]
+            seq = new[-1][0] if new else record.flushed_seq
+            flushed.append((record, seq))
+            if record.done and seq >= record.last_seq:
+                finished.append(record)
+
+        with get_db_cursor(dict_cursor=False) as (conn, cur):
+            execute_values(
+                cur,
+                "INSERT INTO resumable_streams (stream_id, conversation_id) VALUES %s "
+                "ON CONFLICT (stream_id) DO NOTHING",
+                streams,
+            )
+            if frames:
+                execute_values(
+                    cur,
+                    "INSERT INTO resumable_stream_frames (stream_id, seq, frame) VALUES %s "
+                    "ON CONFLICT DO NOTHING",
+                    frames,
+                )
+            cur.execute(
+                "UPDATE resumable_streams SET updated_at = now(), done = stream_id = ANY(%s) "
+                "WHERE stream_id = ANY(%s)",
+                ([r.stream_id for r in finished], [r.stream_id for r in records]),
+            )
+            if self.flushes % 100 == 0:
+                cur.execute(
+                    "DELETE FROM resumable_streams WHERE updated_at < now() - make_interval(secs => %s)",
+                    (self.ttl,),
+                )
+        for record, seq in flushed:
+            record.flushed_seq = seq
+        for record in finished:
+            record.flushed_done = True
+        self.flushes += 1
+
+    def _run(self) -> None:
+        while True:
+            sleep(self.flush_interval)
+            try:
+                self._flush()
+            except Exception as e:
+                self.failures += 1
+                print(f'Resume store write failed: {e}')
+                sleep(1)
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            'backend': 'postgres',
+            'flushes': self.flushes,
+            'failures': self.failures,
+        }
+
+
+RESUME_BACKENDS = {
+    'memory': MemoryResumeStore,
+    'postgres': PostgresResumeStore,
+}
+
+
+def create_resume_store(options: dict):
+    """Build the configured resume store, or None when it is disabled."""
+    options = {**RESUME_DEFAULTS, **options}
+    if not options.pop('enable'):
+        return None
+    backend = options.pop('backend')
+    if backend not in RESUME_BACKENDS:
+        raise ValueError(f'unknown resume backend {backend!r}')
+    return RESUME_BACKENDS[backend](**options)
@@ -0,0 +1,454 @@
+#Routing generations across model providers by observed latency, with hedging and failover
+
+import asyncio
+import queue
+import random
+import threading
+from collections import deque, namedtuple
+from time import monotonic
+
+from server.cancellation import DeadlineExceeded, abort_response
+from server.relay import SSEParser, extract_texts
+from server.upstream import UpstreamError
+
+# Defaults for the optional "router" block of config.json.
+ROUTER_DEFAULTS = {
+    'enable': False,
+    # name -> {"type": "gemini" | "openai", "models": {requested: upstream}}.
+    # "*" matches any requested model and an upstream "*" keeps its name.
+    # OpenAI-compatible entries may set "base" and "key" (default:
+    # openai_api_base / openai_key). Providers without a key are skipped.
+    'providers': {
+        'gemini': {'type': 'gemini', 'models': {'*': '*'}},
+        'openai': {'type': 'openai', 'models': {'*': 'gpt-4o-mini'}},
+    },
+    # outcomes remembered per provider/model for its TTFT and error rate
+    'window': 50,
+    # a route with at least `min_samples` outcomes and an error rate of
+    # `error_threshold` or more is skipped for `cooldown` seconds
+    'min_samples': 5,
+    'error_threshold': 0.5,
+    'cooldown': 30,
+    # start the next provider when the first hasn't produced a token after
+    # this many seconds, keep whichever answers first (0 = no hedging)
+    'hedge_after': 0,
+    # share of requests sent to the runner-up, so its latency stays known
+    'explore': 0.05,
+}
+
+Route = namedtuple('Route', ('provider', 'kind', 'model'))
+
+
+class RouteStats:
+    """Rolling outcomes of one provider/model: first-token latency in seconds, or None for a failure."""
+
+    def __init__(self, window: int) -> None:
+        self.samples = deque(maxlen=window)
+        self.unhealthy_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.wins = 0
+
+    def ttft(self):
+        latencies = [s for s in self.samples if s is not None]
+        return sum(latencies) / len(latencies) if latencies else None
+
+    def error_rate(self) -> float:
+        if not self.samples:
+            return 0.0
+        return sum(1 for s in self.samples if s is None) / len(self.samples)
+
+
+class PrefetchedStream:
+    """
+    A winning requests streaming response, read ahead up to its first
+    token; iter_content() replays those chunks and continues the stream.
+    """
+
+    def __init__(self, resp, chunks: list, rest) -> None:
+        self.resp = resp
+        self.status_code = resp.status_code
+        self._chunks = chunks
+        self._rest = rest
+
+    @property
+    def raw(self):
+        return self.resp.raw
+
+    def iter_content(self, chunk_size=None):
+        yield from self._chunks
+        self._chunks = []
+        yield from self._rest
+
+    def close(self) -> None:
+        self.resp.close()
+
+
+class AsyncPrefetchedStream:
+    """PrefetchedStream for an httpx response."""
+
+    def __init__(self, resp, chunks: list, rest) -> None:
+        self.resp = resp
+        self.status_code = resp.status_code
+        self._chunks = chunks
+        self._rest = rest
+
+    async def aiter_bytes(self):
+        for chunk in self._chunks:
+            yield chunk
+        self._chunks = []
+        async for chunk in self._rest:
+            yield chunk
+
+    async def aclose(self) -> None:
+        await self.resp.aclose()
+
+
+def has_text(parser: SSEParser, chunk: bytes) -> bool:
+    return any(extract_texts(data) for data in parser.feed(chunk))
+
+
+class _Attempt:
+    def __init__(self, route: Route) -> None:
+        self.route = route
+        self.started = monotonic()
+        self.resp = None
+        self.served_model = None
+        self.error = None
+        self.finished = False
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        """Stop a losing attempt; its thread's read fails and it closes."""
+        self.cancelled = True
+        if self.resp is not None:
+            abort_response(self.resp)
+
+
+class Router:
+    """
+    Chooses the provider for each generation. Routes serving the requested
+    model are ranked healthy first, then by mean time to first token over
+    the last `window` outcomes (unmeasured routes first, so they get
+    measured). A failing route falls back to the next one, and with
+    `hedge_after` a second route is started when the first is slow to
+    produce a token; the loser is aborted.
+
+    `opener(route)` makes the provider call and returns (response, served
+    model); the router reads the response up to its first token, which is
+    what it measures and races on.
+    """
+
+    def __init__(self, providers: dict, window: int = 50, min_samples: int = 5, error_threshold: float = 0.5,
+                 cooldown: float = 30, hedge_after: float = 0, explore: float = 0.05) -> None:
+        self.providers = providers
+        self.window = window
+        self.min_samples = min_samples
+        self.error_threshold = error_threshold
+        self.cooldown = cooldown
+        self.hedge_after = hedge_after
+        self.explore = explore
+        self._stats = {}    # (provider, model) -> RouteStats
+        self._lock = threading.Lock()
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    def routes(self, model: str) -> list:
+        """Routes able to serve `model`, best first."""
+        routes = []
+        for name, options in self.providers.items():
+            models = options.get('models', {})
+            upstream = models.get(model, models.get('*'))
+            if upstream is None:
+                continue
+            routes.append(Route(name, options['type'], model if upstream == '*' else upstream))
+
+        now = monotonic()
+        with self._lock:
+            def rank(route):
+                stats = self._stats.get((route.provider, route.model))
+                if stats is None:
+                    return (False, 0.0)
+                ttft = stats.ttft()
+                return (now < stats.unhealthy_until, ttft if ttft is not None else 0.0)
+            routes.sort(key=rank)
+            healthy = sum(1 for route in routes if not rank(route)[0])
+        if healthy > 1 and random.random() < self.explore:
+            routes[0], routes[1] = routes[1], routes[0]
+        return routes
+
+    def _route_stats(self, route: Route) -> RouteStats:
+        # caller holds the lock
+        key = (route.provider, route.model)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = RouteStats(self.window)
+        return stats
+
+    def observe(self, route: Route, ttft: float) -> None:
+        with self._lock:
+            stats = self._route_stats(route)
+            stats.requests += 1
+            stats.samples.append(ttft)
+
+    def fail(self, route: Route) -> None:
+        with self._lock:
+            stats = self._route_stats(route)
+            stats.requests += 1
+            stats.errors += 1
+            stats.samples.append(None)
+            if len(stats.samples) >= self.min_samples and stats.error_rate() >= self.error_threshold:
+                stats.unhealthy_until = monotonic() + self.cooldown
+
+    def _won(self, attempt: _Attempt, hedge: bool, attempts) -> None:
+        now = monotonic()
+        self.observe(attempt.route, now - attempt.started)
+        # a route that lost the race had no token for at least this long;
+        # without the sample it would stay unmeasured and keep ranking first
+        for other in attempts:
+            if other is not attempt and not other.finished:
+                self.observe(other.route, now - other.started)
+        with self._lock:
+            self._route_stats(attempt.route).wins += 1
+            if hedge:
+                self.hedge_wins += 1
+
+    def _next_wait(self, attempts: list, routes: list, hedged: bool, end: float) -> tuple:
+        """(seconds to wait for an outcome, whether a hedge is due after that)."""
+        remaining = end - monotonic()
+        if self.hedge_after and not hedged and len(attempts) < len(routes):
+            until_hedge = attempts[0].started + self.hedge_after - monotonic()
+            if until_hedge < remaining:
+                return max(0.0, until_hedge), True
+        return max(0.0, remaining), False
+
+    def open(self, model: str, opener, budget: float) -> tuple:
+        """
+        (stream, served model, route) from the first route to produce a
+        token. When every route fails, the last error response is returned
+        as is (or its exception raised).
+        """
+        routes = self.routes(model)
+        if not routes:
+            raise UpstreamError(404, f'No provider is configured for {model}')
+        outcomes = queue.Queue()
+        attempts = []
+        # held while an outcome is posted or attempts are cancelled, so a
+        # loser either sees it was cancelled or is in `outcomes` for abandon()
+        settle = threading.Lock()
+
+        def run(attempt: _Attempt) -> None:
+            stream = None
+            try:
+                resp, attempt.served_model = opener(attempt.route)
+                attempt.resp = resp
+                if resp.status_code < 400 and not attempt.cancelled:
+                    parser, chunks = SSEParser(), []
+                    rest = resp.iter_content(chunk_size=None)
+                    for chunk in rest:
+                        chunks.append(chunk)
+                        if has_text(parser, chunk):
+                            break
+                    stream = PrefetchedStream(resp, chunks, rest)
+            except Exception as e:
+                attempt.error = e
+            with settle:
+                if not attempt.cancelled:
+                    outcomes.put((attempt, stream))
+                    return
+            # lost the race; nobody is waiting for it any more
+            if attempt.resp is not None:
+                attempt.resp.close()
+
+        def abandon(winner: _Attempt = None) -> None:
+            # cancel the other attempts and close outcomes nobody will read
+            with settle:
+                for other in attempts:
+                    if other is not winner:
+                        other.cancel()
+            while True:
+                try:
+                    other, _ = outcomes.get_nowait()
+                except queue.Empty:
+                    return
+                if other.resp is not None:
+                    other.resp.close()
+
+        def launch() -> None:
+            attempt = _Attempt(routes[len(attempts)])
+            attempts.append(attempt)
+            threading.Thread(target=run, args=(attempt,), name='router-attempt', daemon=True).start()
+
+        end = monotonic() + budget
+        hedged = False
+        finished = 0
+        launch()
+        while True:
+            timeout, hedge_due = self._next_wait(attempts, routes, hedged, end)
+            try:
+                attempt, stream = outcomes.get(timeout=timeout)
+            except queue.Empty:
+                if hedge_due:
+                    hedged = True
+                    with self._lock:
+                        self.hedges += 1
+                    launch()
+                    continue
+                abandon()
+                raise DeadlineExceeded(f'No provider produced a token within {budget:.1f}s')
+
+            finished += 1
+            attempt.finished = True
+            if stream is not None:
+                self._won(attempt, hedged and attempt is not attempts[0], attempts)
+                abandon(attempt)
+                return stream, attempt.served_model, attempt.route
+
+            self.fail(attempt.route)
+            if len(attempts) < len(routes):
+                with self._lock:
+                    self.failovers += 1
+                if attempt.resp is not None:
+                    attempt.resp.close()
+                launch()
+            elif finished == len(attempts):
+                if attempt.error is not None:
+                    raise attempt.error
+                return attempt.resp, attempt.served_model, attempt.route
+            elif attempt.resp is not None:
+                attempt.resp.close()
+
+    async def aopen(self, model: str, opener, budget: float) -> tuple:
+        """open() on the event loop; `opener` is a coroutine function returning an httpx response."""
+        routes = self.routes(model)
+        if not routes:
+            raise UpstreamError(404, f'No provider is configured for {model}')
+        attempts = {}   # task -> _Attempt
+
+        async def run(attempt: _Attempt):
+            resp, attempt.served_model = await opener(attempt.route)
+            attempt.resp = resp
+            if resp.status_code >= 400:
+                return None
+            try:
+                parser, chunks = SSEParser(), []
+                rest = resp.aiter_bytes()
+                async for chunk in rest:
+                    chunks.append(chunk)
+                    if has_text(parser, chunk):
+                        break
+            except BaseException:
+                await resp.aclose()
+                raise
+            return AsyncPrefetchedStream(resp, chunks, rest)
+
+        def launch() -> None:
+            attempt = _Attempt(routes[len(attempts)])
+            attempts[asyncio.ensure_future(run(attempt))] = attempt
+
+        async def cancel_others(winner=None) -> None:
+            losers = [task for task in attempts if attempts[task] is not winner]
+            for task in losers:
+                task.cancel()
+            for task in losers:
+                loser = attempts[task]
+                try:
+                    await task
+                except BaseException:
+                    pass
+                if loser.resp is not None and task.done() and not task.cancelled() and task.exception() is None:
+                    await (task.result() or loser.resp).aclose()
+
+        end = monotonic() + budget
+        hedged = False
+        pending = set()
+        launch()
+        pending.update(attempts)
+        ordered = lambda: list(attempts.values())
+        try:
+            while True:
+                timeout, hedge_due = self._next_wait(ordered(), routes, hedged, end)
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if hedge_due:
+                        hedged = True
+                        with self._lock:
+                            self.hedges += 1
+                        launch()
+                        pending = {task for task in attempts if not task.done()}
+                        continue
+                    await cancel_others()
+                    raise DeadlineExceeded(f'No provider produced a token within {budget:.1f}s')
+
+                for task in done:
+                    attempts[task].finished = True
+                for task in done:
+                    attempt = attempts[task]
+                    if task.exception() is None and task.result() is not None:
+                        pending.discard(task)
+                        self._won(attempt, hedged and attempt is not ordered()[0], ordered())
+                        await cancel_others(attempt)
+                        return task.result(), attempt.served_model, attempt.route
+
+                    attempt.error = task.exception()
+                    self.fail(attempt.route)
+                    if len(attempts) < len(routes):
+                        with self._lock:
+                            self.failovers += 1
+                        if attempt.resp is not None:
+                            await attempt.resp.aclose()
+                        launch()
+                        pending = {task for task in attempts if not task.done()}
+                    elif not pending:
+                        await cancel_others(attempt)
+                        if attempt.error is not None:
+                            raise attempt.error
+                        return attempt.resp, attempt.served_model, attempt.route
+                    elif attempt.resp is not None:
+                        await attempt.resp.aclose()
+        except asyncio.CancelledError:
+            await cancel_others()
+            raise
+
+    def stats(self) -> dict:
+        now = monotonic()
+        with self._lock:
+            routes = {
+                f'{provider}/{model}': {
+                    'requests': stats.requests,
+                    'errors': stats.errors,
+                    'wins': stats.wins,
+                    'ttft_seconds': stats.ttft() or 0.0,
+                    'error_rate': stats.error_rate(),
+                    'healthy': 0 if now < stats.unhealthy_until else 1,
+                }
+                for (provider, model), stats in self._stats.items()
+            }
+            return {
+                'hedges': self.hedges,
+                'hedge_wins': self.hedge_wins,
+                'failovers': self.failovers,
+                'routes': routes,
+            }
+
+
+def create_router(options: dict, keys: dict):
+    """
+    Build the configured router, or None when it is disabled or no
+    provider is left. `keys` maps provider types to their default API key;
+    providers left without one are dropped.
+    """
+    options = {**ROUTER_DEFAULTS, **options}
+    if not options.pop('enable'):
+        return None
+    providers = {
+        name: provider for name, provider in options.pop('providers').items()
+        if provider.get('key') or keys.get(provider.get('type'))
+    }
+    for name, provider in providers.items():
+        if provider.get('type') not in ('gemini', 'openai'):
+            raise ValueError(f'unknown provider type {provider.get("type")!r} for {name}')
+    if not providers:
+        return None
+    return Router(providers, **options)
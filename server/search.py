@@ -0,0 +1,205 @@
+#Web search for internet_access requests: result cache, single-flight and time budget
+
+import asyncio
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from json import dumps
+from time import time
+
+# Defaults for the optional "search" block of config.json.
+SEARCH_DEFAULTS = {
+    'url': 'https://ddg-api.herokuapp.com/search',
+    'limit': 3,
+    # seconds generation waits for results before going ahead without them
+    'timeout': 3,
+    # cached results expire after `ttl` seconds; the cache holds at most
+    # `max_entries` queries and roughly `max_bytes` of serialized results
+    'ttl': 600,
+    'max_entries': 512,
+    'max_bytes': 2_000_000,
+    # background threads running searches for the Flask path
+    'workers': 8,
+}
+
+
+def normalize_query(query: str) -> str:
+    """Cache key for a query: case, spacing and trailing punctuation don't matter."""
+    return re.sub(r'\s+', ' ', str(query).lower()).strip(' ?!.,;:')
+
+
+class SearchCache:
+    """Thread-safe LRU of search results with per-entry TTL and a byte budget."""
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (expires_at, size, results)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time():
+                if entry is not None:
+                    self._pop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, key: str, results: list) -> None:
+        size = len(dumps(results))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (time() + self.ttl, size, results)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class WebSearch:
+    """
+    Runs web searches concurrently with the rest of request preparation.
+
+    submit() returns immediately: from the cache, by joining an identical
+    search already in flight, or by starting a new one on a small thread
+    pool. results() then waits at most the configured budget and degrades to
+    an empty result list on timeout or error, so a slow search API can delay
+    generation by `timeout` seconds at most.
+    """
+
+    def __init__(self, session, **options) -> None:
+        options = {**SEARCH_DEFAULTS, **options}
+        self.session = session
+        self.url = options['url']
+        self.limit = options['limit']
+        self.timeout = options['timeout']
+        self.cache = SearchCache(options['ttl'], options['max_entries'], options['max_bytes'])
+        self._executor = ThreadPoolExecutor(max_workers=options['workers'], thread_name_prefix='web-search')
+        self._inflight = {}        # key -> concurrent.futures.Future
+        self._async_inflight = {}  # key -> asyncio.Task
+        self._lock = threading.Lock()
+        self.timeouts = 0
+        self.errors = 0
+
+    def _fetch(self, query: str) -> list:
+        search = self.session.get(
+            self.url,
+            params={
+                'query': query,
+                'limit': self.limit,
+            },
+            # let a late answer still land in the cache for the next request
+            timeout=max(self.timeout, 10),
+        )
+        search.raise_for_status()
+        return search.json()
+
+    def _run(self, key: str, query: str) -> list:
+        try:
+            results = self._fetch(query)
+            self.cache.put(key, results)
+            return results
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def submit(self, query: str):
+        key = normalize_query(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        with self._lock:
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._executor.submit(self._run, key, query)
+                self._inflight[key] = future
+        return future
+
+    def results(self, pending, budget: float = None) -> list:
+        if isinstance(pending, list):
+            return pending
+        budget = self.timeout if budget is None else min(budget, self.timeout)
+        try:
+            return pending.result(timeout=budget)
+        except FutureTimeout:
+            self.timeouts += 1
+            print(f'Web search exceeded {budget:.1f}s budget, continuing without results')
+        except Exception as e:
+            self.errors += 1
+            print(f'Web search failed, continuing without results: {e}')
+        return []
+
+    async def asearch(self, client, query: str, budget: float = None) -> list:
+        """asyncio flavour of submit() + results() using an httpx.AsyncClient."""
+        budget = self.timeout if budget is None else min(budget, self.timeout)
+        key = normalize_query(query)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        task = self._async_inflight.get(key)
+        if task is None:
+            async def run():
+                try:
+                    search = await client.get(
+                        self.url,
+                        params={
+                            'query': query,
+                            'limit': self.limit,
+                        },
+                        timeout=max(self.timeout, 10),
+                    )
+                    search.raise_for_status()
+                    results = search.json()
+                    self.cache.put(key, results)
+                    return results
+                finally:
+                    self._async_inflight.pop(key, None)
+
+            task = asyncio.ensure_future(run())
+            # the error is reported to waiters; don't warn if they all gave up
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._async_inflight[key] = task
+
+        try:
+            # shield: a waiter giving up must not cancel the shared search
+            return await asyncio.wait_for(asyncio.shield(task), budget)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            print(f'Web search exceeded {budget:.1f}s budget, continuing without results')
+        except Exception as e:
+            self.errors += 1
+            print(f'Web search failed, continuing without results: {e}')
+        return []
+
+    def stats(self) -> dict:
+        return {
+            **self.cache.stats(),
+            'inflight': len(self._inflight) + len(self._async_inflight),
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+        }
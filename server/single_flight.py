@@ -0,0 +1,111 @@
+#Single-flight requests: identical concurrent requests share one upstream generation
+
+import threading
+from hashlib import sha256
+from json import dumps
+from uuid import uuid4
+
+from server.resume import StreamRecord
+
+# Defaults for the optional "single_flight" block of config.json.
+SINGLE_FLIGHT_DEFAULTS = {
+    'enable': False,
+    # how long a matching request waits for the first one's upstream call to
+    # be accepted; if it fails (or takes longer) the request generates itself
+    'wait': 30,
+    # requests following one generation besides the first (0 = unlimited)
+    'max_subscribers': 0,
+    # frames kept for late joiners when resume is off; a request arriving
+    # after the generation outgrew this starts its own
+    'stream_bytes': 1_000_000,
+}
+
+
+def coalesce_key(model: str, body: dict) -> str:
+    """
+    sha256 over the model and the upstream body with whitespace in every
+    text part collapsed, so prompts differing only in spacing or a trailing
+    newline share a generation.
+    """
+    def normalize(value):
+        if isinstance(value, dict):
+            return {k: ' '.join(v.split()) if k == 'text' and isinstance(v, str) else normalize(v)
+                    for k, v in value.items()}
+        if isinstance(value, list):
+            return [normalize(v) for v in value]
+        return value
+
+    return sha256(dumps([model, normalize(body)], sort_keys=True).encode()).hexdigest()
+
+
+class Coalescer:
+    """
+    Generations in flight by request fingerprint. The first request for a
+    fingerprint leads: it gets a fresh StreamRecord, makes the upstream
+    call and produces into it. Requests arriving while it runs follow the
+    same record from its first frame, so a late joiner gets everything
+    generated so far at once and then the rest live. The generation is
+    cancelled only when every follower's client is gone.
+    """
+
+    def __init__(self, wait: float = 30, max_subscribers: int = 0, stream_bytes: int = 1_000_000) -> None:
+        self.wait = wait
+        self.max_subscribers = max_subscribers
+        self.stream_bytes = stream_bytes
+        self._inflight = {}     # key -> [StreamRecord, subscribers]
+        self._lock = threading.Lock()
+        self.led = 0
+        self.joined = 0
+        self.fallbacks = 0
+
+    def new_record(self, conversation_id: str) -> StreamRecord:
+        return StreamRecord(uuid4().hex[:16], conversation_id or '', self.stream_bytes)
+
+    def _joinable(self, entry: list) -> bool:
+        record, subscribers = entry
+        if record.done or record.first_seq > 1:
+            return False
+        return not self.max_subscribers or subscribers < self.max_subscribers
+
+    def acquire(self, key: str, create) -> tuple:
+        """
+        (record, leader): the generation in flight for `key` to follow, or a
+        new record from `create()` that the caller must produce into (or
+        fail()) when there is none.
+        """
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is not None and self._joinable(entry):
+                entry[1] += 1
+                self.joined += 1
+                return entry[0], False
+            record = create()
+            self._inflight[key] = [record, 0]
+            self.led += 1
+        record.add_finish_callback(lambda text: self._release(key, record))
+        return record, True
+
+    def _release(self, key: str, record: StreamRecord) -> None:
+        with self._lock:
+            entry = self._inflight.get(key)
+            if entry is not None and entry[0] is record:
+                del self._inflight[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = list(self._inflight.values())
+        return {
+            'inflight': len(entries),
+            'subscribers': sum(subscribers for _, subscribers in entries),
+            'led': self.led,
+            'joined': self.joined,
+            'fallbacks': self.fallbacks,
+        }
+
+
+def create_single_flight(options: dict):
+    """Build the configured coalescer, or None when single_flight is disabled."""
+    options = {**SINGLE_FLIGHT_DEFAULTS, **options}
+    if not options.pop('enable'):
+        return None
+    return Coalescer(**options)
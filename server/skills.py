@@ -0,0 +1,411 @@
+#Team skills system prompt: rendering and a process-level cache of the result
+
+import json
+import os
+import re
+import select
+import threading
+from time import time
+
+import psycopg2
+
+from server.pool import DB_CONFIG, get_db_cursor
+
+# Seconds before a background reload of team_skills, and whether to also
+# invalidate immediately on NOTIFY (requires install_change_trigger()).
+TEAM_SKILLS_CONFIG = {
+    'ttl': float(os.getenv('TEAM_SKILLS_TTL', '300')),
+    'listen': os.getenv('TEAM_SKILLS_LISTEN', 'false').lower() in ('1', 'true', 'yes'),
+    # only inject members whose skills are mentioned in the conversation
+    'select': os.getenv('TEAM_SKILLS_SELECT', 'true').lower() in ('1', 'true', 'yes'),
+    # how many trailing conversation messages are searched for skill terms
+    'context_turns': int(os.getenv('TEAM_SKILLS_CONTEXT_TURNS', '4')),
+    # JSON file with a team_skills row, read instead of the database
+    'file': os.getenv('TEAM_SKILLS_FILE'),
+    # "row": the single team_skills row; "tables": the normalized members /
+    # skills / member_skills tables of server/directory.py
+    'source': os.getenv('TEAM_SKILLS_SOURCE', 'row').lower(),
+    # with "tables", most members listed for one request (best matches first)
+    'max_members': int(os.getenv('TEAM_SKILLS_MAX_MEMBERS', '25')),
+}
+
+# Spellings folded onto one canonical skill term, both when indexing the
+# team_skills row and when scanning the conversation.
+SKILL_ALIASES = {
+    'k8s': 'kubernetes',
+    'kube': 'kubernetes',
+    'js': 'javascript',
+    'ecmascript': 'javascript',
+    'ts': 'typescript',
+    'py': 'python',
+    'python3': 'python',
+    'golang': 'go',
+    'reactjs': 'react',
+    'react.js': 'react',
+    'node': 'node.js',
+    'nodejs': 'node.js',
+    'vuejs': 'vue',
+    'vue.js': 'vue',
+    'postgres': 'postgresql',
+    'psql': 'postgresql',
+    'mongo': 'mongodb',
+    'tf': 'terraform',
+    'gcp': 'google cloud',
+    'aws': 'amazon web services',
+    'ml': 'machine learning',
+    'dl': 'deep learning',
+    'ci/cd': 'ci',
+    'cicd': 'ci',
+    'cpp': 'c++',
+    'csharp': 'c#',
+    'dotnet': '.net',
+    'ux': 'user experience',
+    'ui': 'user interface',
+}
+
+# "/" separates words ("Docker/k8s"); "c++", "c#" and ".net" stay whole
+_TOKEN_RE = re.compile(r'[a-z0-9.+#][a-z0-9.+#-]*', re.IGNORECASE)
+
+# Skill words (as written, before aliasing) that are also ordinary English or
+# common abbreviations. On their own they only count with a signal: see
+# SkillIndex.terms().
+AMBIGUOUS_SKILL_WORDS = frozenset({
+    'go', 'r', 'c', 'd', 'ts', 'py', 'ui', 'ux', 'tf', 'js', 'ml', 'dl',
+    'ci', 'cd', 'qa', 'rust', 'swift', 'dart', 'spring', 'express',
+    'compose', 'make', 'chef', 'puppet', 'salt',
+})
+# how many words away a matched skill lends its context to an ambiguous one
+NEIGHBOUR_WORDS = 3
+
+TEAM_SKILLS_HEADER = "\n\n--- CRITICAL CONTEXT: TEAM SKILLS ---\n" \
+                     "You are an AI assistant for a specific team. Below is a list of your team members and their skills. " \
+                     "**THIS IS YOUR MOST IMPORTANT KNOWLEDGE.**\n" \
+                     "BEFORE answering any query about skills, programming, tools, or learning a topic (like 'React', 'Python', 'Docker', etc.), " \
+                     "you MUST FIRST check this list. If the user's query matches a skill in this list, your PRIMARY response " \
+                     "MUST be to identify the team member(s) who have that skill and suggest the user approach them.\n" \
+                     "DO NOT provide general advice or external links for a topic if a team member is listed with that skill. " \
+                     "Only provide general advice if no team member has the skill.\n\n" \
+                     "Example:\n" \
+                     "User: 'How do I learn React?'\n" \
+                     "Your Correct Response: 'For questions about React, **user3@example.com** is the best person on our team to ask! They have it listed as one of their skills.'\n" \
+                     "User: 'Who knows Docker?'\n" \
+                     "Your Correct Response: 'That would be **user4@example.com**. They have experience with Docker and Kubernetes.'\n\n" \
+                     "--- Team Skills List ---\n"
+
+TEAM_SKILLS_FOOTER = "--- End of Team Skills List ---\n"
+
+# Channel notified by the trigger below whenever team_skills is written.
+TEAM_SKILLS_CHANNEL = 'team_skills_changed'
+
+TEAM_SKILLS_NOTIFY_SQL = f"""
+CREATE OR REPLACE FUNCTION notify_team_skills_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('{TEAM_SKILLS_CHANNEL}', TG_OP);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+TEAM_SKILLS_TRIGGER_SQL = TEAM_SKILLS_NOTIFY_SQL + """
+DROP TRIGGER IF EXISTS team_skills_changed ON team_skills;
+CREATE TRIGGER team_skills_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON team_skills
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_team_skills_changed();
+"""
+
+
+def render_member(user_key, team_skills_row: dict) -> str:
+    """Render the prompt block for a single team member of the team_skills row."""
+    user_ids = team_skills_row.get("user_id", {})
+    soft_skills = team_skills_row.get("soft_skills", {})
+    hard_skills = team_skills_row.get("hard_skills", {})
+
+    lines = [f"User: {user_ids[user_key]} \n"]
+
+    # Add soft skills
+    if user_key in soft_skills and soft_skills[user_key]:
+        lines.append(f"  Soft Skills: {', '.join(soft_skills[user_key])}\n")
+
+    # Add hard skills
+    if user_key in hard_skills:
+        user_hard_skills = hard_skills[user_key]
+        hard_skill_parts = []
+        if user_hard_skills.get("programming"):
+            hard_skill_parts.append(f"Programming: {', '.join(user_hard_skills['programming'])}")
+        if user_hard_skills.get("tools"):
+            hard_skill_parts.append(f"Tools: {', '.join(user_hard_skills['tools'])}")
+
+        if hard_skill_parts:
+            lines.append(f"  Hard Skills: {'; '.join(hard_skill_parts)}\n")
+        else:
+            lines.append("  Hard Skills: None listed\n")
+
+    lines.append("\n") # Add a newline for spacing between users
+    return ''.join(lines)
+
+
+def render_team_skills(team_skills_row: dict) -> str:
+    """Render the full team skills context appended to the system message."""
+    members = [render_member(user_key, team_skills_row)
+               for user_key in team_skills_row.get("user_id", {})]
+    return ''.join([TEAM_SKILLS_HEADER, *members, TEAM_SKILLS_FOOTER])
+
+
+def normalize_skill(term: str) -> str:
+    """Lower-case, collapse whitespace and resolve aliases ("K8s " -> "kubernetes")."""
+    term = ' '.join(str(term).lower().split())
+    return SKILL_ALIASES.get(term, term)
+
+
+def _words(text: str) -> list:
+    """
+    (token, word, cased) for each word of `text`: the normalized token, the
+    lowercased word as written, and whether its capitalisation is a signal,
+    i.e. it is capitalised mid-sentence ("Go") or an acronym ("TS").
+    """
+    words = []
+    end = 0
+    for m in _TOKEN_RE.finditer(text):
+        # drop sentence punctuation but keep "c++", "c#" and ".net"
+        raw = m.group().rstrip('.-')
+        if not raw:
+            continue
+        gap = text[end:m.start()]
+        initial = end == 0 or '\n' in gap or any(c in gap for c in '.!?')
+        end = m.start() + len(raw)
+        word = raw.lower()
+        cased = raw != word and (not initial or (len(raw) > 1 and raw.isupper()))
+        words.append((SKILL_ALIASES.get(word, word), word, cased))
+    return words
+
+
+def tokenize(text: str) -> list:
+    """Split free text into normalized single-word skill tokens."""
+    return [token for token, _, _ in _words(text)]
+
+
+def skill_keys(term: str) -> set:
+    """
+    Index keys of one listed skill: its normalized form, its joined tokens
+    and each of its tokens, so "Docker Compose" is found by "docker" too.
+    """
+    tokens = tokenize(term)
+    return {key for key in (normalize_skill(term), ' '.join(tokens), *tokens) if key}
+
+
+class SkillIndex:
+    """
+    Inverted index from normalized skill term to the team_skills member keys
+    listing it. Multi-word skills ("machine learning") are matched against
+    n-grams of the searched text, up to the longest indexed term.
+    """
+
+    def __init__(self, team_skills_row: dict) -> None:
+        self.members = list(team_skills_row.get("user_id", {}))
+        self.postings = {}
+        self.max_words = 1
+
+        soft_skills = team_skills_row.get("soft_skills", {})
+        hard_skills = team_skills_row.get("hard_skills", {})
+
+        for user_key in self.members:
+            terms = list(soft_skills.get(user_key) or [])
+            user_hard_skills = hard_skills.get(user_key) or {}
+            terms += user_hard_skills.get("programming") or []
+            terms += user_hard_skills.get("tools") or []
+
+            for term in terms:
+                for key in skill_keys(term):
+                    self._add(key).add(user_key)
+
+    @classmethod
+    def from_terms(cls, terms) -> 'SkillIndex':
+        """Index of skill keys alone (no members), for matching text against a vocabulary."""
+        index = cls({})
+        for key in terms:
+            index._add(key)
+        return index
+
+    def _add(self, key: str) -> set:
+        self.max_words = max(self.max_words, key.count(' ') + 1)
+        return self.postings.setdefault(key, set())
+
+    def terms(self, text: str) -> list:
+        """
+        Indexed skill keys occurring in `text`, in order of appearance.
+
+        A single word from AMBIGUOUS_SKILL_WORDS only counts when written as
+        a skill ("Go", "TS"), or within NEIGHBOUR_WORDS of another matched
+        skill ("python and go"), so "I want to go home" matches nothing.
+        """
+        words = _words(text)
+        tokens = [token for token, _, _ in words]
+        found = {}
+        anchors = set()
+        pending = []
+        for n in range(1, self.max_words + 1):
+            for i in range(len(tokens) - n + 1):
+                key = ' '.join(tokens[i:i + n])
+                if key not in self.postings:
+                    continue
+                if n == 1 and words[i][1] in AMBIGUOUS_SKILL_WORDS and not words[i][2]:
+                    pending.append((key, i))
+                    continue
+                found.setdefault(key, i)
+                anchors.update(range(i, i + n))
+        for key, i in pending:
+            if any(abs(i - j) <= NEIGHBOUR_WORDS for j in anchors):
+                found.setdefault(key, i)
+        return sorted(found, key=found.get)
+
+    def lookup(self, text: str) -> list:
+        """Member keys whose skills occur in `text`, in team_skills order."""
+        matched = set()
+        for key in self.terms(text):
+            matched |= self.postings[key]
+        return [user_key for user_key in self.members if user_key in matched]
+
+
+def load_team_skills_file(path: str) -> dict:
+    """team_skills row from a JSON file (local development and benchmarks)."""
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def install_change_trigger() -> None:
+    """Create the NOTIFY trigger used to invalidate TeamSkillsPrompt caches."""
+    with get_db_cursor(dict_cursor=False) as (conn, cur):
+        cur.execute(TEAM_SKILLS_TRIGGER_SQL)
+
+
+class TeamSkillsPrompt:
+    """
+    Process-level cache of the rendered team skills context.
+
+    The first get() loads and renders synchronously; afterwards callers are
+    always served from memory. Once `ttl` seconds have passed a single
+    background thread reloads the row while callers keep getting the previous
+    rendering, so the hot path never waits on the database. When listen() is
+    running, a NOTIFY on TEAM_SKILLS_CHANNEL marks the cache stale immediately.
+    """
+
+    # whether select() may query the database once loaded
+    blocking = False
+
+    def __init__(self, loader, ttl: float = 300) -> None:
+        self.loader = loader
+        self.ttl = ttl
+        self.version = 0
+        # (row, full rendering, per-member blocks, SkillIndex), swapped atomically
+        self._state = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+        self._listener = None
+
+    def _load(self) -> None:
+        row = self.loader()
+        blocks = {user_key: render_member(user_key, row) for user_key in row.get("user_id", {})}
+        text = ''.join([TEAM_SKILLS_HEADER, *blocks.values(), TEAM_SKILLS_FOOTER])
+        with self._lock:
+            self._state = (row, text, blocks, SkillIndex(row))
+            self._loaded_at = time()
+            self.version += 1
+
+    def _refresh_in_background(self) -> None:
+        def run():
+            try:
+                self._load()
+            except Exception as e:
+                print(f'Team skills refresh failed, serving cached copy: {e}')
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name='team-skills-refresh', daemon=True).start()
+
+    def _current(self) -> tuple:
+        if self._state is None:
+            # a cold start costs one load; concurrent callers wait for it
+            with self._load_lock:
+                if self._state is None:
+                    self._load()
+            return self._state
+
+        if time() - self._loaded_at >= self.ttl:
+            with self._lock:
+                start = not self._refreshing
+                self._refreshing = True
+            if start:
+                self._refresh_in_background()
+        return self._state
+
+    def warm(self) -> None:
+        """Load the cache ahead of the first request."""
+        self._current()
+
+    @property
+    def loaded(self) -> bool:
+        """True once a rendering is cached and get()/select() won't hit the database."""
+        return self._state is not None
+
+    def get(self) -> str:
+        """Team skills context listing every member."""
+        return self._current()[1]
+
+    def matches(self, text: str) -> str:
+        """Blocks of only the members whose skills are mentioned in `text` ('' when none)."""
+        _, _, blocks, index = self._current()
+        return ''.join(blocks[user_key] for user_key in index.lookup(text))
+
+    def select(self, text: str) -> str:
+        """
+        Team skills context listing only the members whose skills are
+        mentioned in `text`, or every member when nothing matches.
+        """
+        matched = self.matches(text)
+        if not matched:
+            return self.get()
+        return ''.join([TEAM_SKILLS_HEADER, matched, TEAM_SKILLS_FOOTER])
+
+    def row(self) -> dict:
+        """Raw team_skills row behind the current rendering."""
+        return self._current()[0]
+
+    def invalidate(self) -> None:
+        """Mark the cached copy stale; the next get() triggers a refresh."""
+        self._loaded_at = 0.0
+
+    def listen(self, channel: str = TEAM_SKILLS_CHANNEL, poll_timeout: float = 5) -> None:
+        """
+        Start a daemon thread that LISTENs on `channel` over a dedicated
+        (non-pooled) connection and invalidates the cache on every NOTIFY.
+        """
+        if self._listener is not None:
+            return
+
+        def run():
+            while True:
+                conn = None
+                try:
+                    conn = psycopg2.connect(**DB_CONFIG)
+                    conn.autocommit = True
+                    with conn.cursor() as cur:
+                        cur.execute(f'LISTEN {channel};')
+                    # anything may have changed while we were disconnected
+                    self.invalidate()
+                    while True:
+                        if select.select([conn], [], [], poll_timeout) == ([], [], []):
+                            continue
+                        conn.poll()
+                        if conn.notifies:
+                            conn.notifies.clear()
+                            self.invalidate()
+                except Exception as e:
+                    print(f'Team skills listener error, reconnecting: {e}')
+                    if conn is not None:
+                        conn.close()
+                    threading.Event().wait(poll_timeout)
+
+        self._listener = threading.Thread(target=run, name='team-skills-listen', daemon=True)
+        self._listener.start()
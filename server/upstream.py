@@ -0,0 +1,124 @@
+#Long-lived HTTP client shared by all upstream (model and search) calls
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Defaults for the optional "upstream" block of config.json.
+UPSTREAM_DEFAULTS = {
+    # number of distinct hosts to keep connection pools for
+    'pool_connections': 10,
+    # keep-alive connections kept per host; size this to the worker's
+    # concurrent streams or extra connections are opened and thrown away
+    'pool_maxsize': 32,
+    # retries for connection errors and retryable statuses; only applied
+    # before a response body is read, so streams are never replayed
+    'retries': 2,
+    'backoff_factor': 0.3,
+    'status_forcelist': [502, 503, 504],
+}
+
+
+class UpstreamError(Exception):
+    """The model API answered a generation with an error status."""
+
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class UpstreamClient:
+    """
+    Wraps one requests.Session with a tuned connection pool so TLS
+    connections to the model and search APIs are kept alive and reused
+    across requests. Build one per worker process and share it between
+    threads; urllib3's pools are thread-safe.
+    """
+
+    def __init__(self, proxy: dict = None, **options) -> None:
+        options = {**UPSTREAM_DEFAULTS, **options}
+
+        retry = Retry(
+            total=options['retries'],
+            connect=options['retries'],
+            read=0,
+            status=options['retries'],
+            backoff_factor=options['backoff_factor'],
+            status_forcelist=options['status_forcelist'],
+            allowed_methods=frozenset(['GET', 'POST']),
+            raise_on_status=False,
+        )
+        self.adapter = HTTPAdapter(
+            pool_connections=options['pool_connections'],
+            pool_maxsize=options['pool_maxsize'],
+            max_retries=retry,
+        )
+
+        self.session = requests.Session()
+        # ignore HTTP_PROXY/HTTPS_PROXY from the environment; only the
+        # proxy from config.json is honored
+        self.session.trust_env = False
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        if proxy and proxy.get('enable'):
+            self.session.proxies = {
+                'http': proxy.get('http'),
+                'https': proxy.get('https'),
+            }
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.session.get(url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.session.post(url, **kwargs)
+
+    def warm(self, urls: list, timeout: float = 5) -> int:
+        """
+        Open a keep-alive connection (DNS, TCP and TLS) to each URL's host
+        ahead of the first request. The response status doesn't matter.
+        Returns how many hosts answered.
+        """
+        opened = 0
+        for url in urls:
+            try:
+                self.session.head(url, timeout=timeout).close()
+                opened += 1
+            except requests.RequestException as e:
+                print(f'Upstream warm-up of {url} failed: {e}')
+        return opened
+
+    def close(self) -> None:
+        self.session.close()
+
+    def stats(self) -> dict:
+        """
+        Per-host pool statistics. `reuse_rate` is the share of requests that
+        were sent over an already open connection.
+        """
+        managers = [self.adapter.poolmanager, *self.adapter.proxy_manager.values()]
+        hosts = {}
+        for manager in managers:
+            for key in list(manager.pools.keys()):
+                pool = manager.pools.get(key)
+                if pool is None:
+                    continue
+                opened = pool.num_connections
+                sent = pool.num_requests
+                hosts[f'{pool.scheme}://{pool.host}:{pool.port}'] = {
+                    'connections_opened': opened,
+                    'requests': sent,
+                    # unused slots in the queue are None placeholders
+                    'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+                    'maxsize': pool.pool.maxsize if pool.pool is not None else 0,
+                    'reuse_rate': (sent - opened) / sent if sent else 0.0,
+                }
+
+        opened = sum(h['connections_opened'] for h in hosts.values())
+        sent = sum(h['requests'] for h in hosts.values())
+        return {
+            'hosts': hosts,
+            'connections_opened': opened,
+            'requests': sent,
+            'reuse_rate': (sent - opened) / sent if sent else 0.0,
+        }
@@ -1,11 +1,20 @@
-from flask import render_template, send_file, redirect
+from flask import render_template, redirect, request
 from time import time
 from os import urandom
 
+from server.assets import create_asset_store
+from server.metrics import registry
+
 
 class Website:
-    def __init__(self, app) -> None:
+    def __init__(self, app, config: dict = None) -> None:
         self.app = app
+        # client css/js/img held in memory, with fingerprinted URLs for templates
+        self.assets = create_asset_store((config or {}).get('assets', {}))
+        self.app.jinja_env.globals['asset_url'] = self.assets.url
+        self.app.jinja_env.globals['asset_importmap'] = self.assets.importmap
+        self.app.extensions['assets'] = self.assets
+        registry.register_collector('assets', self.assets.stats)
         self.routes = {
             '/': {
                 'function': lambda: redirect('/chat'),
@@ -29,13 +38,19 @@ class Website:
         if not '-' in conversation_id:
             return redirect(f'/chat')
 
-        return render_template('index.html', chat_id=conversation_id)
+        return render_template('index.html', chat_id=conversation_id, server_history=self.app.config.get('SERVER_HISTORY', False))
 
     def _index(self):
-        return render_template('index.html', chat_id=f'{urandom(4).hex()}-{urandom(2).hex()}-{urandom(2).hex()}-{urandom(2).hex()}-{hex(int(time() * 1000))[2:]}')
+        return render_template('index.html', chat_id=f'{urandom(4).hex()}-{urandom(2).hex()}-{urandom(2).hex()}-{urandom(2).hex()}-{hex(int(time() * 1000))[2:]}', server_history=self.app.config.get('SERVER_HISTORY', False))
 
     def _assets(self, folder: str, file: str):
-        try:
-            return send_file(f"./../client/{folder}/{file}", as_attachment=False)
-        except:
+        found = self.assets.respond(
+            folder, file,
+            version = request.args.get('v'),
+            if_none_match = request.headers.get('If-None-Match'),
+            accept_encoding = request.headers.get('Accept-Encoding'),
+        )
+        if found is None:
             return "File not found", 404
+        status, headers, body = found
+        return self.app.response_class(body, status=status, headers=headers)
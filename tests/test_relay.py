@@ -0,0 +1,50 @@
+import json
+
+from server.relay import extract_texts
+
+
+def chunk(text, **extra):
+    return json.dumps({
+        'candidates': [{'content': {'parts': [{'text': text}], 'role': 'model'}, 'index': 0, **extra}],
+        'usageMetadata': {'promptTokenCount': 3, 'candidatesTokenCount': 1, 'totalTokenCount': 4},
+        'modelVersion': 'gemini-2.5-flash',
+    })
+
+
+def test_plain_chunk():
+    assert extract_texts(chunk('Hello "world"\n')) == ['Hello "world"\n']
+
+
+def test_text_key_inside_answer_text():
+    assert extract_texts(chunk('a JSON like {"text": "x"}')) == ['a JSON like {"text": "x"}']
+
+
+def test_grounding_metadata_is_not_answer_text():
+    data = chunk('Docker is a container runtime.', groundingMetadata={
+        'webSearchQueries': ['what is docker'],
+        'groundingChunks': [{'web': {'uri': 'https://docs.docker.com', 'title': 'Docker docs'}}],
+        'groundingSupports': [{
+            'segment': {'startIndex': 0, 'endIndex': 30, 'text': 'Docker is a container runtime.'},
+            'groundingChunkIndices': [0],
+        }],
+    })
+    assert extract_texts(data) == ['Docker is a container runtime.']
+
+
+def test_function_call_args_are_not_answer_text():
+    data = json.dumps({'candidates': [{'content': {'parts': [
+        {'functionCall': {'name': 'search', 'args': {'text': 'docker'}}},
+    ], 'role': 'model'}}]})
+    assert extract_texts(data) == []
+
+
+def test_openai_delta():
+    data = json.dumps({'id': 'c1', 'object': 'chat.completion.chunk', 'model': 'gpt-4o-mini',
+                       'choices': [{'index': 0, 'delta': {'content': 'Hi'}, 'finish_reason': None}]})
+    assert extract_texts(data) == ['Hi']
+
+
+def test_openai_tool_call_arguments_are_not_answer_text():
+    data = json.dumps({'choices': [{'index': 0, 'delta': {'content': None, 'tool_calls': [
+        {'index': 0, 'function': {'name': 'f', 'arguments': '{"content": "x"}'}}]}}]})
+    assert extract_texts(data) == []
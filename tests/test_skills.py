@@ -0,0 +1,43 @@
+from server.skills import SkillIndex, skill_keys, tokenize
+
+TEAM = {
+    'user_id': {'ana': 'ana@example.com', 'bo': 'bo@example.com', 'cy': 'cy@example.com', 'di': 'di@example.com'},
+    'soft_skills': {},
+    'hard_skills': {
+        'ana': {'tools': ['Docker Compose']},
+        'bo': {'programming': ['Go']},
+        'cy': {'tools': ['Kubernetes']},
+        'di': {'programming': ['Python', 'TypeScript']},
+    },
+}
+
+
+def lookup(text):
+    return SkillIndex(TEAM).lookup(text)
+
+
+def test_multi_word_skill_indexes_each_word():
+    assert skill_keys('Docker Compose') == {'docker compose', 'docker', 'compose'}
+    assert lookup('who knows docker?') == ['ana']
+    assert lookup('any docker compose experts?') == ['ana']
+
+
+def test_slash_separates_words():
+    assert tokenize('Docker/k8s help') == ['docker', 'kubernetes', 'help']
+    assert lookup('Docker/k8s help') == ['ana', 'cy']
+
+
+def test_ambiguous_word_needs_a_signal():
+    assert lookup('I want to go home') == []
+    assert lookup('Go home, it is late.') == []
+    assert lookup('let us compose an email') == []
+    assert lookup('Who here writes Go?') == ['bo']
+    assert lookup('any golang people?') == ['bo']
+    assert lookup('porting python and go services') == ['bo', 'di']
+
+
+def test_ambiguous_alias_needs_a_signal():
+    assert lookup('ts') == []
+    assert lookup('help with TS generics') == ['di']
+    assert lookup('py or go?') == []
+    assert lookup('typescript or py?') == ['di']
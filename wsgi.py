@@ -0,0 +1,37 @@
+# Production entry point. gunicorn (see gunicorn.conf.py) imports this module
+# once in the master process, so config, routes, templates and static assets
+# are loaded a single time and shared with every forked worker.
+
+import os
+
+from app import app, load_config, register_routes
+from server.pool import warm_db_pool
+
+config = load_config()
+mode = os.getenv('SERVING_MODE') or config.get('serving', {}).get('mode', 'flask')
+
+# background threads and connections are started per worker in init_worker()
+backend_api = register_routes(config, start_background=False)
+
+# compile the page template before the fork
+app.jinja_env.get_template('index.html')
+
+if mode == 'asgi':
+    from server.asgi import create_asgi_app
+
+    application = create_asgi_app(app, backend_api, config)
+else:
+    application = app
+
+
+def init_worker() -> None:
+    """Runs in each worker right after the fork, before it accepts requests."""
+    backend_api.start_background()
+    warm_db_pool()
+    backend_api.warm()
+
+
+def shutdown_worker() -> None:
+    """Runs when a worker exits, after its in-flight requests have finished."""
+    if backend_api.conversations is not None:
+        backend_api.conversations.flush()